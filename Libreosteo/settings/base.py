@@ -275,6 +275,8 @@ LOGGING = {
     }
 }
 
+# The index may also be stored into the database, with
+# 'ENGINE': 'libreosteoweb.api.sqlite_backend.SQLiteFTSEngine'
 HAYSTACK_CONNECTIONS = {
     'default': {
         'ENGINE': 'haystack.backends.whoosh_backend.WhooshEngine',
@@ -282,7 +284,7 @@ HAYSTACK_CONNECTIONS = {
     },
 }
 
-HAYSTACK_SIGNAL_PROCESSOR = 'haystack.signals.RealtimeSignalProcessor'
+HAYSTACK_SIGNAL_PROCESSOR = 'libreosteoweb.api.indexing.QueuedSignalProcessor'
 
 COMPRESS_CSS_FILTERS = [
     'compressor.filters.css_default.CssAbsoluteFilter',
@@ -291,6 +293,11 @@ COMPRESS_CSS_FILTERS = [
 
 DISPLAY_SERVICE_NET_HELPER = True
 
+# Check for a new version of Libreosteo in background, at most once by
+# interval (in seconds)
+VERSION_CHECK = True
+VERSION_CHECK_INTERVAL = 24 * 3600
+
 PROTECTED_MEDIA_ROOT = os.path.join(DATA_FOLDER, "media")
 PROTECTED_MEDIA_URL = "/files"
 PROTECTED_MEDIA_LOCATION_PREFIX = "/internal"  # Prefix used in nginx config
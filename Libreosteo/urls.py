@@ -42,6 +42,7 @@ router.register(r'profiles', views.TherapeutSettingsViewSet)
 router.register(r'comments', views.ExaminationCommentViewSet)
 router.register(r'office-users', views.UserOfficeViewSet, 'OfficeUser')
 router.register(r'file-import', views.FileImportViewSet)
+router.register(r'import-jobs', views.ImportJobViewSet)
 router.register(r'patient-documents', views.PatientDocumentViewSet,
                 'PatientDocuments')
 router.register(r'paiment-mean', views.PaimentMeanViewSet, 'PaimentMean')
@@ -69,6 +70,9 @@ urlpatterns = [
     re_path(r'^api/statistics[/]?$',
             views.StatisticsView.as_view(),
             name='statistics_view'),
+    re_path(r'^api/search[/]?$',
+            views.GlobalSearchView.as_view(),
+            name='search_api'),
     re_path(r'^api/patients/(?P<patient>.+)/documents$',
             views.PatientDocumentViewSet.as_view({'get': 'list'}),
             name="patient_document_view"),
@@ -77,7 +81,10 @@ urlpatterns = [
     re_path(r'', include('libreosteoweb.urls')),
     re_path(r'^internal/dump.json', views.DbDump.as_view(), name='db_dump'),
     re_path(r'^internal/restore', views.LoadDump.as_view(), name='load_dump'),
-    re_path(r'^internal/rebuild_index',
+    re_path(r'^internal/rebuild_index/(?P<job_id>[0-9a-f]+)$',
+            views.RebuildIndexProgress.as_view(),
+            name="rebuild_index_progress"),
+    re_path(r'^internal/rebuild_index$',
             views.RebuildIndex.as_view(),
             name="rebuild_index"),
 
@@ -90,7 +97,7 @@ urlpatterns = [
             displays.display_examination_timeline),
     re_path(r'^web-view/partials/examination', displays.display_examination),
     re_path(r'^web-view/partials/search-result',
-            views.SearchViewHtml(),
+            displays.display_search_result,
             name='search_view'),
     re_path(r'^web-view/partials/user-profile', displays.display_userprofile),
     re_path(r'^web-view/partials/dashboard', displays.display_dashboard),
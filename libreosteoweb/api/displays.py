@@ -93,7 +93,7 @@ def display_invoices(request):
 
 
 def display_index(request):
-    new_version_available, new_version = version.ask_for_new_version()
+    new_version_available, new_version = version.version_checker.get()
     return render(
         request, 'index.html', {
             'version': libreosteoweb.__version__,
@@ -0,0 +1,91 @@
+# This file is part of LibreOsteo.
+#
+# LibreOsteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LibreOsteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
+from django.http import StreamingHttpResponse
+from rest_framework import serializers
+from rest_framework_csv.renderers import CSVRenderer, CSVStreamingRenderer
+
+# Number of rows fetched from the database at once
+EXPORT_CHUNK_SIZE = 500
+
+
+class CSVStreamingMixin(object):
+    """
+    Streams the CSV rendering of the list, so that the memory stays flat
+    whatever the number of rows. The header, the labels and the writer
+    options of the negotiated CSV renderer are kept.
+    """
+    export_chunk_size = EXPORT_CHUNK_SIZE
+
+    def list(self, request, *args, **kwargs):
+        if isinstance(request.accepted_renderer, CSVRenderer):
+            return self.stream_csv(request)
+        return super(CSVStreamingMixin, self).list(request, *args, **kwargs)
+
+    def stream_csv(self, request):
+        queryset = self.filter_queryset(self.get_queryset())
+        csv_renderer = request.accepted_renderer
+        renderer = CSVStreamingRenderer()
+        renderer.writer_opts = csv_renderer.writer_opts
+        renderer_context = self.get_renderer_context()
+        header = renderer_context.get('header') or csv_renderer.header
+        if not header:
+            header = self.get_csv_header(queryset)
+        renderer_context['header'] = header
+        renderer_context['labels'] = renderer_context.get(
+            'labels', csv_renderer.labels)
+        content = []
+        if header:
+            content = renderer.render(self.get_csv_rows(queryset),
+                                      renderer_context=renderer_context)
+        return StreamingHttpResponse(
+            content,
+            content_type='%s; charset=%s' %
+            (csv_renderer.media_type, csv_renderer.charset))
+
+    def get_csv_rows(self, queryset):
+        serializer_class = self.get_serializer_class()
+        # The serializer context is shared, to load the reference tables
+        # once for the whole export
+        context = self.get_serializer_context()
+        for instance in queryset.iterator(chunk_size=self.export_chunk_size):
+            yield serializer_class(instance, context=context).data
+
+    def get_csv_header(self, queryset):
+        """
+        Builds the header from the fields of the serializer, sorted as the
+        CSVRenderer sorts the columns it collects from all the rows. The
+        views whose columns depend on the rows, as the items of the lists,
+        override it. Without rows, there is no header, as in the
+        CSVRenderer.
+        """
+        if not queryset.exists():
+            return None
+        return sorted(self.get_csv_columns(self.get_serializer().fields))
+
+    def get_csv_columns(self, fields, prefix=''):
+        """
+        Flattens the fields as the CSVRenderer flattens the rows. The lists,
+        which have columns per item, are left out.
+        """
+        columns = []
+        for (name, field) in fields.items():
+            if isinstance(field, serializers.ListSerializer):
+                continue
+            if isinstance(field, serializers.BaseSerializer):
+                columns.extend(
+                    self.get_csv_columns(field.fields, prefix + name + '.'))
+            else:
+                columns.append(prefix + name)
+        return columns
@@ -13,16 +13,36 @@
 # You should have received a copy of the GNU General Public License
 # along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
 import logging
+import collections
 import csv
+import itertools
+import sys
+import threading
+import time
+from django.db import transaction
 from django.utils.translation import gettext_lazy as _
 import random
-from libreosteoweb.models import Patient, ExaminationType, ExaminationStatus
+from libreosteoweb.models import (Patient, Examination, ExaminationType,
+                                  ExaminationStatus)
 from datetime import date, datetime
-from .utils import enum, Singleton, _unicode
+from .filter import get_firstname_filters, get_name_filters
+from .indexing import index_queue
+from .signals import post_bulk_create
+from .utils import enum, _unicode
 
 logger = logging.getLogger(__name__)
 
-_CSV_BUFFER_SIZE = 1024 * 1024 * 10
+# Sample of the file used to guess the dialect of the csv
+_CSV_SNIFF_SIZE = 1024 * 64
+_CSV_SNIFF_LINES = 20
+
+# Bounds of the cache of the analyzed files, as the size of their content
+# in bytes and their lifetime in seconds
+FILE_CONTENT_CACHE_SIZE = 1024 * 1024
+FILE_CONTENT_CACHE_TTL = 3600
+
+# Number of rows validated and inserted at once by the integrators
+INTEGRATION_BATCH_SIZE = 500
 
 
 class Extractor(object):
@@ -90,11 +110,13 @@ class Extractor(object):
                                                      line_filter=filter)
             nb_row = content['nb_row'] - 1
             if nb_row > 0:
-                idx = sorted(
-                    random.sample(range(1, nb_row + 1), min(5, nb_row)))
-                logger.info("indexes = %s " % idx)
-                for i in idx:
-                    result['%s' % (i + 1)] = content['content'][i - 1]
+                idx = set(random.sample(range(1, nb_row + 1), min(5, nb_row)))
+                logger.info("indexes = %s " % sorted(idx))
+                for (i, row) in enumerate(content['content'], 1):
+                    if i in idx:
+                        result['%s' % (i + 1)] = row
+                        if len(result) == len(idx):
+                            break
         except:
             logger.exception('Extractor failed.')
         logger.info("result is %s" % result)
@@ -200,7 +222,24 @@ class AnalyzerExaminationFile(Analyzer):
         super(self.__class__, self).__init__(content=content)
 
 
+class FileContentRows(object):
+    """
+    Rows of a csv file, after its header. The file is read again, row by
+    row, on each iteration.
+    """
+
+    def __init__(self, adapter):
+        self.adapter = adapter
+
+    def __iter__(self):
+        return self.adapter.iter_rows()
+
+
 class FileContentAdapter(dict):
+    """
+    Header and number of rows of a csv file. The rows are not kept in
+    memory, but given by the content as they are read.
+    """
 
     def __init__(self, ourfile, line_filter=None):
         self.file = ourfile
@@ -214,34 +253,54 @@ class FileContentAdapter(dict):
 
     def get_content(self):
         if self['content'] is None:
-            reader = self._get_reader()
             rownum = 0
             header = None
-            content = []
-            for row in reader:
+            for row in self._get_reader():
                 # Save header row.
                 if rownum == 0:
                     header = [self.filter(c) for c in row]
-                else:
-                    content.append([self.filter(c) for c in row])
                 rownum += 1
-            self.file.close()
-            self['content'] = content
+            self['content'] = FileContentRows(self)
             self['nb_row'] = rownum
             self['header'] = header
         return self
 
+    def get_size(self):
+        """
+        Returns the approximate size of the content kept in memory.
+        """
+        return sys.getsizeof(self) + sum(
+            sys.getsizeof(c) for c in self.get('header') or [])
+
+    def iter_rows(self):
+        reader = iter(self._get_reader())
+        try:
+            # Skip the header
+            next(reader, None)
+            for row in reader:
+                yield [self.filter(c) for c in row]
+        finally:
+            # Closes the file when the rows are not all read
+            if hasattr(reader, 'close'):
+                reader.close()
+
     def _get_reader(self):
         if not bool(self.file):
-            return None
-        f = open(str(self.file.file), mode='r', encoding='utf-8')
-        logger.info("* Try to guess the dialect on csv")
-        csv_buffer = f.read(_CSV_BUFFER_SIZE)
-        # Compatibility with python2 and python3
-        dialect = csv.Sniffer().sniff(csv_buffer)
-        f.seek(0)
-        reader = csv.reader(f, dialect)
-        return reader
+            return
+        with open(self.file.path, mode='rb') as f:
+            # Each line is decoded, as utf-8 or else as iso-8859-1
+            lines = DecodeCsvReader(iter(f), filter)
+            logger.info("* Try to guess the dialect on csv")
+            sample = []
+            sample_size = 0
+            for line in itertools.islice(lines, _CSV_SNIFF_LINES):
+                sample.append(line)
+                sample_size += len(line)
+                if sample_size >= _CSV_SNIFF_SIZE:
+                    break
+            dialect = csv.Sniffer().sniff(''.join(sample))
+            for row in csv.reader(itertools.chain(sample, lines), dialect):
+                yield row
 
     def passthrough(self, line):
         return line
@@ -278,25 +337,88 @@ class FileContentKey(object):
         return not (self == other)
 
 
+class FileContentCache(object):
+    """
+    Least recently used contents of the analyzed files, bounded by their
+    size. A content expires ttl seconds after it was read.
+    """
+
+    def __init__(self,
+                 max_size=FILE_CONTENT_CACHE_SIZE,
+                 ttl=FILE_CONTENT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # (expiry time, size, content) by FileContentKey
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+        # The file is read out of the lock
+        content = compute()
+        size = content.get_size()
+        with self.lock:
+            self.remove(key)
+            for (k, entry) in list(self.entries.items()):
+                if entry[0] <= now:
+                    self.remove(k)
+            if size <= self.max_size:
+                self.entries[key] = (now + self.ttl, size, content)
+                self.size += size
+            while self.size > self.max_size:
+                self.remove(next(iter(self.entries)))
+        return content
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def evict(self, ourfile):
+        """
+        Removes the contents of the file, whatever their filter.
+        """
+        with self.lock:
+            for key in [k for k in self.entries if k.file == ourfile]:
+                self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+file_content_cache = FileContentCache()
+
+
 class FileContentProxy(object):
-    __metaclass__ = Singleton
-    file_content = {}
 
     def get_content(self, ourfile, line_filter=None):
-        key = FileContentKey(ourfile, line_filter)
-        try:
-            return self.file_content[key]
-        except KeyError:
-            self.file_content[key] = FileContentAdapter(
-                ourfile, line_filter).get_content()
-            return self.file_content[key]
+        return file_content_cache.get(
+            FileContentKey(ourfile, line_filter),
+            lambda: FileContentAdapter(ourfile, line_filter).get_content())
 
     def unproxy(self, ourfile, line_filter=None):
-        key = FileContentKey(ourfile, line_filter)
-        try:
-            self.file_content[key] = None
-        except:
-            pass
+        file_content_cache.evict(ourfile)
 
 
 class AnalyzerHandler(object):
@@ -342,15 +464,35 @@ class InvalidIntegrationFile(Exception):
 
 class IntegratorHandler(object):
 
-    def integrate(self, file, file_additional=None, user=None):
+    def __init__(self):
+        # The patient tables of the integrated patient files
+        self.patient_tables = {}
+
+    def integrate(self, file, file_additional=None, user=None, progress=None):
+        """
+        Integrates the file. progress is called, if given, after each
+        batch with its number of rows and the result of the file so far.
+        """
         integrator = IntegratorFactory().get_instance(file)
         if integrator is None:
             raise InvalidIntegrationFile(
                 "This file %s is not valid to be integrated." % (file))
-
-        result = integrator.integrate(file,
-                                      file_additional=file_additional,
-                                      user=user)
+        integrator.progress = progress
+        if file_additional is not None:
+            # The patients of the examinations do not have to be looked up
+            integrator.patient_table = self.patient_tables.get(
+                file_additional)
+
+        # The search index is updated once the file is integrated
+        index_queue.hold()
+        try:
+            result = integrator.integrate(file,
+                                          file_additional=file_additional,
+                                          user=user)
+        finally:
+            index_queue.release()
+        if isinstance(integrator, IntegratorPatient):
+            self.patient_tables[file] = integrator.patient_table
         return result
 
     def post_processing(self, files):
@@ -448,11 +590,76 @@ class FilePatientFactory(object):
         return datetime.strptime(value, f).date()
 
 
+def get_patient_key(family_name, first_name, birth_date):
+    """
+    Identifies a patient by its name and birth date, ignoring the case as
+    the serializer does.
+    """
+    return (family_name.lower(), first_name.lower(), birth_date)
+
+
+def get_patient_ids(**filters):
+    """
+    Returns the ids of the stored patients, by key, with a single query.
+    """
+    return dict((get_patient_key(*p[1:]), p[0])
+                for p in Patient.objects.filter(**filters).values_list(
+                    'id', 'family_name', 'first_name', 'birth_date'))
+
+
 class AbstractIntegrator(object):
+    """
+    Integrates the rows of a file by batches. The valid rows of a batch
+    are inserted at once, into their own transaction.
+    """
+    batch_size = INTEGRATION_BATCH_SIZE
+    # The ids of the patients, by their number into the patient file
+    patient_table = None
+    progress = None
 
     def integrate(self, file, file_additional=None, user=None):
         pass
 
+    def get_batches(self, content):
+        """
+        Yields the rows of the content as lists of (line number, row). The
+        first line of the file is the header.
+        """
+        rows = enumerate(content['content'], 2)
+        batch = list(itertools.islice(rows, self.batch_size))
+        while batch:
+            yield batch
+            batch = list(itertools.islice(rows, self.batch_size))
+
+    def create(self, model, instances):
+        """
+        Inserts the instances. As post_save is not sent, the search index
+        and the statistics are updated from post_bulk_create.
+        """
+        if not instances:
+            return []
+        with transaction.atomic():
+            instances = model.objects.bulk_create(instances)
+            # The keys are not returned by the insert on SQLite before 3.35
+            if any(i.pk is None for i in instances):
+                self.fetch_pks(model, instances)
+            post_bulk_create.send(sender=model, instances=instances)
+        return instances
+
+    def fetch_pks(self, model, instances):
+        """
+        Sets the keys of the inserted instances. They are the last rows of
+        the table, as the transaction locks the database once written.
+        """
+        pks = model.objects.order_by('-pk').values_list(
+            'pk', flat=True)[:len(instances)]
+        for (instance, pk) in zip(instances, reversed(pks)):
+            instance.pk = pk
+
+    def report_progress(self, nb_row, nb_line, errors):
+        if self.progress is not None:
+            self.progress(nb_row, (nb_line, errors))
+
 
 class IntegratorPatient(AbstractIntegrator):
 
@@ -465,25 +672,62 @@ class IntegratorPatient(AbstractIntegrator):
         nb_line = 0
         errors = []
         factory = FilePatientFactory()
+        # The ids of the patients of the previous batches, by key
+        ids = {}
+        self.patient_table = {}
 
-        for idx, r in enumerate(content['content']):
-            serializer = factory.get_serializer(r)
-            try:
-                serializer['errors']
-                errors.append((idx + 2, serializer['errors']))
-            except KeyError:
-                if serializer.is_valid():
-                    serializer.save()
-                    nb_line += 1
+        for batch in self.get_batches(content):
+            valid = []
+            for (line, r) in batch:
+                serializer = factory.get_serializer(r)
+                try:
+                    serializer['errors']
+                    errors.append((line, serializer['errors']))
+                except KeyError:
+                    # The existing patients are checked for the whole batch
+                    serializer.validators = []
+                    if serializer.is_valid():
+                        valid.append(
+                            (line, r[0], serializer.validated_data))
+                    else:
+                        errors.append((line, serializer.errors))
+                        logger.info(
+                            "errors detected, data is = %s, errors = %s " %
+                            (serializer.initial_data, serializer.errors))
+            ids.update(get_patient_ids(
+                birth_date__in=set(d['birth_date'] for (l, n, d) in valid)))
+            patients = {}
+            numbers = []
+            for (line, number, data) in valid:
+                key = get_patient_key(data['family_name'], data['first_name'],
+                                      data['birth_date'])
+                if key in ids or key in patients:
+                    errors.append((line, {
+                        'non_field_errors': [_('This patient already exists')]
+                    }))
                 else:
-                    # idx + 2 because : we have header and the index start from 0
-                    # To have the line number we have to add 2 to the index....
-                    errors.append((idx + 2, serializer.errors))
-                    logger.info("errors detected, data is = %s, errors = %s " %
-                                (serializer.initial_data, serializer.errors))
+                    patients[key] = Patient(**data)
+                # The examinations of an existing patient are imported too
+                numbers.append((number, key))
+            nb_line += len(self.create(Patient, list(patients.values())))
+            ids.update((key, p.pk) for (key, p) in patients.items())
+            for (number, key) in numbers:
+                try:
+                    self.patient_table[int(number)] = ids[key]
+                except ValueError:
+                    logger.info("Invalid patient number %s" % number)
+            self.report_progress(len(batch), nb_line, errors)
         logger.info("Dump errors : %s ", errors)
         return (nb_line, errors)
 
+    def fetch_pks(self, model, instances):
+        # The patients of a batch are new, so their keys are unique
+        ids = get_patient_ids(
+            birth_date__in=set(p.birth_date for p in instances))
+        for p in instances:
+            p.pk = ids[get_patient_key(p.family_name, p.first_name,
+                                       p.birth_date)]
+
 
 class IntegratorExamination(AbstractIntegrator):
 
@@ -498,62 +742,72 @@ class IntegratorExamination(AbstractIntegrator):
         content = self.extractor.get_content(file)
         nb_line = 0
         errors = []
-        for idx, r in enumerate(content['content']):
-            logger.info("* Load line %s from content" % idx)
-            try:
-                patient = self.get_patient(int(r[0]), file_additional)
-                data = {
-                    'date': self.get_date(r[1], with_time=True),
-                    'reason': r[2],
-                    'reason_description': r[3],
-                    'orl': r[4],
-                    'visceral': r[5],
-                    'pulmo': r[6],
-                    'uro_gyneco': r[7],
-                    'periphery': r[8],
-                    'general_state': r[9],
-                    'medical_examination': r[10],
-                    'diagnosis': r[11],
-                    'treatments': r[12],
-                    'conclusion': r[13],
-                    'patient': patient.id,
-                    'therapeut': user.id,
-                    'type': ExaminationType.NORMAL,
-                    'status': ExaminationStatus.NOT_INVOICED,
-                    'status_reason': u'%s' % _('Imported examination'),
-                }
-                serializer = self.serializer_class(data=data)
-                if serializer.is_valid():
-                    serializer.save()
-                    nb_line += 1
-                else:
-                    # idx + 2 because : we have header and the index start from 0
-                    # To have the line number we have to add 2 to the index....
-                    errors.append((idx + 2, serializer.errors))
-                    logger.info("errors detected, data is = %s, errors = %s " %
-                                (data, serializer.errors))
-            except ValueError as e:
-                logger.exception("Exception when creating examination.")
-                errors.append((idx + 2, {
-                    'general_problem':
-                    _('There is a problem when reading this line :') +
-                    _unicode(e)
-                }))
-            except:
-                logger.exception("Exception when creating examination.")
-                errors.append((idx + 2, {
-                    'general_problem':
-                    _('There is a problem when reading this line.')
-                }))
+        for batch in self.get_batches(content):
+            examinations = []
+            for (line, r) in batch:
+                examination = self.get_examination(line, r, file_additional,
+                                                   user, errors)
+                if examination is not None:
+                    examinations.append(examination)
+            nb_line += len(self.create(Examination, examinations))
+            self.report_progress(len(batch), nb_line, errors)
         return (nb_line, errors)
 
+    def get_examination(self, line, r, file_additional, user, errors):
+        """
+        Returns the examination of the row, once validated, or records its
+        errors.
+        """
+        logger.info("* Load line %s from content" % line)
+        try:
+            patient_id = self.get_patient_id(int(r[0]), file_additional)
+            data = {
+                'date': self.get_date(r[1], with_time=True),
+                'reason': r[2],
+                'reason_description': r[3],
+                'orl': r[4],
+                'visceral': r[5],
+                'pulmo': r[6],
+                'uro_gyneco': r[7],
+                'periphery': r[8],
+                'general_state': r[9],
+                'medical_examination': r[10],
+                'diagnosis': r[11],
+                'treatments': r[12],
+                'conclusion': r[13],
+                'patient': patient_id,
+                'therapeut': user.id,
+                'type': ExaminationType.NORMAL,
+                'status': ExaminationStatus.NOT_INVOICED,
+                'status_reason': u'%s' % _('Imported examination'),
+            }
+            serializer = self.serializer_class(data=data)
+            if serializer.is_valid():
+                return Examination(**serializer.validated_data)
+            errors.append((line, serializer.errors))
+            logger.info("errors detected, data is = %s, errors = %s " %
+                        (data, serializer.errors))
+        except ValueError as e:
+            logger.exception("Exception when creating examination.")
+            errors.append((line, {
+                'general_problem':
+                _('There is a problem when reading this line :') + _unicode(e)
+            }))
+        except:
+            logger.exception("Exception when creating examination.")
+            errors.append((line, {
+                'general_problem':
+                _('There is a problem when reading this line.')
+            }))
+        return None
+
     def get_date(self, value, with_time=False):
         f = "%d/%m/%Y"
         if with_time:
             return datetime.strptime(value, f)
         return datetime.strptime(value, f).date()
 
-    def get_patient(self, numero, file_patient):
+    def get_patient_id(self, numero, file_patient):
         if not bool(file_patient):
             return None
         if self.patient_table is None:
@@ -561,22 +815,30 @@ class IntegratorExamination(AbstractIntegrator):
         return self.patient_table[numero]
 
     def _build_patient_table(self, file_patient):
+        """
+        Matches the patients of the file, when it was not integrated by
+        this handler, with the stored patients. Only the patients born on
+        the days of a batch of the file are read.
+        """
         content = self.extractor.get_content(file_patient)
         self.patient_table = {}
         factory = FilePatientFactory()
-        for c in content['content']:
-            try:
-                serializer = factory.get_serializer(c)
-                # remove validators to get a validated data through filters
-                serializer.validators = []
-                serializer.is_valid()
-                self.patient_table[int(c[0])] = Patient.objects.filter(
-                    family_name=serializer.validated_data['family_name'],
-                    first_name=serializer.validated_data['first_name'],
-                    birth_date=serializer.validated_data['birth_date']).first(
-                    )
-
-                logger.info("found patient %s " %
-                            self.patient_table[int(c[0])])
-            except:
-                logger.exception("Could not load patient %s" % c[0])
+        # The names are filtered as by PatientSerializer
+        (names, first_names) = (get_name_filters(), get_firstname_filters())
+        for batch in self.get_batches(content):
+            keys = {}
+            for (line, c) in batch:
+                try:
+                    keys[int(c[0])] = get_patient_key(
+                        names.filter(c[1].strip()),
+                        first_names.filter(c[3].strip()),
+                        factory.get_date(c[4]))
+                except Exception:
+                    logger.exception("Could not load patient %s" % c[0])
+            ids = get_patient_ids(
+                birth_date__in=set(key[2] for key in keys.values()))
+            for (number, key) in keys.items():
+                if key in ids:
+                    self.patient_table[number] = ids[key]
+                else:
+                    logger.error("Could not load patient %s" % number)
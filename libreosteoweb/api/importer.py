@@ -0,0 +1,209 @@
+# This file is part of LibreOsteo.
+#
+# LibreOsteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LibreOsteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
+import collections
+import logging
+import threading
+from django.db import close_old_connections
+from django.db.models import F
+from django.utils import timezone
+from libreosteoweb.models import ImportJob
+from .file_integrator import Extractor, IntegratorHandler
+
+logger = logging.getLogger(__name__)
+
+
+class ImportCanceled(Exception):
+    pass
+
+
+class ImportJobRunner(object):
+    """
+    Runs the import jobs, one at a time, in a background thread. The
+    thread is started by ImporterPlugin in server.py, else on the first
+    submitted job.
+
+    The progress and the result of the running job are stored after each
+    batch of lines, where its cancellation is checked too: the batches
+    already integrated are kept, and counted, once the job is canceled.
+    """
+
+    def __init__(self):
+        self.pending = collections.deque()
+        self.condition = threading.Condition()
+        self.worker = None
+        self.stopping = False
+
+    def submit(self, job):
+        with self.condition:
+            self.pending.append(job.pk)
+            self.condition.notify()
+        self.start_worker()
+
+    def recover(self):
+        """
+        Restarts the pending jobs, once the server is started. The jobs
+        interrupted by the previous stop are failed.
+        """
+        ImportJob.objects.filter(status=ImportJob.RUNNING).update(
+            status=ImportJob.FAILED,
+            error='Interrupted',
+            end_date=timezone.now())
+        with self.condition:
+            self.pending.extend(
+                ImportJob.objects.filter(status=ImportJob.PENDING).order_by(
+                    'pk').values_list('pk', flat=True))
+            self.condition.notify()
+
+    def is_running(self):
+        return self.worker is not None and self.worker.is_alive()
+
+    def start_worker(self):
+        with self.condition:
+            if self.is_running():
+                return
+            self.stopping = False
+            self.worker = threading.Thread(target=self.run,
+                                           name='libreosteo-importer',
+                                           daemon=True)
+            self.worker.start()
+
+    def stop_worker(self):
+        """
+        Stops the worker, once the batch of the running job is integrated.
+        """
+        with self.condition:
+            if not self.is_running():
+                return
+            self.stopping = True
+            self.condition.notify()
+        self.worker.join()
+        self.worker = None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopping:
+                    self.condition.wait()
+                if self.stopping:
+                    return
+                job_id = self.pending.popleft()
+            try:
+                self.run_job(job_id)
+            except Exception:
+                logger.exception("Cannot run the import job %s" % job_id)
+            finally:
+                close_old_connections()
+
+    def run_job(self, job_id):
+        # The job may have been canceled in the meantime
+        if not ImportJob.objects.filter(
+                pk=job_id, status=ImportJob.PENDING,
+                cancel_requested=False).update(status=ImportJob.RUNNING,
+                                               start_date=timezone.now()):
+            return
+        job = ImportJob.objects.select_related('file_import').get(pk=job_id)
+        file_import = job.file_import
+        if file_import is None:
+            job.status = ImportJob.FAILED
+            job.error = 'Missing files'
+            job.end_date = timezone.now()
+            job.save()
+            return
+        extractor = Extractor()
+        job.total = sum(
+            extractor.get_content(f)['nb_row'] - 1
+            for f in (file_import.file_patient, file_import.file_examination)
+            if f)
+        job.result = {
+            'patient': {
+                'imported': 0,
+                'errors': []
+            },
+            'examination': {
+                'imported': 0,
+                'errors': []
+            }
+        }
+        job.save()
+        integrator = IntegratorHandler()
+        try:
+            if file_import.file_patient:
+                self.integrate(job, integrator, 'patient',
+                               file_import.file_patient)
+            if file_import.file_examination:
+                self.integrate(job, integrator, 'examination',
+                               file_import.file_examination,
+                               file_additional=file_import.file_patient,
+                               user=job.user)
+            job.status = ImportJob.DONE
+        except ImportCanceled:
+            job.status = ImportJob.CANCELED
+        except Exception as e:
+            logger.exception("Import failed")
+            job.status = ImportJob.FAILED
+            job.error = str(e)
+        finally:
+            integrator.post_processing(
+                files=[file_import.file_patient, file_import.file_examination])
+        job.refresh_from_db(fields=['done', 'cancel_requested'])
+        job.end_date = timezone.now()
+        job.save()
+
+    def integrate(self, job, integrator, name, file, **kwargs):
+
+        def progress(nb_row, result):
+            self.set_result(job, name, result, nb_row)
+            if self.stopping or ImportJob.objects.filter(
+                    pk=job.pk, cancel_requested=True).exists():
+                raise ImportCanceled()
+
+        result = integrator.integrate(file, progress=progress, **kwargs)
+        self.set_result(job, name, result)
+
+    def set_result(self, job, name, result, nb_row=0):
+        """
+        Stores the result of the file so far, as (number of imported lines,
+        errors), and adds the rows processed since the previous call.
+        """
+        (imported, errors) = result
+        job.result[name] = {'imported': imported, 'errors': errors}
+        job.nb_errors = sum(len(r['errors']) for r in job.result.values())
+        ImportJob.objects.filter(pk=job.pk).update(result=job.result,
+                                                   nb_errors=job.nb_errors,
+                                                   done=F('done') + nb_row)
+
+
+import_runner = ImportJobRunner()
+
+
+def start_import(file_import, user):
+    """
+    Creates the import job of the files and queues it.
+    """
+    job = ImportJob.objects.create(file_import=file_import, user=user)
+    import_runner.submit(job)
+    return job
+
+
+def cancel_import(job):
+    """
+    Requests the cancellation of the job, which is stopped after its
+    current batch of lines.
+    """
+    ImportJob.objects.filter(pk=job.pk).update(cancel_requested=True)
+    # Not started yet, so the worker skips it
+    ImportJob.objects.filter(pk=job.pk, status=ImportJob.PENDING).update(
+        status=ImportJob.CANCELED, end_date=timezone.now())
+    job.refresh_from_db()
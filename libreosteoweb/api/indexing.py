@@ -0,0 +1,193 @@
+# This file is part of LibreOsteo.
+#
+# LibreOsteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LibreOsteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
+import logging
+import threading
+import time
+from django.apps import apps
+from django.db import close_old_connections, models, transaction
+from haystack import connections
+from haystack.exceptions import NotHandled
+from haystack.signals import BaseSignalProcessor
+from haystack.utils import get_identifier
+from .signals import post_bulk_create
+
+logger = logging.getLogger(__name__)
+
+# Delay in seconds to gather the changes before indexing them
+INDEXING_DELAY = 1
+
+
+class IndexQueue(object):
+    """
+    Queue of the objects to index, as (using, model label, pk). The queue
+    is applied in batches by a background indexer thread when it is
+    started (see IndexerPlugin in server.py), else it is applied at once.
+    """
+
+    def __init__(self, delay=INDEXING_DELAY):
+        self.delay = delay
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.worker = None
+        self.stopping = False
+        self.held = 0
+
+    def push(self, using, model, pk, identifier):
+        with self.condition:
+            was_empty = not self.pending
+            self.pending[(using, model._meta.label, pk)] = identifier
+            if self.is_running() or self.held:
+                if was_empty:
+                    self.condition.notify()
+                return
+        self.flush()
+
+    def hold(self):
+        """
+        Keeps the changes pending until release() is called, for instance
+        while the index is rebuilt aside.
+        """
+        with self.condition:
+            self.held += 1
+
+    def release(self):
+        with self.condition:
+            self.held -= 1
+            if self.held or self.is_running():
+                self.condition.notify()
+                return
+        self.flush()
+
+    def is_running(self):
+        return self.worker is not None and self.worker.is_alive()
+
+    def start_worker(self):
+        with self.condition:
+            if self.is_running():
+                return
+            self.stopping = False
+            self.worker = threading.Thread(target=self.run,
+                                           name='libreosteo-indexer',
+                                           daemon=True)
+            self.worker.start()
+
+    def stop_worker(self):
+        with self.condition:
+            if not self.is_running():
+                return
+            self.stopping = True
+            self.condition.notify()
+        self.worker.join()
+        self.worker = None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while (not self.pending or self.held) and not self.stopping:
+                    self.condition.wait()
+                # Gather the changes done meanwhile
+                deadline = time.monotonic() + self.delay
+                while not self.stopping and time.monotonic() < deadline:
+                    self.condition.wait(deadline - time.monotonic())
+                stopping = self.stopping
+                if self.held and not stopping:
+                    continue
+            self.flush()
+            close_old_connections()
+            if stopping:
+                return
+
+    def flush(self):
+        """
+        Applies the pending changes, with one update per model.
+        """
+        with self.condition:
+            pending = self.pending
+            self.pending = {}
+        batches = {}
+        for ((using, label, pk), identifier) in pending.items():
+            batches.setdefault((using, label), {})[pk] = identifier
+        for ((using, label), identifiers) in batches.items():
+            try:
+                self.apply(using, apps.get_model(label), identifiers)
+            except Exception:
+                logger.exception("Cannot index %s" % label)
+
+    def apply(self, using, model, identifiers):
+        try:
+            index = connections[using].get_unified_index().get_index(model)
+        except NotHandled:
+            return
+        backend = index.get_backend(using)
+        instances = index.index_queryset(using=using).filter(
+            pk__in=identifiers.keys())
+        instances = [i for i in instances if index.should_update(i)]
+        if instances:
+            backend.update(index, instances)
+        for pk in set(identifiers.keys()) - set(i.pk for i in instances):
+            backend.remove(identifiers[pk])
+
+
+index_queue = IndexQueue()
+
+
+def flush_index_queue():
+    """
+    Applies the pending changes at once, as used by the tests.
+    """
+    index_queue.flush()
+
+
+class QueuedSignalProcessor(BaseSignalProcessor):
+    """
+    Records the saved and deleted objects into the index queue, once the
+    transaction is committed, instead of indexing them into the request.
+    """
+
+    def setup(self):
+        models.signals.post_save.connect(self.handle_save)
+        models.signals.post_delete.connect(self.handle_delete)
+        post_bulk_create.connect(self.handle_bulk_create)
+
+    def teardown(self):
+        models.signals.post_save.disconnect(self.handle_save)
+        models.signals.post_delete.disconnect(self.handle_delete)
+        post_bulk_create.disconnect(self.handle_bulk_create)
+
+    def handle_save(self, sender, instance, **kwargs):
+        self.enqueue(sender, instance)
+
+    def handle_delete(self, sender, instance, **kwargs):
+        self.enqueue(sender, instance)
+
+    def handle_bulk_create(self, sender, instances, **kwargs):
+        for instance in instances:
+            self.enqueue(sender, instance)
+
+    def enqueue(self, sender, instance):
+        if not self.is_indexed(sender):
+            return
+        # The pk is reset once the instance is deleted
+        (pk, identifier) = (instance.pk, get_identifier(instance))
+        for using in self.connection_router.for_write(instance=instance):
+            transaction.on_commit(lambda using=using: index_queue.push(
+                using, sender, pk, identifier))
+
+    def is_indexed(self, sender):
+        for using in self.connections.connections_info.keys():
+            if sender in self.connections[using].get_unified_index(
+            ).get_indexed_models():
+                return True
+        return False
@@ -15,6 +15,7 @@
 from libreosteoweb import models
 from libreosteoweb.api.utils import _unicode, convert_to_long
 from django.utils import timezone
+from django.db import transaction
 
 
 class Generator(object):
@@ -126,6 +127,7 @@ class ExaminationInvoiceHelper(object):
         self.therapeut_settings = therapeut_settings
         self.therapeut_user = therapeut_user
 
+    @transaction.atomic
     def invoice_examination(self,
                             invoicing_serializer,
                             current_examination,
@@ -159,6 +161,7 @@ class ExaminationInvoiceHelper(object):
                 current_invoice.status = models.InvoiceStatus.INVOICED_PAID
                 current_invoice.save()
                 current_examination.save()
+            current_examination.update_current_invoice()
             return {'invoiced': current_invoice.id}
         return {}
 
@@ -0,0 +1,259 @@
+# This file is part of LibreOsteo.
+#
+# LibreOsteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LibreOsteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
+import logging
+import multiprocessing
+import threading
+import uuid
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                as_completed, wait)
+from datetime import timedelta
+from django.apps import apps
+from django.db import close_old_connections, connections as db_connections
+from django.utils import timezone
+from haystack import connections
+from haystack.constants import DEFAULT_ALIAS
+from haystack.exceptions import SkipDocument
+from whoosh import writing
+from .indexing import index_queue
+
+logger = logging.getLogger(__name__)
+
+# Number of objects indexed at once
+REBUILD_BATCH_SIZE = 200
+
+# Time in seconds to wait for the lock of the index
+WRITER_TIMEOUT = 60
+
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def get_chunks(pks, batch_size):
+    """
+    Splits the sorted pks into ranges (first pk, last pk) of at most
+    batch_size objects.
+    """
+    return [(pks[i], pks[min(i + batch_size, len(pks)) - 1])
+            for i in range(0, len(pks), batch_size)]
+
+
+def prepare_chunk(using, label, start_date, first_pk, last_pk):
+    """
+    Renders the documents of the objects of the model in the pk range, as
+    the backend does before writing them. Returns the number of
+    objects and the list of the documents.
+    """
+    if not apps.ready:
+        # Spawned worker process
+        import django
+        django.setup()
+    model = apps.get_model(label)
+    index = connections[using].get_unified_index().get_index(model)
+    backend = connections[using].get_backend()
+    instances = list(
+        index.build_queryset(using=using, start_date=start_date).filter(
+            pk__gte=first_pk, pk__lte=last_pk).order_by('pk'))
+    documents = []
+    for instance in instances:
+        try:
+            document = index.full_prepare(instance)
+        except SkipDocument:
+            continue
+        # Document boosts are not supported by the backends
+        document.pop('boost', None)
+        documents.append(
+            dict((k, backend._from_python(v)) for (k, v) in document.items()))
+    close_old_connections()
+    return (len(instances), documents)
+
+
+class WhooshWriter(object):
+    """
+    Writes the documents of a rebuild into a new segment of the Whoosh
+    index. A full rebuild drops the previous segments with the same commit.
+    """
+
+    def __init__(self, backend, clear):
+        if not backend.setup_complete:
+            backend.setup()
+        backend.index = backend.index.refresh()
+        self.writer = backend.index.writer(timeout=WRITER_TIMEOUT)
+        self.clear = clear
+
+    def add(self, documents):
+        for document in documents:
+            if self.clear:
+                self.writer.add_document(**document)
+            else:
+                self.writer.update_document(**document)
+
+    def commit(self):
+        self.writer.commit(mergetype=writing.CLEAR if self.clear else None)
+
+    def cancel(self):
+        self.writer.cancel()
+
+
+class RebuildJob(object):
+    """
+    Rebuilds the search index in a background thread.
+
+    The documents are rendered by pk range, across the worker processes if
+    any, and written by the writer of the backend, committed at once: the
+    search keeps using the previous index meanwhile. A full rebuild replaces
+    the previous index with this commit; an incremental rebuild only
+    updates the objects updated for the last `age` hours, as
+    `update_index --age` does.
+
+    The Whoosh writer holds the lock of the index until the commit, and
+    the live updates are held by the index queue meanwhile: they are
+    applied once the rebuild is done.
+    """
+
+    def __init__(self, age=None, workers=0, using=DEFAULT_ALIAS):
+        self.id = uuid.uuid4().hex
+        self.age = age
+        self.workers = workers
+        self.using = using
+        self.status = None
+        self.total = 0
+        self.done = 0
+        self.error = None
+        self.thread = None
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'mode': 'full' if self.age is None else 'incremental',
+            'status': self.status,
+            'total': self.total,
+            'done': self.done,
+            'error': self.error,
+        }
+
+    def start(self):
+        self.status = RUNNING
+        self.thread = threading.Thread(target=self.run,
+                                       name='libreosteo-rebuild-index',
+                                       daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            if self.age is None:
+                self.rebuild()
+            else:
+                self.update(timezone.now() - timedelta(hours=self.age))
+            self.status = DONE
+        except Exception as e:
+            logger.exception("Cannot rebuild the index")
+            self.error = str(e)
+            self.status = FAILED
+        finally:
+            db_connections.close_all()
+
+    def get_tasks(self, start_date):
+        tasks = []
+        unified_index = connections[self.using].get_unified_index()
+        for model in unified_index.get_indexed_models():
+            index = unified_index.get_index(model)
+            pks = list(
+                index.build_queryset(using=self.using,
+                                     start_date=start_date).order_by(
+                                         'pk').values_list('pk', flat=True))
+            self.total += len(pks)
+            tasks.extend((self.using, model._meta.label, start_date, first,
+                          last) for (first, last) in get_chunks(
+                              pks, REBUILD_BATCH_SIZE))
+        return tasks
+
+    def prepare(self, tasks):
+        if self.workers <= 1:
+            for task in tasks:
+                yield prepare_chunk(*task)
+            return
+        with self.get_executor() as executor:
+            # Only a few chunks are submitted ahead, so that the documents
+            # are not all kept in memory
+            futures = set()
+            for task in tasks:
+                if len(futures) >= self.workers * 2:
+                    (done, futures) = wait(futures,
+                                           return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+                futures.add(executor.submit(prepare_chunk, *task))
+            for future in as_completed(futures):
+                yield future.result()
+
+    def get_executor(self):
+        # The workers are spawned, as a forked process would inherit the
+        # locks held by the other threads of the server
+        return ProcessPoolExecutor(
+            self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def get_writer(self, clear):
+        backend = connections[self.using].get_backend()
+        if hasattr(backend, 'get_writer'):
+            return backend.get_writer(clear)
+        return WhooshWriter(backend, clear)
+
+    def write(self, tasks, clear):
+        writer = self.get_writer(clear)
+        try:
+            for (count, documents) in self.prepare(tasks):
+                writer.add(documents)
+                self.done += count
+        except Exception:
+            writer.cancel()
+            raise
+        writer.commit()
+
+    def update(self, start_date):
+        self.write(self.get_tasks(start_date), clear=False)
+
+    def rebuild(self):
+        # The changes done meanwhile are applied once the new index is live
+        index_queue.hold()
+        try:
+            self.write(self.get_tasks(None), clear=True)
+        finally:
+            index_queue.release()
+
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+def start_rebuild(age=None, workers=0):
+    """
+    Starts a rebuild job and returns it. Only one job runs at once: the
+    running job is returned if any.
+    """
+    with _jobs_lock:
+        for job in _jobs.values():
+            if job.status == RUNNING:
+                return job
+        _jobs.clear()
+        job = RebuildJob(age=age, workers=workers)
+        _jobs[job.id] = job
+        job.start()
+        return job
+
+
+def get_rebuild_job(job_id):
+    with _jobs_lock:
+        return _jobs.get(job_id)
@@ -12,11 +12,21 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
+from django.conf import settings
+from django.db import transaction
 from django.dispatch import receiver
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import post_save, post_delete, pre_save
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth import user_logged_in, user_logged_out
-from ..models import OfficeEvent, Patient, Examination, PatientDocument, LoggedInUser
+from django.contrib.sessions.models import Session
+from ..models import OfficeEvent, Patient, Examination, Invoice, PatientDocument, LoggedInUser, OfficeSettings, FileImport
+from ..middleware import middleware_cache, session_keys
+from .file_integrator import file_content_cache
+from .signals import post_bulk_create, post_reload_db
+from .statistics import (DailyStatsRollup, StatisticsCache,
+                         get_examination_day)
+from .typeahead import patient_name_index, TYPEAHEAD_FIELDS
+from .rebuild import start_rebuild
 import logging
 
 # Get an instance of a logger
@@ -98,15 +108,167 @@ def receiver_examination(sender, **kwargs):
         event.save()
 
 
+@receiver(post_save, sender=Patient)
+@receiver(post_delete, sender=Patient)
+def daily_stats_patient(sender, **kwargs):
+    if kwargs.get('raw', False):
+        return
+    DailyStatsRollup().refresh([kwargs['instance'].creation_date])
+    StatisticsCache().invalidate_all()
+
+
+@receiver(post_bulk_create, sender=Patient)
+def daily_stats_patient_bulk(sender, instances, **kwargs):
+    DailyStatsRollup().refresh([i.creation_date for i in instances])
+    StatisticsCache().invalidate_all()
+
+
+@receiver(pre_save, sender=Examination)
+def daily_stats_examination_previous_day(sender, **kwargs):
+    instance = kwargs['instance']
+    instance.previous_stats_day = None
+    instance.previous_stats_scope = None
+    if kwargs.get('raw', False) or instance.pk is None:
+        return
+    previous = Examination.objects.filter(pk=instance.pk).values(
+        'date', 'office_id', 'therapeut_id').first()
+    if previous is not None:
+        instance.previous_stats_day = get_examination_day(previous['date'])
+        instance.previous_stats_scope = (previous['office_id'],
+                                         previous['therapeut_id'])
+
+
+@receiver(post_save, sender=Examination)
+@receiver(post_delete, sender=Examination)
+def daily_stats_examination(sender, **kwargs):
+    if kwargs.get('raw', False):
+        return
+    instance = kwargs['instance']
+    DailyStatsRollup().refresh([
+        get_examination_day(instance.date),
+        getattr(instance, 'previous_stats_day', None)
+    ])
+    statistics_cache = StatisticsCache()
+    statistics_cache.invalidate_scope(instance.office_id,
+                                      instance.therapeut_id)
+    previous_scope = getattr(instance, 'previous_stats_scope', None)
+    if previous_scope is not None:
+        statistics_cache.invalidate_scope(*previous_scope)
+
+
+@receiver(post_bulk_create, sender=Examination)
+def daily_stats_examination_bulk(sender, instances, **kwargs):
+    DailyStatsRollup().refresh(
+        [get_examination_day(i.date) for i in instances])
+    statistics_cache = StatisticsCache()
+    for scope in set((i.office_id, i.therapeut_id) for i in instances):
+        statistics_cache.invalidate_scope(*scope)
+
+
+@receiver(post_save, sender=Invoice)
+@receiver(post_delete, sender=Invoice)
+def statistics_invoice(sender, **kwargs):
+    if kwargs.get('raw', False):
+        return
+    instance = kwargs['instance']
+    StatisticsCache().invalidate_scope(instance.officesettings_id,
+                                       instance.therapeut_id)
+
+
+@receiver(post_save, sender=Patient)
+def typeahead_patient(sender, **kwargs):
+    if kwargs.get('raw', False):
+        return
+    instance = kwargs['instance']
+    values = tuple(getattr(instance, f) for f in TYPEAHEAD_FIELDS)
+    transaction.on_commit(lambda: patient_name_index.update(values))
+
+
+@receiver(post_bulk_create, sender=Patient)
+def typeahead_patient_bulk(sender, instances, **kwargs):
+    values = [
+        tuple(getattr(instance, f) for f in TYPEAHEAD_FIELDS)
+        for instance in instances
+    ]
+
+    def update():
+        for v in values:
+            patient_name_index.update(v)
+
+    transaction.on_commit(update)
+
+
+@receiver(post_delete, sender=Patient)
+def typeahead_patient_delete(sender, **kwargs):
+    # The pk is reset once the instance is deleted
+    pk = kwargs['instance'].pk
+    transaction.on_commit(lambda: patient_name_index.remove(pk))
+
+
+@receiver(post_reload_db)
+def daily_stats_reload(sender, **kwargs):
+    DailyStatsRollup().rebuild()
+    StatisticsCache().invalidate_all()
+
+
+@receiver(post_reload_db)
+def current_invoice_reload(sender, **kwargs):
+    # The backups of the older versions do not hold the current invoices
+    Examination.objects.update_current_invoices()
+
+
+@receiver(post_reload_db)
+def typeahead_reload(sender, **kwargs):
+    patient_name_index.reset()
+
+
+@receiver(post_reload_db)
+def search_index_reload(sender, **kwargs):
+    # The backups do not hold the search index
+    transaction.on_commit(start_rebuild)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+@receiver(post_save, sender=OfficeSettings)
+@receiver(post_delete, sender=OfficeSettings)
+def middleware_cache_clear(sender, **kwargs):
+    # Also applied to the changes done by a restore
+    transaction.on_commit(middleware_cache.clear)
+
+
+@receiver(post_save, sender=LoggedInUser)
+@receiver(post_delete, sender=LoggedInUser)
+def session_keys_discard(sender, instance, **kwargs):
+    # The session of the user is checked again on its next request
+    session_keys.discard(instance.user_id)
+
+
 @receiver(post_delete, sender=PatientDocument)
 def delete_document(sender, **kwargs):
     doc_instance = kwargs['instance']
     doc_instance.document.delete()
 
 
+@receiver(post_delete, sender=FileImport)
+def file_content_evict(sender, instance, **kwargs):
+    file_content_cache.evict(instance.file_patient)
+    file_content_cache.evict(instance.file_examination)
+
+
 @receiver(user_logged_in)
 def on_user_logged_in(sender, request, **kwargs):
-    LoggedInUser.objects.get_or_create(user=kwargs.get('user'))
+    logged_in_user, created = LoggedInUser.objects.get_or_create(
+        user=kwargs.get('user'))
+    session_key = request.session.session_key
+    if session_key is None or logged_in_user.session_key == session_key:
+        return
+    # Closes the other session of the user, so that the requests of the new
+    # one do not have to store it
+    if logged_in_user.session_key:
+        Session.objects.filter(session_key=logged_in_user.session_key).delete()
+    logged_in_user.session_key = session_key
+    logged_in_user.save()
 
 
 @receiver(user_logged_out)
@@ -0,0 +1,252 @@
+# This file is part of LibreOsteo.
+#
+# LibreOsteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LibreOsteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
+import datetime
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from haystack.inputs import AutoQuery
+from haystack.query import SearchQuerySet
+from haystack.utils.highlighting import Highlighter
+from rest_framework.exceptions import ParseError
+from libreosteoweb.models import (Document, Examination, Patient,
+                                  PatientDocument)
+
+# Number of results of a page by default
+SEARCH_PAGE_SIZE = 10
+SEARCH_MAX_PAGE_SIZE = 50
+
+# Length of the extract of the results
+SEARCH_HIGHLIGHT_LENGTH = 80
+
+SEARCH_MODELS = {
+    'patient': Patient,
+    'document': Document,
+    'examination': Examination,
+}
+SEARCH_SORTS = ('score', 'family_name', '-date')
+
+EXAMINATION_FACETS = ('month', 'therapeut', 'type')
+
+
+def get_int_param(query_params, name, default=None, minimum=None):
+    value = query_params.get(name)
+    if value in (None, ''):
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise ParseError(detail="%s is invalid" % name)
+    if minimum is not None and value < minimum:
+        raise ParseError(detail="%s is invalid" % name)
+    return value
+
+
+def get_date_param(query_params, name):
+    value = query_params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        date = parse_datetime(value)
+        if date is None:
+            date = parse_date(value)
+            if date is not None:
+                date = datetime.datetime.combine(date, datetime.time())
+    except ValueError:
+        date = None
+    if date is None:
+        raise ParseError(detail="%s is invalid" % name)
+    if timezone.is_naive(date):
+        date = timezone.make_aware(date)
+    return date
+
+
+def get_facet_counts(sqs, facets):
+    counts = sqs.facet_counts().get('fields', {})
+    return dict((facet, [{
+        'value': value,
+        'count': count
+    } for (value, count) in counts.get(facet, [])]) for facet in facets)
+
+
+def get_patients(pks):
+    return dict(
+        (p['id'], p) for p in Patient.objects.filter(pk__in=set(pks)).values(
+            'id', 'family_name', 'first_name'))
+
+
+class BaseSearch(object):
+    """
+    Full text search returning a page of results as JSON. Only the results
+    of the page are loaded from the search backend, along with the hits
+    count and the facet counts.
+    """
+    facets = ()
+
+    def __init__(self, query_params):
+        self.query = query_params.get('q', '').strip()
+        self.page = get_int_param(query_params, 'page', 1, minimum=1)
+        self.page_size = min(
+            get_int_param(query_params,
+                          'page_size',
+                          SEARCH_PAGE_SIZE,
+                          minimum=1), SEARCH_MAX_PAGE_SIZE)
+
+    def get_queryset(self):
+        raise NotImplementedError()
+
+    def get_results(self, results):
+        raise NotImplementedError()
+
+    def get_facets(self, sqs):
+        return get_facet_counts(sqs, self.facets)
+
+    def search(self):
+        response = {
+            'count': 0,
+            'page': self.page,
+            'page_size': self.page_size,
+            'results': [],
+            'facets': {},
+        }
+        if not self.query:
+            return response
+        sqs = self.get_queryset()
+        for facet in self.facets:
+            sqs = sqs.facet(facet)
+        start = (self.page - 1) * self.page_size
+        results = list(sqs[start:start + self.page_size])
+        response.update({
+            'count': sqs.count(),
+            'results': self.get_results(results),
+            'facets': self.get_facets(sqs),
+        })
+        return response
+
+
+class GlobalSearch(BaseSearch):
+    """
+    Search of the patients, their documents and their examinations. The
+    results may be limited to some models and sorted, and give the extract
+    of their text with the words of the query highlighted.
+    """
+
+    def __init__(self, query_params):
+        super(GlobalSearch, self).__init__(query_params)
+        names = [
+            n for n in query_params.get('models', '').split(',') if n.strip()
+        ]
+        if any(n not in SEARCH_MODELS for n in names):
+            raise ParseError(detail="models is invalid")
+        self.models = [SEARCH_MODELS[n] for n in names]
+        self.sort = query_params.get('sort') or 'score'
+        if self.sort not in SEARCH_SORTS:
+            raise ParseError(detail="sort is invalid")
+
+    def get_base_queryset(self):
+        return SearchQuerySet().filter(content=AutoQuery(self.query))
+
+    def get_queryset(self):
+        sqs = self.get_base_queryset().models(*(self.models or
+                                                SEARCH_MODELS.values()))
+        if self.sort != 'score':
+            sqs = sqs.order_by(self.sort)
+        return sqs
+
+    def get_facets(self, sqs):
+        # The counts by model do not depend on the selected models, so that
+        # the results can be refined
+        return {
+            'model': [{
+                'value': name,
+                'count': self.get_base_queryset().models(model).count()
+            } for (name, model) in sorted(SEARCH_MODELS.items())]
+        }
+
+    def get_results(self, results):
+        documents = dict(
+            PatientDocument.objects.filter(document__in=[
+                r.pk for r in results if r.model is Document
+            ]).values_list('document', 'patient'))
+        patient_pks = []
+        for result in results:
+            if result.model is Patient:
+                patient_pks.append(int(result.pk))
+            elif result.model is Examination:
+                patient_pks.append(result.patient)
+            else:
+                patient_pks.append(documents.get(int(result.pk)))
+        patients = get_patients(patient_pks)
+        highlighter = Highlighter(self.query,
+                                  max_length=SEARCH_HIGHLIGHT_LENGTH)
+        return [
+            self.get_result(result, patients.get(pk), highlighter)
+            for (result, pk) in zip(results, patient_pks)
+        ]
+
+    def get_result(self, result, patient, highlighter):
+        if result.model is Patient:
+            title = '%s %s' % (result.family_name, result.first_name)
+        elif result.model is Examination:
+            title = result.reason
+        else:
+            title = result.title
+        return {
+            'model': result.model_name,
+            'id': int(result.pk),
+            'score': result.score,
+            'title': title,
+            'patient': patient,
+            'highlight': highlighter.highlight(result.text or ''),
+        }
+
+
+class ExaminationSearch(BaseSearch):
+    """
+    Search of the examinations, which may be narrowed on the date, the
+    therapeut and the type of the examination. The facet counts are given
+    for the matching examinations, and the results refer to their patient.
+    """
+    facets = EXAMINATION_FACETS
+
+    def __init__(self, query_params):
+        super(ExaminationSearch, self).__init__(query_params)
+        self.filters = {}
+        for name in EXAMINATION_FACETS:
+            value = get_int_param(query_params, name)
+            if value is not None:
+                self.filters[name] = value
+        for lookup in ('date__gte', 'date__lte'):
+            value = get_date_param(query_params, lookup)
+            if value is not None:
+                self.filters[lookup] = value
+
+    def get_queryset(self):
+        sqs = SearchQuerySet().models(Examination).filter(
+            content=AutoQuery(self.query))
+        if self.filters:
+            sqs = sqs.filter(**self.filters)
+        return sqs
+
+    def get_results(self, results):
+        patients = get_patients(r.patient for r in results)
+        return [{
+            'id': int(r.pk),
+            'patient': patients.get(r.patient),
+            'date': r.date,
+            'therapeut': r.therapeut,
+            'type': r.type,
+            'reason': r.reason,
+            'diagnosis': r.diagnosis,
+            'score': r.score,
+        } for r in results]
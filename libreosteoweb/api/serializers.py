@@ -149,7 +149,21 @@ class ExaminationExtractSerializer(WithPkMixin, serializers.ModelSerializer):
             examination__exact=obj.id).count()
 
 
-class PaimentModeSerializer(serializers.Serializer):
+class ReferenceLookupMixin(object):
+    """
+    Loads a small reference table once per serialization pass. The
+    table is kept into the context of the root serializer, which is
+    shared by the nested and listed serializers.
+    """
+
+    def get_reference(self, name, load):
+        references = self.context.setdefault('references', {})
+        if name not in references:
+            references[name] = load()
+        return references[name]
+
+
+class PaimentModeSerializer(ReferenceLookupMixin, serializers.Serializer):
     paiment_mode_text = serializers.SerializerMethodField()
 
     def get_paiment_mode_text(self, obj):
@@ -157,10 +171,12 @@ class PaimentModeSerializer(serializers.Serializer):
             paiment_code = obj.paiment_mode
         else:
             paiment_code = obj.get('paiment_mode')
-        paiment_mean = PaimentMean.objects.filter(code=paiment_code).first()
-        if paiment_mean is not None:
-            return paiment_mean.text
-        return 'n/a'
+        # The first paiment mean with the code is used
+        paiment_means = self.get_reference(
+            'paiment_means', lambda: dict(
+                PaimentMean.objects.order_by('-id').values_list(
+                    'code', 'text')))
+        return paiment_means.get(paiment_code, 'n/a')
 
 
 class PaimentSerializer(PaimentModeSerializer):
@@ -179,10 +195,10 @@ class InvoiceSerializer(WithPkMixin, serializers.ModelSerializer,
     office_name = serializers.SerializerMethodField()
 
     def get_office_name(self, obj):
-        office = OfficeSettings.objects.get(id=obj.officesettings_id)
-        if office is not None:
-            return office.office_name
-        return 'n/a'
+        office_names = self.get_reference(
+            'office_names', lambda: dict(
+                OfficeSettings.objects.values_list('id', 'office_name')))
+        return office_names.get(obj.officesettings_id, 'n/a')
 
     class Meta:
         model = Invoice
@@ -221,6 +237,7 @@ class ExaminationSerializer(serializers.ModelSerializer):
     class Meta:
         model = Examination
         fields = '__all__'
+        read_only_fields = ('current_invoice', 'current_invoice_status')
 
     def validate_date(self, value):
         to_validate = value
@@ -235,6 +252,22 @@ class ExaminationSerializer(serializers.ModelSerializer):
         return to_validate
 
 
+class ExaminationExportSerializer(serializers.ModelSerializer):
+    patient_detail = PatientExportSerializer(source="patient", read_only=True)
+    therapeut_detail = UserInfoSerializer(source="therapeut",
+                                          allow_null=True,
+                                          read_only=True)
+
+    class Meta:
+        model = Examination
+        fields = ('id', 'date', 'reason', 'reason_description', 'orl',
+                  'visceral', 'pulmo', 'uro_gyneco', 'periphery',
+                  'general_state', 'medical_examination', 'diagnosis',
+                  'treatments', 'conclusion', 'status', 'type', 'office',
+                  'therapeut', 'patient', 'patient_detail',
+                  'therapeut_detail')
+
+
 class CheckSerializer(serializers.Serializer):
     bank = serializers.CharField(required=False, allow_null=True)
     payer = serializers.CharField(required=False, allow_null=True)
@@ -300,28 +333,57 @@ class ExaminationCommentSerializer(WithPkMixin, serializers.ModelSerializer):
         fields = '__all__'
 
 
+def get_event_patient_names(events):
+    """
+    Resolves the patient names of the events, with one query per
+    referenced model. The names are keyed by (clazz, reference), and
+    the missing references are left out.
+    """
+    references = {}
+    for event in events:
+        references.setdefault(event.clazz, set()).add(event.reference)
+    patients = {}
+    if "Patient" in references:
+        for (reference, patient) in Patient.objects.only(
+                'family_name',
+                'first_name').in_bulk(references["Patient"]).items():
+            patients[("Patient", reference)] = patient
+    if "Examination" in references:
+        for (reference, examination) in Examination.objects.select_related(
+                'patient').only('patient__family_name',
+                                'patient__first_name').in_bulk(
+                                    references["Examination"]).items():
+            patients[("Examination", reference)] = examination.patient
+    return dict((key, "%s %s" % (patient.family_name, patient.first_name))
+                for (key, patient) in patients.items())
+
+
+class OfficeEventListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        events = list(data.all() if isinstance(data, models.Manager
+                                               ) else data)
+        self.context['patient_names'] = get_event_patient_names(events)
+        return super(OfficeEventListSerializer,
+                     self).to_representation(events)
+
+
 class OfficeEventSerializer(WithPkMixin, serializers.ModelSerializer):
 
     class Meta:
         model = OfficeEvent
         fields = '__all__'
+        list_serializer_class = OfficeEventListSerializer
 
     patient_name = serializers.SerializerMethodField()
     translated_comment = serializers.SerializerMethodField()
     therapeut_name = UserInfoSerializer(source='user')
 
     def get_patient_name(self, obj):
-        if (obj.clazz == "Patient"):
-            patient = Patient.objects.get(id=obj.reference)
-            return "%s %s" % (patient.family_name, patient.first_name)
-        if (obj.clazz == "Examination"):
-            try:
-                examination = Examination.objects.get(id=obj.reference)
-                patient = examination.patient
-                return "%s %s" % (patient.family_name, patient.first_name)
-            except ObjectDoesNotExist:
-                pass
-        return ""
+        patient_names = self.context.get('patient_names', None)
+        if patient_names is None:
+            patient_names = get_event_patient_names([obj])
+        return patient_names.get((obj.clazz, obj.reference), "")
 
     def get_translated_comment(self, obj):
         return _(obj.comment)
@@ -438,6 +500,19 @@ class FileImportSerializer(WithPkMixin, serializers.ModelSerializer):
         return Extractor().extract(obj)
 
 
+class ImportJobSerializer(serializers.ModelSerializer):
+    eta = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ImportJob
+        fields = ('id', 'file_import', 'status', 'total', 'done', 'nb_errors',
+                  'result', 'error', 'cancel_requested', 'creation_date',
+                  'start_date', 'end_date', 'eta')
+
+    def get_eta(self, obj):
+        return obj.get_eta()
+
+
 class DocumentSerializer(WithPkMixin, serializers.ModelSerializer):
 
     class Meta:
@@ -17,3 +17,7 @@
 import django.dispatch
 
 post_reload_db = django.dispatch.Signal()
+
+# Sent with the instances inserted at once by bulk_create(), which does not
+# send post_save
+post_bulk_create = django.dispatch.Signal()
@@ -0,0 +1,460 @@
+# This file is part of LibreOsteo.
+#
+# LibreOsteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LibreOsteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Search backend storing the documents into a SQLite FTS5 table of the
+database, so that the index lives with the data. Select it with:
+
+    HAYSTACK_CONNECTIONS = {
+        'default': {
+            'ENGINE': 'libreosteoweb.api.sqlite_backend.SQLiteFTSEngine',
+        },
+    }
+"""
+import datetime
+import json
+import logging
+import re
+import warnings
+from django.apps import apps
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DEFAULT_DB_ALIAS, connections as db_connections
+from django.db import transaction
+from django.utils import timezone
+from haystack import connections
+from haystack.backends import (BaseEngine, BaseSearchBackend,
+                               BaseSearchQuery, log_query)
+from haystack.constants import DJANGO_CT, DJANGO_ID, ID
+from haystack.exceptions import SkipDocument
+from haystack.inputs import AutoQuery, Exact, Raw
+from haystack.models import SearchResult
+from haystack.utils import get_identifier
+
+logger = logging.getLogger(__name__)
+
+# Query matching all the documents
+MATCH_ALL = '1'
+
+# Fixed width, so that the dates are compared as strings
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+_words = re.compile(r'\w+')
+_exacts = re.compile(r'"(?P<phrase>.*?)"')
+
+
+def quote(text):
+    return '"%s"' % text.replace('"', '""')
+
+
+def build_terms(text):
+    """
+    Every word of the text is a prefix query, as the EdgeNgram fields.
+    """
+    words = _words.findall(text)
+    if not words:
+        # Matches nothing
+        return quote('')
+    return ' '.join(quote(w) + '*' for w in words)
+
+
+def build_phrase(text):
+    return quote(' '.join(_words.findall(text)))
+
+
+def literal(value):
+    """
+    Returns the SQL literal of a value, as prepared by _from_python().
+    """
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'%s'" % str(value).replace("'", "''")
+
+
+class SQLiteFTSSearchBackend(BaseSearchBackend):
+    """
+    The documents are rows of a FTS5 table, whose rowid is made from the
+    content type and the primary key of the object. The fields of the
+    document are kept as JSON, for the filters, the facets and the search
+    results.
+
+    The queries are SQL conditions on this table, where the full text
+    queries are MATCH sub queries.
+    """
+
+    def __init__(self, connection_alias, **connection_options):
+        super(SQLiteFTSSearchBackend,
+              self).__init__(connection_alias, **connection_options)
+        self.database = connection_options.get('DATABASE', DEFAULT_DB_ALIAS)
+        self.table = connection_options.get('TABLE', 'libreosteoweb_search')
+
+    def get_connection(self):
+        return db_connections[self.database]
+
+    def setup(self, cursor, table=None):
+        cursor.execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s UNINDEXED, '
+            'text, data UNINDEXED, tokenize="unicode61 remove_diacritics 2")'
+            % (self.quote_name(table or self.table), ID))
+
+    def quote_name(self, name):
+        return self.get_connection().ops.quote_name(name)
+
+    def get_rowid_range(self, model):
+        content_type = ContentType.objects.get_for_model(model)
+        return (content_type.id << 32, ((content_type.id + 1) << 32) - 1)
+
+    def get_rowid(self, identifier):
+        (app_label, model_name, pk) = identifier.split('.')
+        (first, last) = self.get_rowid_range(
+            apps.get_model(app_label, model_name))
+        return first + int(pk)
+
+    def _to_python(self, field, value):
+        if value is not None and field.field_type == 'datetime':
+            value = datetime.datetime.strptime(value, DATETIME_FORMAT)
+            if settings.USE_TZ:
+                value = timezone.make_aware(value, datetime.timezone.utc)
+        elif value is not None and field.field_type == 'date':
+            value = datetime.date.fromisoformat(value)
+        return value
+
+    def _from_python(self, value):
+        if isinstance(value, datetime.datetime):
+            if timezone.is_aware(value):
+                value = timezone.make_naive(value, datetime.timezone.utc)
+            return value.strftime(DATETIME_FORMAT)
+        if isinstance(value, datetime.date):
+            return value.isoformat()
+        if isinstance(value, (set, tuple)):
+            return list(value)
+        return value
+
+    def prepare(self, index, instance):
+        document = index.full_prepare(instance)
+        document.pop('boost', None)
+        return dict(
+            (k, self._from_python(v)) for (k, v) in document.items())
+
+    def write(self, cursor, documents, table=None):
+        """
+        Writes the documents, as prepared by prepare(), replacing the
+        previous version of the objects.
+        """
+        document_field = connections[
+            self.connection_alias].get_unified_index().document_field
+        rows = [(self.get_rowid(d[ID]), d[ID], d.get(document_field) or '',
+                 json.dumps(d, cls=DjangoJSONEncoder)) for d in documents]
+        table = self.quote_name(table or self.table)
+        cursor.executemany('DELETE FROM %s WHERE rowid = %%s' % table,
+                           [(r[0], ) for r in rows])
+        cursor.executemany(
+            'INSERT INTO %s (rowid, %s, text, data) VALUES (%%s, %%s, %%s, '
+            '%%s)' % (table, ID), rows)
+
+    def update(self, index, iterable, commit=True):
+        documents = []
+        for instance in iterable:
+            try:
+                documents.append(self.prepare(index, instance))
+            except SkipDocument:
+                logger.debug("Indexing for object `%s` skipped", instance)
+        if not documents:
+            return
+        with transaction.atomic(using=self.database):
+            with self.get_connection().cursor() as cursor:
+                self.setup(cursor)
+                self.write(cursor, documents)
+
+    def remove(self, obj_or_string, commit=True):
+        with transaction.atomic(using=self.database):
+            with self.get_connection().cursor() as cursor:
+                self.setup(cursor)
+                cursor.execute(
+                    'DELETE FROM %s WHERE rowid = %%s' %
+                    self.quote_name(self.table),
+                    [self.get_rowid(get_identifier(obj_or_string))])
+
+    def clear(self, models=None, commit=True):
+        with transaction.atomic(using=self.database):
+            with self.get_connection().cursor() as cursor:
+                self.setup(cursor)
+                if models is None:
+                    cursor.execute('DELETE FROM %s' %
+                                   self.quote_name(self.table))
+                    return
+                for model in models:
+                    cursor.execute(
+                        'DELETE FROM %s WHERE rowid BETWEEN %%s AND %%s' %
+                        self.quote_name(self.table),
+                        self.get_rowid_range(model))
+
+    def get_writer(self, clear):
+        return SQLiteFTSWriter(self, clear)
+
+    def build_match(self, query):
+        """
+        Returns the condition matching the full text query.
+        """
+        table = self.quote_name(self.table)
+        return '%s.rowid IN (SELECT rowid FROM %s WHERE %s MATCH %s)' % (
+            table, table, table, literal(query))
+
+    def build_where(self, query_string, models, narrow_queries):
+        where = ['(%s)' % q for q in [query_string] + list(narrow_queries or [])]
+        ranges = [self.get_rowid_range(m) for m in models]
+        where.append('(%s)' % ' OR '.join(
+            ['%s.rowid BETWEEN %d AND %d' % ((self.quote_name(self.table), ) + r)
+             for r in ranges] or ['0']))
+        return ' AND '.join(where)
+
+    def build_order_by(self, sort_by, scored):
+        order_by = []
+        for field in sort_by or []:
+            direction = 'DESC' if field.startswith('-') else 'ASC'
+            field = field.lstrip('-')
+            if field == 'score':
+                if scored:
+                    order_by.append('score %s' % direction)
+                continue
+            order_by.append("json_extract(data, '$.%s') %s" %
+                            (_words.match(field).group(0), direction))
+        if not order_by and scored:
+            order_by.append('score DESC')
+        order_by.append('%s.rowid ASC' % self.quote_name(self.table))
+        return ', '.join(order_by)
+
+    def get_facets(self, cursor, where, facets):
+        counts = {}
+        for field in facets:
+            cursor.execute(
+                "SELECT json_extract(data, '$.%s') AS value, COUNT(*) FROM %s "
+                "WHERE %s GROUP BY value" % (_words.match(field).group(0),
+                                             self.quote_name(self.table), where))
+            # As Whoosh, the most frequent values first
+            counts[field] = sorted(
+                cursor.fetchall(),
+                key=lambda c: (-c[1], c[0] is None, c[0] or 0))
+        return counts
+
+    @log_query
+    def search(self,
+               query_string,
+               sort_by=None,
+               start_offset=0,
+               end_offset=None,
+               facets=None,
+               date_facets=None,
+               query_facets=None,
+               models=None,
+               narrow_queries=None,
+               result_class=None,
+               match=None,
+               **kwargs):
+        if not query_string:
+            return {'results': [], 'hits': 0}
+        if date_facets or query_facets:
+            warnings.warn("Only the field facets are supported",
+                          Warning,
+                          stacklevel=2)
+        unified_index = connections[self.connection_alias].get_unified_index()
+        if not models:
+            models = unified_index.get_indexed_models()
+        where = self.build_where(query_string, models, narrow_queries)
+        table = self.quote_name(self.table)
+        limit = -1 if end_offset is None else end_offset - start_offset
+        with self.get_connection().cursor() as cursor:
+            self.setup(cursor)
+            cursor.execute('SELECT COUNT(*) FROM %s WHERE %s' % (table, where))
+            hits = cursor.fetchone()[0]
+            if match:
+                # The bm25 rank is lower for the better matches
+                cursor.execute(
+                    'SELECT data, COALESCE(ranked.score, 0) AS score FROM %s '
+                    'LEFT JOIN (SELECT rowid, -bm25(%s) AS score FROM %s '
+                    'WHERE %s MATCH %%s) AS ranked ON ranked.rowid = %s.rowid '
+                    'WHERE %s ORDER BY %s LIMIT %%s OFFSET %%s' %
+                    (table, table, table, table, table, where,
+                     self.build_order_by(sort_by, True)),
+                    [match, limit, start_offset])
+            else:
+                cursor.execute(
+                    'SELECT data, 0 AS score FROM %s WHERE %s ORDER BY %s '
+                    'LIMIT %%s OFFSET %%s' %
+                    (table, where, self.build_order_by(sort_by, False)),
+                    [limit, start_offset])
+            rows = cursor.fetchall()
+            facet_counts = {}
+            if facets:
+                facet_counts['fields'] = self.get_facets(cursor, where, facets)
+        result_class = result_class or SearchResult
+        results = []
+        for (data, score) in rows:
+            fields = json.loads(data)
+            (app_label, model_name) = fields.pop(DJANGO_CT).split('.')
+            pk = fields.pop(DJANGO_ID)
+            fields.pop(ID, None)
+            index_fields = unified_index.get_index(
+                apps.get_model(app_label, model_name)).fields
+            for (name, value) in fields.items():
+                if name in index_fields:
+                    fields[name] = self._to_python(index_fields[name], value)
+            results.append(
+                result_class(app_label, model_name, pk, score, **fields))
+        return {'results': results, 'hits': hits, 'facets': facet_counts}
+
+
+class SQLiteFTSWriter(object):
+    """
+    Writes the documents of a rebuild. A full rebuild writes them into a
+    new table, which replaces the live one on commit.
+    """
+
+    def __init__(self, backend, clear):
+        self.backend = backend
+        self.clear = clear
+        self.table = backend.table + '_rebuild' if clear else backend.table
+        with backend.get_connection().cursor() as cursor:
+            if clear:
+                self.drop(cursor)
+            backend.setup(cursor, self.table)
+
+    def drop(self, cursor):
+        cursor.execute('DROP TABLE IF EXISTS %s' %
+                       self.backend.quote_name(self.table))
+
+    def add(self, documents):
+        with transaction.atomic(using=self.backend.database):
+            with self.backend.get_connection().cursor() as cursor:
+                self.backend.write(cursor, documents, self.table)
+
+    def commit(self):
+        if not self.clear:
+            return
+        with transaction.atomic(using=self.backend.database):
+            with self.backend.get_connection().cursor() as cursor:
+                cursor.execute('DROP TABLE IF EXISTS %s' %
+                               self.backend.quote_name(self.backend.table))
+                cursor.execute('ALTER TABLE %s RENAME TO %s' %
+                               (self.backend.quote_name(self.table),
+                                self.backend.quote_name(self.backend.table)))
+
+    def cancel(self):
+        if self.clear:
+            with self.backend.get_connection().cursor() as cursor:
+                self.drop(cursor)
+
+
+class SQLiteFTSSearchQuery(BaseSearchQuery):
+    """
+    Builds the SQL conditions of the queries. The full text queries are FTS5
+    queries, where the words are prefix queries.
+    """
+    operators = {
+        'exact': '=',
+        'gt': '>',
+        'gte': '>=',
+        'lt': '<',
+        'lte': '<=',
+    }
+
+    def matching_all_fragment(self):
+        return MATCH_ALL
+
+    def build_query(self):
+        # Full text queries of the query, for the ranking
+        self.matches = []
+        return super(SQLiteFTSSearchQuery, self).build_query()
+
+    def build_params(self, *args, **kwargs):
+        search_kwargs = super(SQLiteFTSSearchQuery,
+                              self).build_params(*args, **kwargs)
+        self.build_query()
+        if self.matches:
+            search_kwargs['match'] = ' OR '.join('(%s)' % m
+                                                 for m in self.matches)
+        return search_kwargs
+
+    def build_query_fragment(self, field, filter_type, value):
+        if isinstance(value, Raw):
+            return value.query_string
+        if field in ('content', connections[
+                self._using].get_unified_index().document_field):
+            match = self.build_match_query(filter_type, value)
+            self.matches.append(match)
+            return self.backend.build_match(match)
+        value = getattr(value, 'query_string', value)
+        column = "json_extract(data, '$.%s')" % _words.match(field).group(0)
+        if filter_type == 'in':
+            return '%s IN (%s)' % (column, ', '.join(
+                literal(self.backend._from_python(v)) for v in value))
+        if filter_type == 'range':
+            return '%s BETWEEN %s AND %s' % ((column, ) + tuple(
+                literal(self.backend._from_python(v)) for v in value))
+        if filter_type in ('content', 'contains', 'startswith') and isinstance(
+                value, str):
+            pattern = value.replace('\\', '\\\\').replace('%', '\\%').replace(
+                '_', '\\_')
+            if filter_type != 'startswith':
+                pattern = '%' + pattern
+            return "%s LIKE %s ESCAPE '\\'" % (column, literal(pattern + '%'))
+        if filter_type in ('content', 'contains'):
+            filter_type = 'exact'
+        if filter_type in self.operators:
+            return '%s %s %s' % (column, self.operators[filter_type],
+                                 literal(self.backend._from_python(value)))
+        raise NotImplementedError("The %s filter is not supported" %
+                                  filter_type)
+
+    def build_match_query(self, filter_type, value):
+        if isinstance(value, AutoQuery):
+            return self.build_auto_query(value.query_string)
+        if filter_type == 'exact' or isinstance(value, Exact):
+            return build_phrase(str(getattr(value, 'query_string', value)))
+        value = getattr(value, 'query_string', value)
+        if filter_type == 'in':
+            return '(%s)' % ' OR '.join(build_phrase(str(v)) for v in value)
+        if filter_type in ('content', 'contains', 'startswith', 'fuzzy'):
+            return build_terms(str(value))
+        raise NotImplementedError("The %s filter is not supported" %
+                                  filter_type)
+
+    def build_auto_query(self, query_string):
+        """
+        As AutoQuery: the quoted phrases are exact matches, and the words
+        starting with '-' are excluded.
+        """
+        exacts = _exacts.findall(query_string)
+        (included, excluded) = ([build_phrase(e) for e in exacts], [])
+        for word in _exacts.sub(' ', query_string).split():
+            if word.startswith('-') and len(word) > 1:
+                excluded.append(build_terms(word[1:]))
+            else:
+                included.append(build_terms(word))
+        if not included:
+            return quote('')
+        query = ' '.join(included)
+        if excluded:
+            query = '(%s) NOT (%s)' % (query, ' OR '.join(excluded))
+        return query
+
+
+class SQLiteFTSEngine(BaseEngine):
+    backend = SQLiteFTSSearchBackend
+    query = SQLiteFTSSearchQuery
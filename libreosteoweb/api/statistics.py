@@ -12,20 +12,91 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
-from libreosteoweb.models import Patient, Examination
+from libreosteoweb.models import (Patient, Examination, Invoice,
+                                  DailyOfficeStats, ExaminationType,
+                                  InvoiceStatus)
 from datetime import date, timedelta
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, DateField, Q, Sum
+from django.db.models.functions import (TruncDate, TruncMonth, TruncWeek,
+                                        TruncYear)
 from django.utils import timezone
 import datetime
 import copy
 
+HISTORY_LENGTH = 11
+
+COUNTERS = [
+    'nb_new_patient', 'nb_urgent_return', 'nb_non_paid', 'nb_examination',
+    'amount_non_paid'
+]
+
+# Aging of the receivables, in days since the invoice date
+AGING_BUCKETS = [('0-30', 0, 30), ('31-60', 30, 60), ('61-90', 60, 90),
+                 ('90+', 90, None)]
+
 
 class Statistics(object):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, office=None, therapeut=None, *args, **kwargs):
         # Initialize variable that it should be needed
         self.sub_classes_period = dict(week=WeekPeriod,
                                        month=MonthPeriod,
                                        year=YearPeriod)
         self.subclass = None
+        # Scope of the examinations. The patients are not attached to an
+        # office or a therapeut, so new patients are always counted globally.
+        self.office = office
+        self.therapeut = therapeut
+
+    def get_examination_scope(self):
+        scope = {}
+        if self.office is not None:
+            scope['office_id'] = self.office
+        if self.therapeut is not None:
+            scope['therapeut_id'] = self.therapeut
+        return scope
+
+    def get_unpaid_invoices(self):
+        invoices = Invoice.objects.filter(
+            status=InvoiceStatus.WAITING_FOR_PAIEMENT)
+        if self.office is not None:
+            invoices = invoices.filter(officesettings_id=self.office)
+        if self.therapeut is not None:
+            invoices = invoices.filter(therapeut_id=self.therapeut)
+        return invoices
+
+    def get_receivables(self, current_date=None):
+        """
+        Count and amount of the invoices waiting for paiement, by aging.
+        Computed with one aggregate query.
+        """
+        if current_date is None:
+            current_date = timezone.now()
+        aggregates = {
+            'nb_non_paid': Count('id'),
+            'amount_non_paid': Sum('amount')
+        }
+        for (label, min_days, max_days) in AGING_BUCKETS:
+            aging = Q()
+            if min_days > 0:
+                aging &= Q(date__lt=current_date - timedelta(days=min_days))
+            if max_days is not None:
+                aging &= Q(date__gte=current_date - timedelta(days=max_days))
+            aggregates['nb_%s' % label] = Count('id', filter=aging)
+            aggregates['amount_%s' % label] = Sum('amount', filter=aging)
+        values = self.get_unpaid_invoices().aggregate(**aggregates)
+        return {
+            'nb_non_paid':
+            values['nb_non_paid'],
+            'amount_non_paid':
+            values['amount_non_paid'] or 0,
+            'aging': [{
+                'label': label,
+                'nb_non_paid': values['nb_%s' % label],
+                'amount_non_paid': values['amount_%s' % label] or 0
+            } for (label, min_days, max_days) in AGING_BUCKETS]
+        }
 
     def define_period_subclass(self, selector=None):
         if selector is None:
@@ -41,12 +112,7 @@ class Statistics(object):
         if (start_date is None):
             start_date = timezone.now()
         if statistics_obj is None:
-            statistics_obj = {
-                'nb_new_patient': 0,
-                'nb_urgent_return': 0,
-                'nb_non_paid': 0,
-                'nb_examination': 0
-            }
+            statistics_obj = dict((c, 0) for c in COUNTERS)
         period = self.subclass()
         end_date = timezone.make_aware(
             datetime.datetime.combine(start_date, datetime.time.max))
@@ -57,60 +123,43 @@ class Statistics(object):
         stats_obj['nb_new_patient'] = Patient.objects.filter(
             creation_date__gte=start_date,
             creation_date__lte=end_date).count()
-        stats_obj['nb_examination'] = Examination.objects.filter(
+        examinations = Examination.objects.filter(
+            **self.get_examination_scope())
+        stats_obj['nb_examination'] = examinations.filter(
             date__gte=start_date, date__lte=end_date).count()
-        stats_obj['nb_urgent_return'] = Examination.objects.filter(
+        stats_obj['nb_urgent_return'] = examinations.filter(
             date__gte=start_date, date__lte=end_date, type=3).count()
+        unpaid_invoices = self.get_unpaid_invoices().filter(
+            date__gte=start_date, date__lte=end_date)
+        stats_obj['nb_non_paid'] = unpaid_invoices.count()
+        stats_obj['amount_non_paid'] = unpaid_invoices.aggregate(
+            amount=Sum('amount'))['amount'] or 0
         return stats_obj
 
     def get_history_statistics(self):
 
         end_date = timezone.now()
-        obj_statistics = {
-            'nb_new_patient': 0,
-            'nb_urgent_return': 0,
-            'nb_non_paid': 0,
-            'nb_examination': 0
-        }
-        history_statistics = {
-            'nb_new_patient': [[], []],
-            'nb_examination': [[], []],
-            'nb_urgent_return': [[], []]
-        }
+        obj_statistics = dict((c, 0) for c in COUNTERS)
+        history_statistics = dict((c, [[], []]) for c in COUNTERS)
         period = self.subclass()
-        for i in range(1, 12):
+        for i in range(0, HISTORY_LENGTH):
             start_of_the_period = period.get_start_of_period(end_date)
             self.get_statistics(end_date, obj_statistics)
-            history_statistics['nb_new_patient'][0].append(
-                "%s - %s" % (start_of_the_period, end_date))
-            history_statistics['nb_new_patient'][1].append(
-                obj_statistics['nb_new_patient'])
-            history_statistics['nb_examination'][0].append(
-                "%s - %s" % (start_of_the_period, end_date))
-            history_statistics['nb_examination'][1].append(
-                obj_statistics['nb_examination'])
-            history_statistics['nb_urgent_return'][0].append(
-                "%s - %s" % (start_of_the_period, end_date))
-            history_statistics['nb_urgent_return'][1].append(
-                obj_statistics['nb_urgent_return'])
+            for c in COUNTERS:
+                history_statistics[c][0].append(
+                    "%s - %s" % (start_of_the_period, end_date))
+                history_statistics[c][1].append(obj_statistics[c])
             end_date = start_of_the_period - timedelta(
                 days=period.get_timedelta_of_period())
 
-        history_statistics['nb_new_patient'][0] = history_statistics[
-            'nb_new_patient'][0][::-1]
-        history_statistics['nb_new_patient'][1] = history_statistics[
-            'nb_new_patient'][1][::-1]
-        history_statistics['nb_examination'][0] = history_statistics[
-            'nb_examination'][0][::-1]
-        history_statistics['nb_examination'][1] = history_statistics[
-            'nb_examination'][1][::-1]
-        history_statistics['nb_urgent_return'][0] = history_statistics[
-            'nb_urgent_return'][0][::-1]
-        history_statistics['nb_urgent_return'][1] = history_statistics[
-            'nb_urgent_return'][1][::-1]
+        for c in COUNTERS:
+            history_statistics[c][0] = history_statistics[c][0][::-1]
+            history_statistics[c][1] = history_statistics[c][1][::-1]
         return history_statistics
 
-    def compute(self):
+    def compute(self, periods=None):
+        if periods is None:
+            periods = ['week', 'month', 'year']
         # Do some computation there
         result = {
             'week': None,
@@ -120,9 +169,10 @@ class Statistics(object):
                 'week': None,
                 'month': None,
                 'year': None
-            }
+            },
+            'receivables': self.get_receivables()
         }
-        for period in ['week', 'month', 'year']:
+        for period in periods:
             # Compute on the period
             self.define_period_subclass(period)
             result[period] = self.get_statistics()
@@ -130,6 +180,238 @@ class Statistics(object):
         return result
 
 
+class AggregatedStatistics(Statistics):
+    """
+    Same result as Statistics, but all the buckets of the three periods
+    are fetched with one grouped query per model before walking the
+    periods. The walk itself then only reads the buckets in memory.
+    """
+    truncs = dict(week=TruncWeek, month=TruncMonth, year=TruncYear)
+
+    def __init__(self, *args, **kwargs):
+        super(AggregatedStatistics, self).__init__(*args, **kwargs)
+        self.buckets = None
+
+    def compute(self, periods=None):
+        self.buckets = self.get_buckets()
+        return super(AggregatedStatistics, self).compute(periods)
+
+    def get_lower_bound(self, current_date=None):
+        """
+        Oldest start of period which is reached by the history.
+        """
+        if current_date is None:
+            current_date = timezone.now()
+        lower_bound = None
+        for period_class in self.sub_classes_period.values():
+            period = period_class()
+            end_date = current_date
+            for i in range(1, HISTORY_LENGTH):
+                end_date = period.get_start_of_period(end_date) - timedelta(
+                    days=period.get_timedelta_of_period())
+            start_date = period.get_start_of_period(end_date)
+            if lower_bound is None or start_date < lower_bound:
+                lower_bound = start_date
+        return lower_bound
+
+    def get_buckets(self):
+        now = timezone.now()
+        start_date = self.get_lower_bound(now)
+        end_date = timezone.make_aware(
+            datetime.datetime.combine(now, datetime.time.max))
+        buckets = dict((period, {}) for period in self.truncs)
+        patients = Patient.objects.filter(creation_date__gte=start_date,
+                                          creation_date__lte=end_date)
+        for row in self._group_by_periods(patients, 'creation_date',
+                                          nb_new_patient=Count('id')):
+            self._add_to_buckets(buckets, row)
+        examinations = Examination.objects.filter(
+            date__gte=start_date,
+            date__lte=end_date,
+            **self.get_examination_scope())
+        for row in self._group_by_periods(
+                examinations,
+                'date',
+                nb_examination=Count('id'),
+                nb_urgent_return=Count('id', filter=Q(type=3))):
+            self._add_to_buckets(buckets, row)
+        self._add_unpaid_invoices_to_buckets(buckets, start_date, end_date)
+        return buckets
+
+    def _add_unpaid_invoices_to_buckets(self, buckets, start_date, end_date):
+        invoices = self.get_unpaid_invoices().filter(date__gte=start_date,
+                                                     date__lte=end_date)
+        for row in self._group_by_periods(invoices,
+                                          'date',
+                                          nb_non_paid=Count('id'),
+                                          amount_non_paid=Sum('amount')):
+            self._add_to_buckets(buckets, row)
+
+    def _group_by_periods(self, queryset, field, **aggregates):
+        periods = dict(
+            (period, trunc(field, output_field=DateField()))
+            for (period, trunc) in self.truncs.items())
+        return queryset.order_by().values(**periods).annotate(**aggregates)
+
+    def _add_to_buckets(self, buckets, row):
+        for period in self.truncs:
+            bucket = buckets[period].setdefault(row[period], {})
+            for (key, value) in row.items():
+                if key not in self.truncs:
+                    bucket[key] = bucket.get(key, 0) + value
+
+    def compute_statistics(self, start_date, end_date, stats_obj):
+        if self.buckets is None:
+            return super(AggregatedStatistics,
+                         self).compute_statistics(start_date, end_date,
+                                                  stats_obj)
+        period = self.get_period_name()
+        bucket = self.buckets[period].get(
+            timezone.localtime(start_date).date(), {})
+        for key in COUNTERS:
+            stats_obj[key] = bucket.get(key, 0)
+        return stats_obj
+
+    def get_period_name(self):
+        for (name, period_class) in self.sub_classes_period.items():
+            if period_class == self.subclass:
+                return name
+
+
+class RollupStatistics(AggregatedStatistics):
+    """
+    Same result as AggregatedStatistics, but the buckets are summed from
+    the DailyOfficeStats rollup instead of counting the raw rows.
+    The unpaid counters come from the invoices.
+    """
+    counters = ['nb_new_patient', 'nb_examination', 'nb_urgent_return']
+
+    def get_buckets(self):
+        now = timezone.now()
+        start_date = self.get_lower_bound(now)
+        end_date = timezone.make_aware(
+            datetime.datetime.combine(now, datetime.time.max))
+        buckets = dict((period, {}) for period in self.truncs)
+        daily_stats = DailyOfficeStats.objects.filter(day__gte=start_date,
+                                                      day__lte=end_date)
+        for row in self._group_by_periods(daily_stats, 'day',
+                                          **self.get_aggregates()):
+            self._add_to_buckets(buckets, row)
+        self._add_unpaid_invoices_to_buckets(buckets, start_date, end_date)
+        return buckets
+
+    def get_aggregates(self):
+        scope = self.get_examination_scope()
+        aggregates = {}
+        for c in self.counters:
+            if c == 'nb_new_patient' or len(scope) == 0:
+                aggregates[c] = Sum(c)
+            else:
+                aggregates[c] = Sum(c, filter=Q(**scope))
+        return aggregates
+
+
+class DailyStatsRollup(object):
+    """
+    Maintains the DailyOfficeStats rows from the patients and the
+    examinations. A day is always recomputed as a whole. The unpaid
+    invoices are not rolled up, as they are counted from the invoices.
+    """
+
+    def rebuild(self):
+        with transaction.atomic():
+            DailyOfficeStats.objects.all().delete()
+            self._create_rows(
+                Patient.objects.filter(creation_date__isnull=False),
+                Examination.objects.all())
+
+    def refresh(self, days):
+        days = set(d for d in days if d is not None)
+        if len(days) == 0:
+            return
+        with transaction.atomic():
+            DailyOfficeStats.objects.filter(day__in=days).delete()
+            self._create_rows(
+                Patient.objects.filter(creation_date__in=days),
+                Examination.objects.filter(date__date__in=days))
+
+    def _create_rows(self, patients, examinations):
+        rows = {}
+        for p in patients.order_by().values('creation_date').annotate(
+                nb_new_patient=Count('id')):
+            key = (p['creation_date'], None, None)
+            rows.setdefault(key, {})['nb_new_patient'] = p['nb_new_patient']
+        for e in examinations.order_by().values(
+                'office', 'therapeut', day=TruncDate('date')).annotate(
+                    nb_examination=Count('id'),
+                    nb_urgent_return=Count(
+                        'id', filter=Q(type=ExaminationType.RETURN))):
+            key = (e.pop('day'), e.pop('office'), e.pop('therapeut'))
+            rows.setdefault(key, {}).update(e)
+        DailyOfficeStats.objects.bulk_create([
+            DailyOfficeStats(day=day,
+                             office_id=office,
+                             therapeut_id=therapeut,
+                             **counters)
+            for ((day, office, therapeut), counters) in rows.items()
+        ],
+                                             batch_size=500)
+
+
+class StatisticsCache(object):
+    """
+    Cache of the computed statistics per scope, period and day.
+    The whole cache is invalidated by increasing its generation.
+    """
+    prefix = 'libreosteo:statistics'
+    timeout = 24 * 3600
+    periods = [None, 'week', 'month', 'year']
+
+    def get_key(self, office, therapeut, period, day=None):
+        if day is None:
+            day = timezone.localdate()
+        return '%s:%s:%s:%s:%s' % (self.prefix, office or '*', therapeut
+                                   or '*', period or '*', day.isoformat())
+
+    def get_generation_key(self):
+        return '%s:generation' % self.prefix
+
+    def get_or_compute(self, office, therapeut, period, compute):
+        key = self.get_key(office, therapeut, period)
+        generation_key = self.get_generation_key()
+        values = cache.get_many([key, generation_key])
+        generation = values.get(generation_key, 0)
+        if key in values and values[key][0] == generation:
+            return values[key][1]
+        result = compute()
+        cache.set(key, (generation, result), self.timeout)
+        return result
+
+    def invalidate_scope(self, office=None, therapeut=None):
+        """
+        Invalidate the statistics which include an examination done by
+        the therapeut into the office.
+        """
+        cache.delete_many([
+            self.get_key(o, t, p) for o in set([None, office])
+            for t in set([None, therapeut]) for p in self.periods
+        ])
+
+    def invalidate_all(self):
+        try:
+            cache.incr(self.get_generation_key())
+        except ValueError:
+            cache.set(self.get_generation_key(), 1, None)
+
+
+def get_examination_day(examination_date):
+    if examination_date is None:
+        return None
+    if timezone.is_aware(examination_date):
+        examination_date = timezone.localtime(examination_date)
+    return examination_date.date()
+
+
 class WeekPeriod(object):
     def get_start_of_period(self, current_date=None):
         if current_date is None:
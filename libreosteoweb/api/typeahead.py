@@ -0,0 +1,190 @@
+# This file is part of LibreOsteo.
+#
+# LibreOsteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LibreOsteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
+import bisect
+import datetime
+import re
+import threading
+import unicodedata
+
+# Number of patients returned by default
+TYPEAHEAD_LIMIT = 10
+
+TYPEAHEAD_FIELDS = ('id', 'family_name', 'original_name', 'first_name',
+                    'birth_date')
+
+_separators = re.compile(r'[\W_]+')
+
+
+def fold(value):
+    """
+    Returns the lower case value without the accents.
+    """
+    value = unicodedata.normalize('NFKD', value)
+    return ''.join(c for c in value if not unicodedata.combining(c)).lower()
+
+
+def get_terms(value):
+    return [t for t in _separators.split(fold(value)) if t]
+
+
+class PatientNameIndex(object):
+    """
+    In memory prefix index of the patient names and birth dates, for the
+    typeahead. The accent folded terms are kept sorted, along with the id of
+    their patient, so that the patients of a prefix are found by bisection.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.clear()
+
+    def clear(self):
+        # Sorted terms, and the patient ids in the same order
+        self.keys = []
+        self.pks = []
+        self.records = {}
+        self.terms = {}
+
+    def load(self, patients=None):
+        """
+        Loads the index from the patients values, as given by
+        Patient.objects.values_list(*TYPEAHEAD_FIELDS).
+        """
+        if patients is None:
+            from libreosteoweb.models import Patient
+            patients = Patient.objects.values_list(*TYPEAHEAD_FIELDS)
+        # The updates wait for the end of the loading
+        with self.lock:
+            self.clear()
+            entries = []
+            for values in patients:
+                record = self.get_record(values)
+                terms = self.get_record_terms(record)
+                self.records[record['id']] = record
+                self.terms[record['id']] = terms
+                entries.extend((t, record['id']) for t in terms)
+            entries.sort()
+            self.keys = [t for (t, pk) in entries]
+            self.pks = [pk for (t, pk) in entries]
+            self.loaded = True
+
+    def reset(self):
+        """
+        Drops the index, which is loaded again on the next search.
+        """
+        with self.lock:
+            self.clear()
+            self.loaded = False
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def get_record(self, values):
+        record = dict(zip(TYPEAHEAD_FIELDS, values))
+        birth_date = record['birth_date']
+        if isinstance(birth_date, datetime.datetime):
+            birth_date = birth_date.date()
+        if isinstance(birth_date, datetime.date):
+            record['birth_date'] = birth_date.isoformat()
+        return record
+
+    def get_record_terms(self, record):
+        terms = set()
+        for field in ('family_name', 'original_name', 'first_name'):
+            terms.update(get_terms(record[field] or ''))
+        if record['birth_date']:
+            (year, month, day) = record['birth_date'].split('-')
+            terms.update([day, month, year])
+        return sorted(terms)
+
+    def update(self, values):
+        """
+        Adds or replaces the patient, given as a tuple of TYPEAHEAD_FIELDS.
+        """
+        record = self.get_record(values)
+        terms = self.get_record_terms(record)
+        with self.lock:
+            if not self.loaded:
+                return
+            pk = record['id']
+            # Only the changed terms are moved
+            previous = set(self.terms.get(pk, []))
+            for term in previous.difference(terms):
+                i = self.get_position(term, pk)
+                del self.keys[i]
+                del self.pks[i]
+            for term in set(terms).difference(previous):
+                i = self.get_position(term, pk)
+                self.keys.insert(i, term)
+                self.pks.insert(i, pk)
+            self.records[pk] = record
+            self.terms[pk] = terms
+
+    def remove(self, pk):
+        with self.lock:
+            self.records.pop(pk, None)
+            for term in self.terms.pop(pk, []):
+                i = self.get_position(term, pk)
+                del self.keys[i]
+                del self.pks[i]
+
+    def get_position(self, term, pk):
+        """
+        Returns the position of (term, pk), as the ids of a term are sorted.
+        """
+        lo = bisect.bisect_left(self.keys, term)
+        hi = bisect.bisect_right(self.keys, term, lo)
+        return bisect.bisect_left(self.pks, pk, lo, hi)
+
+    def get_range(self, word):
+        lo = bisect.bisect_left(self.keys, word)
+        return (lo, bisect.bisect_right(self.keys, word + '\U0010ffff', lo))
+
+    def search(self, query, limit=TYPEAHEAD_LIMIT):
+        """
+        Returns the patients which have a term starting with each word of
+        the query, in the order of the terms of the most selective word.
+        """
+        words = set(get_terms(query))
+        if not words or limit <= 0:
+            return []
+        self.ensure_loaded()
+        with self.lock:
+            ranges = sorted((self.get_range(w) for w in words),
+                            key=lambda r: r[1] - r[0])
+            (lo, hi) = ranges[0]
+            matching = None
+            if len(ranges) > 1:
+                # Patients matching all the words
+                matching = set(self.pks[lo:hi])
+                for (other_lo, other_hi) in ranges[1:]:
+                    matching.intersection_update(self.pks[other_lo:other_hi])
+                limit = min(limit, len(matching))
+            result = []
+            seen = set()
+            for i in range(lo, hi):
+                if len(result) >= limit:
+                    break
+                pk = self.pks[i]
+                if pk in seen or (matching is not None and pk not in matching):
+                    continue
+                seen.add(pk)
+                result.append(self.records[pk])
+        return result
+
+
+patient_name_index = PatientNameIndex()
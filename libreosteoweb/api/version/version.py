@@ -11,26 +11,77 @@
 # GNU General Public License for more details.
 #
 # You should have received a copy of the GNU General Public License
-# along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.import urllib.request
+# along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
+import urllib.request
 import json
 import logging
+import threading
+import time
 import libreosteoweb
+from django.conf import settings
 from packaging.version import parse
-import urllib
 
 logger = logging.getLogger(__name__)
 
+VERSION_URL = "https://www.libreosteo.org/api/version"
+# Timeout of the request, in seconds
+VERSION_TIMEOUT = 10
+# Default interval between two checks, in seconds
+VERSION_CHECK_INTERVAL = 24 * 3600
+
 
 def ask_for_new_version():
     try:
         logger.info("Ask for new version")
-        with urllib.request.urlopen(
-                "https://www.libreosteo.org/api/version") as f:
+        with urllib.request.urlopen(VERSION_URL,
+                                    timeout=VERSION_TIMEOUT) as f:
             contents = f.read().decode("utf-8")
             version = json.loads(contents)
             logger.info("version read = %s " % version['version'])
             if parse(version['version']) > parse(libreosteoweb.__version__):
                 return (True, version['version'])
     except Exception as ex:
-        logger.error("Cannot access to version checking", ex)
+        logger.error("Cannot access to version checking : %s", ex)
     return (False, None)
+
+
+class VersionChecker(object):
+    """
+    Last result of ask_for_new_version(), refreshed in a background thread
+    once older than settings.VERSION_CHECK_INTERVAL, so that the pages never
+    wait for the network.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.result = (False, None)
+        self.checked = None
+        self.thread = None
+
+    def get(self):
+        if not getattr(settings, 'VERSION_CHECK', True):
+            return (False, None)
+        interval = getattr(settings, 'VERSION_CHECK_INTERVAL',
+                           VERSION_CHECK_INTERVAL)
+        with self.lock:
+            if self.thread is None and (self.checked is None
+                                        or time.monotonic() - self.checked
+                                        >= interval):
+                self.thread = threading.Thread(target=self.refresh,
+                                               name='version-check',
+                                               daemon=True)
+                self.thread.start()
+            return self.result
+
+    def refresh(self):
+        result = (False, None)
+        try:
+            result = ask_for_new_version()
+        finally:
+            with self.lock:
+                self.result = result
+                self.checked = time.monotonic()
+                self.thread = None
+
+
+version_checker = VersionChecker()
@@ -29,8 +29,6 @@ from rest_framework.response import Response
 from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 
-from haystack.query import SearchQuerySet
-from haystack.views import SearchView
 from django.contrib.auth import get_user_model, REDIRECT_FIELD_NAME
 from django.contrib.auth.forms import UserCreationForm
 from django.conf import settings
@@ -39,7 +37,8 @@ from django.core.files import File
 from django.core.management import call_command
 from django.db.models import signals
 from django.http import (HttpResponse, HttpResponseForbidden,
-                         HttpResponseRedirect, Http404, HttpResponseBadRequest)
+                         HttpResponseRedirect, Http404, HttpResponseBadRequest,
+                         JsonResponse)
 from django.core.exceptions import SuspiciousOperation
 from django.shortcuts import resolve_url
 from django.utils.http import url_has_allowed_host_and_scheme
@@ -48,8 +47,8 @@ from django.utils.text import format_lazy
 from django.views import View
 from django.views.decorators.cache import never_cache
 from django.views.generic.base import TemplateView
-from django.db.models import Max
-from django.db import connection
+from django.db.models import Count, Max
+from django.db import connection, transaction
 from libreosteoweb.api import serializers as apiserializers
 from libreosteoweb import models
 from django.contrib.auth.mixins import PermissionRequiredMixin
@@ -59,11 +58,16 @@ from .permissions import (IsStaffOrTargetUser, IsStaffOrReadOnlyTargetUser,
                           maintenance_available, IsStaffOrTargetUserFactory,
                           IsDataAccessAllowed)
 from .receivers import (block_disconnect_all_signal, receiver_examination,
-                        temp_disconnect_signal, receiver_newpatient)
+                        receiver_newpatient)
 from .renderers import (ExaminationCSVRenderer, InvoiceCSVRenderer,
                         PatientCSVRenderer)
-from .statistics import Statistics
-from .file_integrator import Extractor, IntegratorHandler
+from .statistics import RollupStatistics, StatisticsCache
+from .exports import CSVStreamingMixin
+from .rebuild import start_rebuild, get_rebuild_job
+from .search import ExaminationSearch, GlobalSearch
+from .typeahead import patient_name_index, TYPEAHEAD_LIMIT
+from .file_integrator import Extractor
+from .importer import start_import, cancel_import
 from .utils import convert_to_long, LoggerWriter
 from libreosteoweb.api.invoicing import generator as invoicing_generator
 from libreosteoweb.api.events.settings import settings_event_tracer, full_db_download, full_retrieve_patient_list
@@ -153,12 +157,6 @@ class InstallView(TemplateView):
         return context
 
 
-class SearchViewHtml(SearchView):
-    template = 'partials/search-result.html'
-    results_per_page = 10
-    results = SearchQuerySet()
-
-
 class InvoiceViewHtml(TemplateView):
     template_name = settings.INVOICE_TEMPLATE
 
@@ -179,7 +177,7 @@ class InvoiceViewHtml(TemplateView):
         return context
 
 
-class PatientViewSet(viewsets.ModelViewSet):
+class PatientViewSet(CSVStreamingMixin, viewsets.ModelViewSet):
     model = models.Patient
     serializer_class = apiserializers.PatientSerializer
     queryset = models.Patient.objects.all()
@@ -201,6 +199,21 @@ class PatientViewSet(viewsets.ModelViewSet):
             apiserializers.ExaminationExtractSerializer(examinations,
                                                         many=True).data)
 
+    @action(detail=False, methods=['get'])
+    def typeahead(self, request):
+        """
+        Returns the patients whose names or birth date start with the words
+        of the query, from the in memory index.
+        """
+        try:
+            limit = min(int(request.query_params.get('limit',
+                                                     TYPEAHEAD_LIMIT)), 50)
+        except ValueError:
+            raise ParseError(detail="limit is invalid")
+        return Response(
+            patient_name_index.search(request.query_params.get('q', ''),
+                                      limit))
+
     def perform_create(self, serializer):
         instance = models.Patient(**serializer.validated_data)
         instance.set_user_operation(self.request.user)
@@ -239,13 +252,43 @@ class RegularDoctorViewSet(viewsets.ModelViewSet):
     serializer_class = apiserializers.RegularDoctorSerializer
 
 
-class ExaminationViewSet(viewsets.ModelViewSet):
+class ExaminationViewSet(CSVStreamingMixin, viewsets.ModelViewSet):
     model = models.Examination
-    queryset = models.Examination.objects.all()
+    queryset = models.Examination.objects.with_invoices()
     serializer_class = apiserializers.ExaminationSerializer
     renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [
         ExaminationCSVRenderer,
     ]
+    filter_backends = [django_filters.rest_framework.DjangoFilterBackend]
+    filterset_fields = {
+        'date': ['lte', 'gte'],
+        'office': ['exact'],
+        'therapeut': ['exact']
+    }
+
+    def is_csv_export(self):
+        return isinstance(getattr(self.request, 'accepted_renderer', None),
+                          ExaminationCSVRenderer)
+
+    def get_queryset(self):
+        if self.is_csv_export():
+            # Only the patient and the therapeut are exported
+            return models.Examination.objects.select_related(
+                'patient', 'therapeut').order_by('date')
+        return super(ExaminationViewSet, self).get_queryset()
+
+    def get_serializer_class(self):
+        if self.is_csv_export():
+            return apiserializers.ExaminationExportSerializer
+        return super(ExaminationViewSet, self).get_serializer_class()
+
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """
+        Returns the examinations matching the full text query, with the
+        facet counts on the month, the therapeut and the type.
+        """
+        return Response(ExaminationSearch(request.query_params).search())
 
     @action(detail=True, methods=['post'])
     def invoice(self, request, pk=None):
@@ -272,6 +315,7 @@ class ExaminationViewSet(viewsets.ModelViewSet):
             return Response(result)
 
     @action(detail=True, methods=['post'])
+    @transaction.atomic
     def update_paiement(self, request, pk=None):
         current_examination = self.get_object()
         serializer = apiserializers.ExaminationInvoicingSerializer(
@@ -300,7 +344,8 @@ class ExaminationViewSet(viewsets.ModelViewSet):
         p.save()
         invoice_to_update.save()
         current_examination.save()
-        return Response({'invoiced': current_examination.last_invoice.id})
+        current_examination.update_current_invoice()
+        return Response({'invoiced': current_examination.current_invoice.id})
 
     @action(detail=True, methods=['post'])
     def close(self, request, pk=None):
@@ -362,8 +407,8 @@ class ExaminationViewSet(viewsets.ModelViewSet):
     @action(detail=False, methods=['get'])
     def unpaid(self, request, pk=None):
         unpaid_examinations = models.Examination.objects.filter(
-            status=models.ExaminationStatus.WAITING_FOR_PAIEMENT).order_by(
-                '-date')
+            current_invoice_status=models.InvoiceStatus.WAITING_FOR_PAIEMENT
+        ).order_by('-date').with_invoices()
         return Response(
             apiserializers.ExaminationSerializer(unpaid_examinations,
                                                  many=True).data)
@@ -395,15 +440,56 @@ class UserOfficeViewSet(viewsets.ModelViewSet):
 
 
 class StatisticsView(APIView):
+    """
+    Statistics of the office.
+    The scope is given by the parameters :
+     - office : id of the office, or 'current' for the selected office
+     - therapeut : id of the therapeut, or 'me' for the current user
+     - period : week, month or year. All periods are computed if not set.
+    """
 
     def get(self, request, *args, **kwargs):
-        myStats = Statistics(*args, **kwargs)
-        result = myStats.compute()
+        office = self._get_scope_id('office', 'current',
+                                    lambda: request.officesettings.id)
+        therapeut = self._get_scope_id('therapeut', 'me',
+                                       lambda: request.user.id)
+        period = request.query_params.get('period', None)
+        if period is not None and period not in ['week', 'month', 'year']:
+            raise ParseError(detail="period is invalid")
+        myStats = RollupStatistics(office=office, therapeut=therapeut)
+        result = StatisticsCache().get_or_compute(
+            office, therapeut, period, lambda: myStats.compute(
+                [period] if period is not None else None))
         response = Response(result, status=status.HTTP_200_OK)
         return response
 
+    def _get_scope_id(self, parameter, current_value, get_current):
+        value = self.request.query_params.get(parameter, None)
+        if value is None or len(value) == 0:
+            return None
+        if value == current_value:
+            return get_current()
+        try:
+            return int(value)
+        except ValueError:
+            raise ParseError(detail="%s is invalid" % parameter)
+
 
-class InvoiceViewSet(viewsets.ReadOnlyModelViewSet):
+class GlobalSearchView(APIView):
+    """
+    Full text search of the patients, documents and examinations.
+    The parameters are :
+     - q : the query
+     - page, page_size : the page of results, from 1
+     - models : patient, document or examination, separated by commas
+     - sort : score, family_name or -date
+    """
+
+    def get(self, request, *args, **kwargs):
+        return Response(GlobalSearch(request.query_params).search())
+
+
+class InvoiceViewSet(CSVStreamingMixin, viewsets.ReadOnlyModelViewSet):
     model = models.Invoice
     queryset = models.Invoice.objects.all()
     serializer_class = apiserializers.InvoiceSerializer
@@ -421,8 +507,32 @@ class InvoiceViewSet(viewsets.ReadOnlyModelViewSet):
                              if 'fields' in self.request.GET else None)
         return context
 
+    def get_csv_header(self, queryset):
+        # The columns the CSVRenderer collects from the rows : those of each
+        # paiment, up to the invoice with the most paiments, and those of
+        # the canceling invoice, or a single one when not canceled
+        counts = queryset.annotate(nb_paiments=Count('paiment')).aggregate(
+            nb_invoices=Count('pk'),
+            nb_canceled=Count('canceled_by'),
+            max_paiments=Max('nb_paiments'))
+        if not counts['nb_invoices']:
+            return None
+        fields = self.get_serializer().fields
+        header = self.get_csv_columns(fields)
+        if not counts['nb_canceled']:
+            header = [c for c in header if not c.startswith('canceled_by.')]
+        if counts['nb_canceled'] < counts['nb_invoices']:
+            header.append('canceled_by')
+        paiment_columns = self.get_csv_columns(
+            fields['paiments_list'].child.fields)
+        for i in range(0, counts['max_paiments']):
+            header.extend('paiments_list.%s.%s' % (i, c)
+                          for c in paiment_columns)
+        return sorted(header)
+
     def get_queryset(self):
-        queryset = models.Invoice.objects.all()
+        queryset = models.Invoice.objects.select_related(
+            'canceled_by').prefetch_related('paiment_set')
         therapeut_id = self.request.query_params.get('therapeut_id', None)
         if therapeut_id is not None:
             queryset = queryset.filter(therapeut_id=therapeut_id)
@@ -442,10 +552,14 @@ class InvoiceViewSet(viewsets.ReadOnlyModelViewSet):
                     officesettings, None).cancel_invoice(self.get_object())
                 canceled = self.get_object()
                 canceled.status = models.InvoiceStatus.CANCELED
-                cancelation.save()
-                canceled.canceled_by = cancelation
-                canceled.save()
-                officesettings.save()
+                with transaction.atomic():
+                    cancelation.save()
+                    canceled.canceled_by = cancelation
+                    canceled.save()
+                    officesettings.save()
+                    for examination in models.Examination.objects.filter(
+                            invoices=canceled):
+                        examination.update_current_invoice()
                 response = {
                     'canceled': self.serializer_class(self.get_object()).data,
                     'credit_note': self.serializer_class(cancelation).data
@@ -485,11 +599,22 @@ class InvoiceViewSet(viewsets.ReadOnlyModelViewSet):
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
 
+class OfficeEventPagination(pagination.CursorPagination):
+    """
+    Keyset pagination on (date, id), so that the cost of a page does not
+    depend on its depth into the feed.
+    """
+    ordering = ('-date', '-id')
+    page_size = 10
+    page_size_query_param = 'limit'
+    max_page_size = 100
+
+
 class OfficeEventViewSet(viewsets.ReadOnlyModelViewSet):
     model = models.OfficeEvent
     serializer_class = apiserializers.OfficeEventSerializer
     queryset = models.OfficeEvent.objects.all()
-    pagination_class = pagination.LimitOffsetPagination
+    pagination_class = OfficeEventPagination
 
     def get_queryset(self):
         """
@@ -497,7 +622,7 @@ class OfficeEventViewSet(viewsets.ReadOnlyModelViewSet):
         No update events are given.
         'all' parameter is used to get all events
         """
-        queryset = models.OfficeEvent.objects.all().order_by('-date')
+        queryset = models.OfficeEvent.objects.select_related('user')
         all_flag = self.request.query_params.get('all', None)
         if all_flag is None:
             queryset = queryset.exclude(clazz__exact='Patient', type__exact=2)
@@ -610,50 +735,36 @@ class FileImportViewSet(viewsets.ModelViewSet):
 
     @action(detail=True, methods=['post', 'get'])
     def integrate(self, request, pk=None):
-        file_import_couple = self.get_object()
-        integrator = IntegratorHandler()
-        nb_line_patient = None
-        nb_line_examination = None
-        response = {
-            'patient': {
-                'imported': 0,
-                'errors': []
-            },
-            'examination': {
-                'imported': 0,
-                'errors': []
-            }
-        }
-        with temp_disconnect_signal(signal=signals.post_save,
-                                    receiver=receiver_newpatient,
-                                    sender=models.Patient):
-            if file_import_couple.file_patient:
-                # Start integration of each patient in the file
-                (nb_line_patient, errors_patient) = integrator.integrate(
-                    file_import_couple.file_patient)
-                response['patient'] = {
-                    'imported': nb_line_patient,
-                    'errors': errors_patient
-                }
-        with temp_disconnect_signal(signal=signals.post_save,
-                                    receiver=receiver_examination,
-                                    sender=models.Examination):
-            if file_import_couple.file_examination:
-                # Start integration of each examination in the file
-                (nb_line_examination,
-                 errors_examination) = integrator.integrate(
-                     file_import_couple.file_examination,
-                     file_additional=file_import_couple.file_patient,
-                     user=request.user)
-                response['examination'] = {
-                    'imported': nb_line_examination,
-                    'errors': errors_examination
-                }
-        integrator.post_processing(files=[
-            file_import_couple.file_patient,
-            file_import_couple.file_examination
-        ])
-        return Response(response, status=status.HTTP_200_OK)
+        """
+        Starts the integration of the files in background. The returned
+        job is polled on the import-jobs endpoint.
+        """
+        job = start_import(self.get_object(), request.user)
+        serializer = apiserializers.ImportJobSerializer(job)
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+
+
+class ImportJobViewSet(viewsets.ReadOnlyModelViewSet):
+    model = models.ImportJob
+    serializer_class = apiserializers.ImportJobSerializer
+    queryset = models.ImportJob.objects.all()
+
+    def get_queryset(self):
+        """
+        The staff follows all the imports, the other users their own ones.
+        """
+        queryset = super(ImportJobViewSet, self).get_queryset()
+        if not self.request.user.is_staff:
+            queryset = queryset.filter(user=self.request.user)
+        return queryset
+
+    @action(detail=True, methods=['post'])
+    def cancel(self, request, pk=None):
+        job = self.get_object()
+        if not job.is_finished():
+            cancel_import(job)
+        serializer = self.get_serializer(job)
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
 
 
 class DocumentViewSet(viewsets.ModelViewSet):
@@ -731,12 +842,32 @@ class DbDump(PermissionRequiredMixin, View):
 
 
 class RebuildIndex(StaffRequiredMixin, View):
+    """
+    Starts the rebuild of the index in background. The index is fully
+    rebuilt, or only for the objects updated for the last `age` hours.
+    """
 
     def get(self, request, *args, **kwargs):
-        call_command('rebuild_index',
-                     interactive=False,
-                     stdout=LoggerWriter(logger.info))
-        return HttpResponse(u'index rebuilt')
+        try:
+            age = request.GET.get('age')
+            age = int(age) if age else None
+            workers = int(request.GET.get('workers', 0))
+        except ValueError:
+            return HttpResponseBadRequest(u'invalid age or workers')
+        if (age is not None and age < 0) or workers < 0:
+            return HttpResponseBadRequest(u'invalid age or workers')
+        job = start_rebuild(age=age,
+                            workers=min(workers, os.cpu_count() or 1))
+        return JsonResponse(job.as_dict(), status=202)
+
+
+class RebuildIndexProgress(StaffRequiredMixin, View):
+
+    def get(self, request, job_id, *args, **kwargs):
+        job = get_rebuild_job(job_id)
+        if job is None:
+            raise Http404()
+        return JsonResponse(job.as_dict())
 
 
 class LoadDump(View):
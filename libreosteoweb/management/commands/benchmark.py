@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import contextlib
+import os
+import random
+import tempfile
+import timeit
+from datetime import date, timedelta
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from libreosteoweb.api.file_integrator import (FilePatientFactory,
+                                               IntegratorExamination)
+from libreosteoweb.api.filter import get_firstname_filters, get_name_filters
+from libreosteoweb.api.typeahead import PatientNameIndex
+from libreosteoweb.middleware import OneSessionPerUserMiddleware, session_keys
+from libreosteoweb.models import LoggedInUser, Patient
+
+FAMILY_NAMES = [
+    'Martin', 'Bernard', 'Dubois', 'Thomas', 'Robert', 'Richard', 'Petit',
+    'Durand', 'Leroy', 'Moreau', 'Simon', 'Laurent', 'Lefèbvre', 'Michel',
+    'Garcia', 'David', 'Bertrand', 'Roux', 'Vincent', 'Fournier', 'Morel',
+    'Girard', 'André', 'Lefèvre', 'Mercier', 'Dupont', 'Lambert', 'Bonnet',
+    'François', 'Martinez', 'Légaré', 'Chevalier', 'Bourgeois', 'Côté'
+]
+FIRST_NAMES = [
+    'Jean', 'Marie', 'Pierre', 'Hélène', 'Jean-Luc', 'Éloïse', 'Zoé',
+    'Louis', 'Léa', 'Gabriel', 'Chloé', 'Noémie', 'Raphaël', 'Inès', 'Hugo',
+    'Maëlle', 'Théo', 'Jérôme', 'Anaïs', 'Céline'
+]
+
+
+def get_patients(count, seed=0, first_pk=1):
+    """
+    Returns random patients values, as loaded by the typeahead index.
+    """
+    rand = random.Random(seed)
+    for pk in range(first_pk, first_pk + count):
+        # Suffix the names to get a realistic number of distinct terms
+        family_name = '%s%s' % (rand.choice(FAMILY_NAMES),
+                                rand.choice(['', 'eau', 'ier', 'in', 'et']))
+        yield (pk, family_name, '', rand.choice(FIRST_NAMES),
+               date(1930, 1, 1) + timedelta(days=rand.randrange(30000)))
+
+
+@contextlib.contextmanager
+def test_database():
+    """
+    Uses the test database, for the benchmarks which store their data.
+    """
+    old_name = connection.creation.create_test_db(verbosity=0,
+                                                  autoclobber=True,
+                                                  serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def benchmark_typeahead(command, patients, queries):
+    index = PatientNameIndex()
+    values = list(get_patients(patients))
+    command.report('load of %d patients' % patients,
+                   timeit.timeit(lambda: index.load(values), number=1))
+    rand = random.Random(1)
+    words = [
+        rand.choice(FAMILY_NAMES + FIRST_NAMES)[0:rand.randint(3, 5)]
+        for i in range(0, queries)
+    ]
+    command.report_timings(
+        'search of a name',
+        [timeit.timeit(lambda: index.search(w), number=1) for w in words])
+    words = [
+        '%s %s' % (rand.choice(FAMILY_NAMES)[0:3], rand.choice(FIRST_NAMES))
+        for i in range(0, queries)
+    ]
+    command.report_timings(
+        'search of a name and a first name',
+        [timeit.timeit(lambda: index.search(w), number=1) for w in words])
+    command.report_timings('update of a patient', [
+        timeit.timeit(lambda: index.update(v), number=1)
+        for v in rand.sample(values, queries)
+    ])
+    command.report_timings('new patient', [
+        timeit.timeit(lambda: index.update(v), number=1)
+        for v in get_patients(queries, seed=2, first_pk=patients + 1)
+    ])
+
+
+def benchmark_sessions(command, patients, queries):
+    """
+    Requests of some users, each one with several tabs opened on its
+    session, through the middleware closing the other sessions of a user.
+    """
+    with test_database():
+        try:
+            run_sessions(command, queries)
+        finally:
+            session_keys.clear()
+
+
+def run_sessions(command, queries):
+    users = []
+    for i in range(0, 5):
+        user = get_user_model().objects.create_user('user%d' % i)
+        session = SessionStore()
+        session.create()
+        LoggedInUser.objects.create(user=user,
+                                    session_key=session.session_key)
+        users.append((user.pk, session.session_key))
+    factory = RequestFactory()
+    middleware = OneSessionPerUserMiddleware(lambda r: HttpResponse())
+    rand = random.Random(3)
+    # The tabs of the users send their requests in turn
+    workload = [rand.choice(users) for i in range(0, queries)]
+
+    def store_every_request(request):
+        # As done before the session keys were kept
+        logged_in_user = request.user.logged_in_user
+        logged_in_user.session_key = request.session.session_key
+        logged_in_user.save()
+
+    def check_every_request(request):
+        session_keys.clear()
+        middleware(request)
+
+    for (label, call) in (('stored on every request', store_every_request),
+                          ('checked on every request', check_every_request),
+                          ('checked on change', middleware)):
+        timings = []
+        with CaptureQueriesContext(connection) as context:
+            for (pk, session_key) in workload:
+                request = factory.get('/api/patients')
+                # As loaded by the authentication middleware
+                request.user = get_user_model().objects.get(pk=pk)
+                request.session = SessionStore(session_key)
+                timings.append(
+                    timeit.timeit(lambda: call(request), number=1))
+        writes = [
+            q for q in context.captured_queries
+            if q['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))
+        ]
+        command.report_timings('%s (%d writes)' % (label, len(writes)),
+                               timings)
+
+
+class BenchmarkFile(object):
+    """
+    Imported file, as given by FileImport.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+
+def benchmark_patient_table(command, patients, queries):
+    """
+    Matching of the patients of an imported patient file with the stored
+    patients, as done to import the examinations when the patient file was
+    not integrated before (--patients 10000 for instance).
+    """
+    values = list(get_patients(patients))
+    (fd, path) = tempfile.mkstemp(suffix='.csv')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(';'.join(['Numero', 'Nom de famille'] + ['x'] * 22) + '\n')
+        for (pk, family_name, original_name, first_name,
+             birth_date) in values:
+            f.write(';'.join([
+                str(pk), family_name, original_name, first_name,
+                birth_date.strftime('%d/%m/%Y')
+            ] + [''] * 19) + '\n')
+    try:
+        with test_database():
+            # Stored as filtered by the serializer
+            (names, first_names) = (get_name_filters(),
+                                    get_firstname_filters())
+            Patient.objects.bulk_create([
+                Patient(family_name=names.filter(v[1]),
+                        first_name=first_names.filter(v[3]),
+                        birth_date=v[4]) for v in values
+            ])
+            run_patient_table(command, BenchmarkFile(path))
+    finally:
+        os.remove(path)
+
+
+def run_patient_table(command, patient_file):
+    integrator = IntegratorExamination()
+    content = integrator.extractor.get_content(patient_file)
+
+    def lookup_each_patient():
+        # As done before the single query
+        factory = FilePatientFactory()
+        for c in content['content']:
+            serializer = factory.get_serializer(c)
+            serializer.validators = []
+            serializer.is_valid()
+            Patient.objects.filter(
+                family_name=serializer.validated_data['family_name'],
+                first_name=serializer.validated_data['first_name'],
+                birth_date=serializer.validated_data['birth_date']).first()
+
+    def count_query(execute, sql, params, many, context):
+        queries.append(sql)
+        return execute(sql, params, many, context)
+
+    for (label, build) in (
+        ('one query by patient', lookup_each_patient),
+        ('one query by batch',
+         lambda: integrator._build_patient_table(patient_file)),
+    ):
+        queries = []
+        with connection.execute_wrapper(count_query):
+            elapsed = timeit.timeit(build, number=1)
+        command.report(
+            'patient table of %d patients, %s (%d queries)' %
+            (content['nb_row'] - 1, label, len(queries)), elapsed)
+    integrator.extractor.unproxy(patient_file)
+
+
+BENCHMARKS = {
+    'patient_table': benchmark_patient_table,
+    'sessions': benchmark_sessions,
+    'typeahead': benchmark_typeahead,
+}
+
+
+class Command(BaseCommand):
+    help = 'Run a micro benchmark of the application'
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()))
+        parser.add_argument('--patients',
+                            type=int,
+                            default=50000,
+                            help='Number of patients')
+        parser.add_argument('--queries',
+                            type=int,
+                            default=1000,
+                            help='Number of measures')
+
+    def handle(self, **options):
+        if options['patients'] <= 0 or options['queries'] <= 0:
+            raise CommandError('patients and queries must be positive')
+        BENCHMARKS[options['benchmark']](self, options['patients'],
+                                         options['queries'])
+
+    def report(self, label, elapsed):
+        self.stdout.write('%s: %.3f ms' % (label, elapsed * 1000))
+
+    def report_timings(self, label, timings):
+        timings = sorted(timings)
+        self.stdout.write(
+            '%s: mean %.1f us, median %.1f us, p99 %.1f us (%d runs)' %
+            (label, sum(timings) / len(timings) * 1e6,
+             timings[len(timings) // 2] * 1e6,
+             timings[int(len(timings) * 0.99)] * 1e6, len(timings)))
@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+from libreosteoweb.api.statistics import DailyStatsRollup
+from libreosteoweb import models
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the daily statistics rollup from the examinations and patients'
+
+    def handle(self, **options):
+        DailyStatsRollup().rebuild()
+        self.stdout.write(
+            self.style.SUCCESS('%d daily statistics rows rebuilt' %
+                               models.DailyOfficeStats.objects.count()))
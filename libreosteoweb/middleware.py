@@ -17,9 +17,12 @@ from django.conf import settings
 from re import compile
 from django.contrib.auth import get_user_model, logout
 from django.contrib.sessions.models import Session
+from django.db import connection
 from django.urls import reverse
 import logging
+import threading
 from django.utils.deprecation import MiddlewareMixin
+from django.utils.functional import cached_property
 from libreosteoweb.models import OfficeSettings, LoggedInUser
 from django.utils.module_loading import import_string
 
@@ -69,6 +72,81 @@ class FakeDummyAuthenticator():
         pass
 
 
+class MiddlewareCache(object):
+    """
+    Process level cache of the facts looked up by the middlewares on every
+    request, as whether a user exists or the number of offices. It is
+    cleared by the receivers once the users or the offices are changed.
+
+    As a value read into a transaction may be rolled back, the cache is
+    only used in autocommit mode, which is the case of the requests.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.generation = 0
+
+    def get(self, key, compute):
+        if connection.in_atomic_block:
+            return compute()
+        with self.lock:
+            if key in self.values:
+                return self.values[key]
+            generation = self.generation
+        value = compute()
+        with self.lock:
+            # Not kept if cleared while computed
+            if generation == self.generation:
+                self.values[key] = value
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.values = {}
+            self.generation += 1
+
+
+middleware_cache = MiddlewareCache()
+
+
+class SessionKeyMap(object):
+    """
+    Session key of the users, as last stored into LoggedInUser, so that
+    the session of a user is only checked and stored when it changes. The
+    receivers discard the user once its LoggedInUser is changed.
+
+    As MiddlewareCache, it is only used in autocommit mode.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keys = {}
+
+    def is_current(self, user_id, session_key):
+        if connection.in_atomic_block or session_key is None:
+            return False
+        with self.lock:
+            return self.keys.get(user_id) == session_key
+
+    def set(self, user_id, session_key):
+        if connection.in_atomic_block:
+            return
+        with self.lock:
+            self.keys[user_id] = session_key
+
+    def discard(self, user_id):
+        with self.lock:
+            self.keys.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.keys = {}
+
+
+session_keys = SessionKeyMap()
+
+
 class LoginRequiredMiddleware(MiddlewareMixin):
     """
     Middleware that requires a user to be authenticated to view any page other
@@ -80,6 +158,22 @@ class LoginRequiredMiddleware(MiddlewareMixin):
     loaded. You'll get an error if they aren't.
     """
 
+    @cached_property
+    def install_pattern(self):
+        return compile(initialize_admin_url().lstrip('/'))
+
+    @cached_property
+    def no_reroute(self):
+        return no_reroute_pattern()
+
+    @cached_property
+    def exempts(self):
+        return get_exempts()
+
+    @cached_property
+    def authenticator(self):
+        return get_authenticator()
+
     def process_request(self, request):
         assert hasattr(request, 'user'), "The Login Required middleware\
  requires authentication middleware to be installed. Edit your\
@@ -88,27 +182,26 @@ class LoginRequiredMiddleware(MiddlewareMixin):
  doesn't work, ensure your TEMPLATE_CONTEXT_PROCESSORS setting includes\
  'django.core.context_processors.auth'."
 
-        match_install = compile(initialize_admin_url().lstrip('/'))
-
         path = request.path.lstrip('/')
 
-        UserModel = get_user_model()
-        if any(m.match(path) for m in no_reroute_pattern()):
+        if any(m.match(path) for m in self.no_reroute):
             return
 
-        if UserModel.objects.all().count() == 0:
+        UserModel = get_user_model()
+        if not middleware_cache.get('has_users',
+                                    UserModel.objects.exists):
             logger.info("No user found")
-            if not match_install.match(request.path.lstrip('/')):
+            if not self.install_pattern.match(request.path.lstrip('/')):
                 logger.info("redirect to install page")
                 return HttpResponseRedirect(initialize_admin_url())
             else:
                 logger.info("no redirect required")
                 return
 
-        if get_authenticator():
+        if self.authenticator:
             # Try to authenticate the request
             try:
-                get_authenticator().authenticate(request)
+                self.authenticator.authenticate(request)
             except Exception as ex:
                 logger.error(
                     "Request on %s %s, but authentication failed on authenticator"
@@ -122,7 +215,7 @@ class LoginRequiredMiddleware(MiddlewareMixin):
                 request.path = ''
             if 'web-view' in path:
                 request.path = ''
-            if not any(m.match(path) for m in get_exempts()):
+            if not any(m.match(path) for m in self.exempts):
                 logger.info(
                     "query path %s, authentication required. redirect to authentication form %s "
                     % (path, get_login_url()))
@@ -152,14 +245,15 @@ class OfficeSettingsMiddleware(MiddlewareMixin):
 
         path = request.path.lstrip('/')
 
-        multiple_office = OfficeSettings.objects.all().count()
+        multiple_office = middleware_cache.get('office_count',
+                                               OfficeSettings.objects.count)
         request.has_multiple_office = multiple_office > 1
         if request.has_multiple_office:
             # Search into the session the current officesettings set
             current_officesettings = OfficeSettings.objects.filter(
                 id=request.session.get('officesettings')).first()
             if current_officesettings is None:
-                if any(m.match(path) for m in self.no_reroute_pattern()):
+                if any(m.match(path) for m in self.no_reroute):
                     return
                 # Redirect to the Office Settings form if not already
                 # redirected
@@ -169,7 +263,8 @@ class OfficeSettingsMiddleware(MiddlewareMixin):
             current_officesettings = OfficeSettings.objects.first()
         request.officesettings = current_officesettings
 
-    def no_reroute_pattern(self):
+    @cached_property
+    def no_reroute(self):
         no_reroute = []
         if hasattr(settings, 'OFFICE_SETTINGS_NO_REROUTE_PATTERN_URL'):
             no_reroute += [
@@ -187,7 +282,9 @@ class OneSessionPerUserMiddleware:
     def __call__(self, request):
         # Code to be executed for each request before
         # the view (and later middleware) are called.
-        if request.user.is_authenticated:
+        if request.user.is_authenticated and not session_keys.is_current(
+                request.user.pk, request.session.session_key):
+            # The session of the user has changed
             if not hasattr(request.user, 'logged_in_user'):
                 logout(request)
                 return HttpResponseRedirect(get_login_url())
@@ -203,8 +300,10 @@ class OneSessionPerUserMiddleware:
                 except:
                     LoggedInUser.objects.filter(user_id=request.user).delete()
 
-            request.user.logged_in_user.session_key = request.session.session_key
-            request.user.logged_in_user.save()
+            if stored_session_key != request.session.session_key:
+                request.user.logged_in_user.session_key = request.session.session_key
+                request.user.logged_in_user.save()
+            session_keys.set(request.user.pk, request.session.session_key)
 
         response = self.get_response(request)
 
@@ -0,0 +1,62 @@
+# Generated by Django 4.2.15 on 2026-10-18 08:21
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Q
+from django.db.models.functions import TruncDate
+import django.db.models.deletion
+
+
+def initialize_daily_office_stats(apps, schema_editor):
+    Patient = apps.get_model('libreosteoweb', 'Patient')
+    Examination = apps.get_model('libreosteoweb', 'Examination')
+    DailyOfficeStats = apps.get_model('libreosteoweb', 'DailyOfficeStats')
+    rows = {}
+    for p in Patient.objects.filter(creation_date__isnull=False).order_by(
+    ).values('creation_date').annotate(nb_new_patient=Count('id')):
+        key = (p['creation_date'], None, None)
+        rows.setdefault(key, {})['nb_new_patient'] = p['nb_new_patient']
+    for e in Examination.objects.order_by().values(
+            'office', 'therapeut', day=TruncDate('date')).annotate(
+                nb_examination=Count('id'),
+                nb_urgent_return=Count('id', filter=Q(type=3)),
+                nb_non_paid=Count('id', filter=Q(status=1))):
+        key = (e.pop('day'), e.pop('office'), e.pop('therapeut'))
+        rows.setdefault(key, {}).update(e)
+    DailyOfficeStats.objects.bulk_create([
+        DailyOfficeStats(day=day,
+                         office_id=office,
+                         therapeut_id=therapeut,
+                         **counters)
+        for ((day, office, therapeut), counters) in rows.items()
+    ],
+                                         batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('libreosteoweb', '0054_auto_20240426_2209'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyOfficeStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(verbose_name='Day')),
+                ('nb_new_patient', models.IntegerField(default=0, verbose_name='New patients')),
+                ('nb_examination', models.IntegerField(default=0, verbose_name='Examinations')),
+                ('nb_urgent_return', models.IntegerField(default=0, verbose_name='Urgent returns')),
+                ('nb_non_paid', models.IntegerField(default=0, verbose_name='Non paid examinations')),
+                ('office', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='libreosteoweb.officesettings', verbose_name='Office Settings')),
+                ('therapeut', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='Therapeut')),
+            ],
+            options={
+                'unique_together': {('day', 'office', 'therapeut')},
+            },
+        ),
+        migrations.RunPython(initialize_daily_office_stats,
+                             migrations.RunPython.noop),
+    ]
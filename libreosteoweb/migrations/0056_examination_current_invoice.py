@@ -0,0 +1,48 @@
+# Generated by Django 4.2.15 on 2026-10-18 08:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def initialize_current_invoice(apps, schema_editor):
+    Examination = apps.get_model('libreosteoweb', 'Examination')
+    for examination in Examination.objects.filter(
+            invoices__isnull=False).distinct().prefetch_related(
+                'invoices__canceled_by'):
+        invoices = sorted(examination.invoices.all(),
+                          key=lambda invoice: invoice.date)
+        invoices_by_id = dict((i.id, i) for i in invoices)
+        current_invoice = invoices[-1]
+        if current_invoice.canceled_by_id is not None:
+            while current_invoice.canceled_by_id is not None:
+                current_invoice = invoices_by_id.get(
+                    current_invoice.canceled_by_id,
+                    None) or current_invoice.canceled_by
+            if current_invoice.type != 'invoice':
+                current_invoice = None
+        Examination.objects.filter(pk=examination.pk).update(
+            current_invoice=current_invoice,
+            current_invoice_status=(current_invoice.status
+                                    if current_invoice is not None else None))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libreosteoweb', '0055_dailyofficestats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='examination',
+            name='current_invoice',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='libreosteoweb.invoice', verbose_name='Current invoice'),
+        ),
+        migrations.AddField(
+            model_name='examination',
+            name='current_invoice_status',
+            field=models.IntegerField(blank=True, db_index=True, null=True, verbose_name='Current invoice status'),
+        ),
+        migrations.RunPython(initialize_current_invoice,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.15 on 2026-10-18 08:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libreosteoweb', '0056_examination_current_invoice'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='officeevent',
+            index=models.Index(fields=['clazz', 'reference'], name='libreosteow_clazz_c584a1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='officeevent',
+            index=models.Index(fields=['date'], name='libreosteow_date_1d16d2_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.15 on 2026-10-18 09:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libreosteoweb', '0058_patient_update_date'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='examination',
+            name='update_date',
+            field=models.DateTimeField(auto_now=True, null=True, verbose_name='Update date'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.15 on 2026-10-18 09:44
+
+from django.conf import settings
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('libreosteoweb', '0059_examination_update_date'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed'), ('canceled', 'Canceled')], default='pending', max_length=10, verbose_name='Status')),
+                ('total', models.IntegerField(default=0, verbose_name='Lines to import')),
+                ('done', models.IntegerField(default=0, verbose_name='Processed lines')),
+                ('nb_errors', models.IntegerField(default=0, verbose_name='Errors')),
+                ('result', models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder, null=True, verbose_name='Result')),
+                ('error', models.TextField(blank=True, verbose_name='Error')),
+                ('cancel_requested', models.BooleanField(default=False, verbose_name='Cancel requested')),
+                ('creation_date', models.DateTimeField(auto_now_add=True, verbose_name='Creation date')),
+                ('start_date', models.DateTimeField(null=True, verbose_name='Start date')),
+                ('end_date', models.DateTimeField(null=True, verbose_name='End date')),
+                ('file_import', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='libreosteoweb.fileimport', verbose_name='File import')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.15 on 2026-10-18 10:14
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('libreosteoweb', '0060_importjob'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='dailyofficestats',
+            name='nb_non_paid',
+        ),
+    ]
@@ -13,7 +13,8 @@
 # You should have received a copy of the GNU General Public License
 # along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
 from django.conf import settings
-from django.db import models
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, transaction
 from django.utils.translation import gettext_lazy as _
 from datetime import date
 from django.utils import timezone
@@ -96,6 +97,9 @@ class Patient(models.Model):
                                      blank=True,
                                      null=True,
                                      editable=False)
+    update_date = models.DateTimeField(_('Update date'),
+                                       auto_now=True,
+                                       null=True)
     sex = models.CharField(_('Sex'),
                            max_length=1,
                            choices=(('M', _('Male')), ('F', _('Female'))),
@@ -148,6 +152,37 @@ class Children(models.Model):
         return "%s %s" % (self.family_name, self.first_name)
 
 
+class ExaminationQuerySet(models.QuerySet):
+
+    def with_invoices(self):
+        """
+        Prefetches the invoices, their cancelations and their paiments
+        to serialize the examinations without a query per row.
+        """
+        return self.select_related('current_invoice').prefetch_related(
+            'invoices__canceled_by__paiment_set', 'invoices__paiment_set',
+            'current_invoice__paiment_set')
+
+    def update_current_invoices(self):
+        """
+        Stores the last invoice and its status on the examinations where
+        they are outdated, as on a database restored from a backup of a
+        version without them.
+        """
+        with transaction.atomic():
+            for examination in self.with_invoices().iterator(chunk_size=500):
+                current_invoice = examination._resolve_last_invoice()
+                current_invoice_status = (current_invoice.status
+                                          if current_invoice is not None
+                                          else None)
+                if (examination.current_invoice != current_invoice
+                        or examination.current_invoice_status !=
+                        current_invoice_status):
+                    Examination.objects.filter(pk=examination.pk).update(
+                        current_invoice=current_invoice,
+                        current_invoice_status=current_invoice_status)
+
+
 class Examination(models.Model):
     """
     This class implements bean object to represent
@@ -194,6 +229,22 @@ class Examination(models.Model):
                                verbose_name=_('Office Settings'),
                                null=True,
                                on_delete=models.SET_NULL)
+    # Denormalized last invoice, see update_current_invoice()
+    current_invoice = models.ForeignKey('Invoice',
+                                        verbose_name=_('Current invoice'),
+                                        blank=True,
+                                        null=True,
+                                        related_name='+',
+                                        on_delete=models.SET_NULL)
+    current_invoice_status = models.IntegerField(_('Current invoice status'),
+                                                 blank=True,
+                                                 null=True,
+                                                 db_index=True)
+    update_date = models.DateTimeField(_('Update date'),
+                                       auto_now=True,
+                                       null=True)
+
+    objects = ExaminationQuerySet.as_manager()
 
     EXAMINATION_IN_PROGRESS = 0
     EXAMINATION_WAITING_FOR_PAIEMENT = 1
@@ -210,42 +261,86 @@ class Examination(models.Model):
         return "%s %s" % (self.patient, self.date)
 
     def get_invoice_number(self):
-        invoice = self._get_last_invoice()
+        invoice = self.last_invoice
         return invoice.number if invoice is not None else None
 
-    def _resolve_invoice(self, invoice):
-        if invoice.canceled_by is not None:
-            return self._resolve_invoice(invoice.canceled_by)
+    def _get_invoices(self):
+        # Sorted in memory to use the invoices prefetched by
+        # ExaminationQuerySet.with_invoices()
+        return sorted(self.invoices.all(), key=lambda invoice: invoice.date)
+
+    def _get_invoice_chain(self, invoice, invoices_by_id):
+        """
+        Returns the invoice followed by the invoices which cancel it.
+        The invoices of the examination are looked up first, so that
+        the chain is walked without querying the database.
+        """
+        chain = [invoice]
+        while invoice.canceled_by_id is not None:
+            invoice = invoices_by_id.get(invoice.canceled_by_id,
+                                         None) or invoice.canceled_by
+            chain.append(invoice)
+        return chain
+
+    def _resolve_invoice(self, invoice, invoices_by_id):
+        invoice = self._get_invoice_chain(invoice, invoices_by_id)[-1]
         return invoice if invoice.type == 'invoice' else None
 
     def _get_invoices_list(self):
+        invoices = self._get_invoices()
+        invoices_by_id = dict((i.id, i) for i in invoices)
         invoices_list = []
-        if self.invoices is not None and self.invoices.all().count() > 0:
-            invoices = self.invoices.all().order_by('date')
-            for invoice in invoices:
-                current_invoice = invoice
-                invoices_list.append(current_invoice)
-                while current_invoice.canceled_by is not None:
-                    current_invoice = current_invoice.canceled_by
-                    invoices_list.append(current_invoice)
-        last_invoice = self._get_last_invoice()
+        for invoice in invoices:
+            invoices_list.extend(
+                self._get_invoice_chain(invoice, invoices_by_id))
         invoices_list.reverse()
+        last_invoice = next((i for i in invoices_list
+                             if i.id == self.current_invoice_id), None)
+        if last_invoice is None:
+            # The stored invoice is missing or outdated
+            last_invoice = self._find_last_invoice(invoices, invoices_by_id)
         if last_invoice is not None:
-            invoices_list.remove(self._get_last_invoice())
+            invoices_list.remove(last_invoice)
         return invoices_list
 
     invoices_list = property(_get_invoices_list)
 
-    def _get_last_invoice(self):
-        if self.invoices.all().count() == 0:
+    def _find_last_invoice(self, invoices, invoices_by_id):
+        if len(invoices) == 0:
             return None
-        invoices = self.invoices.all().order_by('-date')
-        if invoices.first().canceled_by is not None:
-            return self._resolve_invoice(invoices.first())
-        return self.invoices.latest('date')
+        if invoices[-1].canceled_by_id is not None:
+            return self._resolve_invoice(invoices[-1], invoices_by_id)
+        return invoices[-1]
+
+    def _resolve_last_invoice(self):
+        invoices = self._get_invoices()
+        return self._find_last_invoice(invoices,
+                                       dict((i.id, i) for i in invoices))
+
+    def _get_last_invoice(self):
+        if self.current_invoice_id is not None:
+            return self.current_invoice
+        # Not stored yet, the chain of the invoices is walked
+        return self._resolve_last_invoice()
 
     last_invoice = property(_get_last_invoice)
 
+    def update_current_invoice(self):
+        """
+        Stores the last invoice and its status on the examination, so
+        that they are read with a join instead of walking the
+        cancelation chain. The invoices are read again from the
+        database, as the prefetched ones could be outdated.
+        """
+        self.current_invoice = Examination.objects.with_invoices().get(
+            pk=self.pk)._resolve_last_invoice()
+        self.current_invoice_status = (self.current_invoice.status
+                                       if self.current_invoice is not None
+                                       else None)
+        Examination.objects.filter(pk=self.pk).update(
+            current_invoice=self.current_invoice,
+            current_invoice_status=self.current_invoice_status)
+
 
 ExaminationType = enum(
     'ExaminationType',
@@ -365,7 +460,10 @@ class Invoice(models.Model):
     check_sum = models.BinaryField(_('check_sum'), max_length=256, default=b'')
 
     def _get_paiments_list(self):
-        return self.paiment_set.all().order_by('-date')
+        # Sorted in memory to use the prefetched paiments
+        return sorted(self.paiment_set.all(),
+                      key=lambda paiment: paiment.date,
+                      reverse=True)
 
     paiments_list = property(_get_paiments_list)
 
@@ -421,6 +519,12 @@ class OfficeEvent(models.Model):
         if self.date is None:
             self.date = timezone.now()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['clazz', 'reference']),
+            models.Index(fields=['date']),
+        ]
+
 
 class OfficeSettings(models.Model):
     """
@@ -577,6 +681,63 @@ class FileImport(models.Model):
             storage_examination.delete(path_examination)
 
 
+class ImportJob(models.Model):
+    """
+    Integration of a FileImport, run in background by
+    libreosteoweb.api.importer. The result gives the number of imported
+    lines and the errors of each file, as returned by IntegratorHandler.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELED = 'canceled'
+
+    file_import = models.ForeignKey(FileImport,
+                                    verbose_name=_('File import'),
+                                    null=True,
+                                    on_delete=models.SET_NULL)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             verbose_name=_('User'),
+                             null=True,
+                             on_delete=models.SET_NULL)
+    status = models.CharField(_('Status'),
+                              max_length=10,
+                              choices=((PENDING, _('Pending')),
+                                       (RUNNING, _('Running')),
+                                       (DONE, _('Done')),
+                                       (FAILED, _('Failed')),
+                                       (CANCELED, _('Canceled'))),
+                              default=PENDING)
+    total = models.IntegerField(_('Lines to import'), default=0)
+    done = models.IntegerField(_('Processed lines'), default=0)
+    nb_errors = models.IntegerField(_('Errors'), default=0)
+    result = models.JSONField(_('Result'),
+                              null=True,
+                              encoder=DjangoJSONEncoder)
+    error = models.TextField(_('Error'), blank=True)
+    cancel_requested = models.BooleanField(_('Cancel requested'),
+                                           default=False)
+    creation_date = models.DateTimeField(_('Creation date'),
+                                         auto_now_add=True)
+    start_date = models.DateTimeField(_('Start date'), null=True)
+    end_date = models.DateTimeField(_('End date'), null=True)
+
+    def is_finished(self):
+        return self.status in (ImportJob.DONE, ImportJob.FAILED,
+                               ImportJob.CANCELED)
+
+    def get_eta(self):
+        """
+        Returns the estimated remaining time in seconds, from the rate of
+        the processed lines.
+        """
+        if self.status != ImportJob.RUNNING or not self.done:
+            return None
+        elapsed = (timezone.now() - self.start_date).total_seconds()
+        return elapsed * max(self.total - self.done, 0) / self.done
+
+
 class Document(models.Model):
     """
     Implements a document to be attached to
@@ -642,6 +803,30 @@ class PatientDocument(models.Model):
         self.document.delete()
 
 
+class DailyOfficeStats(models.Model):
+    """
+    Daily rollup of the activity for a therapeut into an office.
+    It is maintained by the receivers and used to compute statistics.
+    """
+    day = models.DateField(_('Day'))
+    office = models.ForeignKey('OfficeSettings',
+                               verbose_name=_('Office Settings'),
+                               blank=True,
+                               null=True,
+                               on_delete=models.CASCADE)
+    therapeut = models.ForeignKey(settings.AUTH_USER_MODEL,
+                                  verbose_name=_('Therapeut'),
+                                  blank=True,
+                                  null=True,
+                                  on_delete=models.CASCADE)
+    nb_new_patient = models.IntegerField(_('New patients'), default=0)
+    nb_examination = models.IntegerField(_('Examinations'), default=0)
+    nb_urgent_return = models.IntegerField(_('Urgent returns'), default=0)
+
+    class Meta:
+        unique_together = ('day', 'office', 'therapeut')
+
+
 class LoggedInUser(models.Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL,
                                 on_delete=models.CASCADE,
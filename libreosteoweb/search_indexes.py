@@ -12,6 +12,7 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
+from django.utils import timezone
 from haystack import indexes
 from libreosteoweb import models
 
@@ -44,6 +45,9 @@ class PatientIndex(indexes.SearchIndex, indexes.Indexable):
     def get_model(self):
         return models.Patient
 
+    def get_updated_field(self):
+        return 'update_date'
+
     def index_queryset(self, using=None):
         """Used when the entire index for model is updated."""
         return self.get_model().objects
@@ -58,6 +62,37 @@ class DocumentIndex(indexes.SearchIndex, indexes.Indexable):
     def get_model(self):
         return models.Document
 
+    def get_updated_field(self):
+        return 'internal_date'
+
+    def index_queryset(self, using=None):
+        """Used when the entire index for model is updated."""
+        return self.get_model().objects
+
+
+class ExaminationIndex(indexes.SearchIndex, indexes.Indexable):
+    text = indexes.EdgeNgramField(document=True, use_template=True)
+    patient = indexes.IntegerField(model_attr='patient_id')
+    date = indexes.DateTimeField(model_attr='date')
+    # Year and month, as 202405
+    month = indexes.IntegerField(faceted=True)
+    therapeut = indexes.IntegerField(model_attr='therapeut_id',
+                                     null=True,
+                                     faceted=True)
+    type = indexes.IntegerField(model_attr='type', faceted=True)
+    reason = indexes.CharField(model_attr='reason')
+    diagnosis = indexes.CharField(model_attr='diagnosis')
+
+    def get_model(self):
+        return models.Examination
+
+    def get_updated_field(self):
+        return 'update_date'
+
+    def prepare_month(self, obj):
+        date = timezone.localtime(obj.date)
+        return date.year * 100 + date.month
+
     def index_queryset(self, using=None):
         """Used when the entire index for model is updated."""
         return self.get_model().objects
@@ -113,22 +113,13 @@ libreosteoApp.config(['$stateProvider', '$urlRouterProvider',
             state('search',
             {
                 url : '/search/:query',
-                templateUrl : function(params) {
-                    var url = 'web-view/partials/search-result?q='+params.query;
-                    return url ;
-                },
+                templateUrl : 'web-view/partials/search-result',
                 controller : 'SearchResultCtrl'
             }).
             state('searchPaginated',
             {
                 url : '/search/:query/:page',
-                templateUrl : function(params) {
-                    var page = '';
-                    if(params.page)
-                    {  page="&page="+params.page  }
-                    var url = 'web-view/partials/search-result?q='+params.query+page;
-                    return  url ;
-                },
+                templateUrl : 'web-view/partials/search-result',
                 controller : 'SearchResultCtrl'
             }).
             state('user-profile',
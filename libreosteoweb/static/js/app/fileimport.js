@@ -17,7 +17,7 @@
 */
 var fileimport = angular.module('loFileImport', ['ngResource','ngFileUpload']);
 
-fileimport.controller('ImportFileCtrl', ['$scope', 'Upload', '$http', '$window', function($scope, Upload, $http, $window)
+fileimport.controller('ImportFileCtrl', ['$scope', 'Upload', '$http', '$window', '$timeout', function($scope, Upload, $http, $window, $timeout)
 {
     $scope.forms = {};
     $scope.files = {};
@@ -25,6 +25,7 @@ fileimport.controller('ImportFileCtrl', ['$scope', 'Upload', '$http', '$window',
     $scope.import_result = null;
     $scope.import_error = null;
     $scope.import_fatal = null;
+    $scope.import_job = null;
     $scope.analyze = function() {
       if ($scope.forms.form.$valid && $scope.files.patientFile) {
         $scope.upload($scope.files);
@@ -58,19 +59,44 @@ fileimport.controller('ImportFileCtrl', ['$scope', 'Upload', '$http', '$window',
                 url : 'api/file-import/'+$scope.result_analyze.id+'/integrate'
             }).then( function success(response)
             {
-                if(response.data.patient != 0)
-                {
-                    $scope.import_result = response.data;
-                }
-                if(response.data.patient.errors.length != 0 || response.data.examination.errors.length != 0)
-                {
-                    $scope.import_error = response.data;
-                }
-                $('#import-result').animatescroll();
+                followJob(response.data);
             }, function error(response) {
                 $scope.import_fatal = response.data;
                 $('#import-result').animatescroll();
             });
         }
     }
+
+    $scope.cancelImport = function() {
+        $http.post('api/import-jobs/' + $scope.import_job.id + '/cancel').then(function success(response) {
+            $scope.import_job = response.data;
+        });
+    };
+
+    // The integration runs in background, its job is polled until finished
+    var followJob = function(job) {
+        $scope.import_job = job;
+        if (job.status == 'done' || job.status == 'canceled') {
+            if(job.result.patient != 0)
+            {
+                $scope.import_result = job.result;
+            }
+            if(job.result.patient.errors.length != 0 || job.result.examination.errors.length != 0)
+            {
+                $scope.import_error = job.result;
+            }
+            $('#import-result').animatescroll();
+        } else if (job.status == 'failed') {
+            $scope.import_fatal = job.error;
+            $('#import-result').animatescroll();
+        } else {
+            $timeout(function() {
+                $http.get('api/import-jobs/' + job.id).then(function success(response) {
+                    followJob(response.data);
+                }, function error(response) {
+                    $scope.import_fatal = response.data;
+                });
+            }, 1000);
+        }
+    };
 }]);
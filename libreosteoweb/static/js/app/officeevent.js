@@ -21,7 +21,7 @@ officeEvent.factory('OfficeEventServ', ['$http', '$filter', function ($http, $fi
     var OfficeEventLoader = function() {
         this.items = [];
         this.busy = false;
-        this.after = '';
+        this.next = "/api/events?limit=10";
         this.itemsByDay = [];
         this.hasFinish = false;
     };
@@ -29,13 +29,15 @@ officeEvent.factory('OfficeEventServ', ['$http', '$filter', function ($http, $fi
         if (this.busy) return;
         this.busy = true;
 
-        var url = "/api/events?limit=10&offset=" + this.after ;
-        $http.get(url).success(function(data) {
+        $http.get(this.next).success(function(data) {
             var items = data.results;
             for (var i = 0; i < items.length; i++) {
                 this.items.push(items[i]);
             }
-            this.after = "" + this.items.length;
+            this.next = data.next;
+            if (this.next == null) {
+                this.hasFinish = true;
+            }
             if (items.length == 0){
                 this.hasFinish = true;
                 this.busy = false;
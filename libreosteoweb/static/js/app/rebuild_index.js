@@ -17,17 +17,38 @@
 */
 var rebuildindex = angular.module('loRebuildIndex', ['ngResource']);
 
-rebuildindex.controller('RebuildIndexCtrl', ['$scope','$http', function($scope, $http)
+rebuildindex.controller('RebuildIndexCtrl', ['$scope','$http', '$timeout', function($scope, $http, $timeout)
 {
     $scope.failed=false;
     $scope.finished=false;
+    $scope.job=null;
+
+    var followJob = function(job) {
+      $scope.job = job;
+      if (job.status == 'done') {
+        $scope.finished = true;
+      } else if (job.status == 'failed') {
+        $scope.failed = true;
+      } else {
+        $timeout(function() {
+          $http.get('internal/rebuild_index/' + job.id).then(function success(response) {
+            followJob(response.data);
+          }, function error(response) {
+            $scope.failed = true;
+          });
+        }, 1000);
+      }
+    };
+
     $scope.rebuildindex = function() {
+      $scope.failed = false;
+      $scope.finished = false;
       $http( {
                 method: 'GET',
                 url : 'internal/rebuild_index'
             }).then( function success(response)
             {
-                $scope.finished = true;
+                followJob(response.data);
             }, function error(response) {
                 $scope.failed = true
             });
@@ -15,12 +15,23 @@
     You should have received a copy of the GNU General Public License
     along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
 */
-var search = angular.module('loSearch', []);
+var search = angular.module('loSearch', ['ngSanitize']);
 
 // Define the Controller in the index.html page
-search.controller('SearchCtrl', ['$scope', '$location', '$templateCache', '$state',  
-    function ($scope, $location, $templateCache, $state) {
+search.controller('SearchCtrl', ['$scope', '$location', '$http',
+    function ($scope, $location, $http) {
         $scope.query = '';
+        $scope.typeahead = function(query)
+        {
+            return $http.get('api/patients/typeahead', {params : {q : query}}).then(function(response) {
+                return response.data;
+            });
+        };
+        $scope.openPatient = function(patient)
+        {
+            $scope.query = '';
+            $location.path('/patient/'+patient.id);
+        };
         $scope.onEnterKeyDown = function($event)
         {
             "use strict";
@@ -31,15 +42,48 @@ search.controller('SearchCtrl', ['$scope', '$location', '$templateCache', '$stat
         }
         $scope.search = function()
         {
-            var url = $state.get('search').templateUrl({query : $scope.query});
-            $templateCache.remove(url);
             $location.path('/search/'+$scope.query);
         };
 }]);
 
 
 
-search.controller('SearchResultCtrl', function($scope, $location){
+search.controller('SearchResultCtrl', ['$scope', '$stateParams', '$http',
+    function($scope, $stateParams, $http) {
     "use strict";
+    $scope.query = $stateParams.query;
+    $scope.page = parseInt($stateParams.page) || 1;
+    $scope.models = '';
+    $scope.sort = 'score';
+    $scope.response = {};
+    $scope.loaded = false;
 
-});
+    // Only the requested page of results is returned
+    $scope.load = function()
+    {
+        $http.get('api/search', {params : {
+            q : $scope.query,
+            page : $scope.page,
+            models : $scope.models,
+            sort : $scope.sort
+        }}).then(function(response) {
+            $scope.response = response.data;
+            $scope.loaded = true;
+        });
+    };
+    $scope.setModels = function(models)
+    {
+        $scope.models = models;
+        $scope.goToPage(1);
+    };
+    $scope.goToPage = function(page)
+    {
+        $scope.page = page;
+        $scope.load();
+    };
+    $scope.hasNext = function()
+    {
+        return $scope.response.page * $scope.response.page_size < $scope.response.count;
+    };
+    $scope.load();
+}]);
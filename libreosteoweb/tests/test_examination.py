@@ -0,0 +1,125 @@
+# This file is part of LibreOsteo.
+#
+# LibreOsteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LibreOsteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
+# -*- coding: utf-8 -*-
+from django.test import TestCase
+from django.contrib.auth import get_user_model
+from libreosteoweb.models import (Patient, Examination, Invoice, Paiment,
+                                  InvoiceStatus, ExaminationStatus)
+from libreosteoweb.api.serializers import ExaminationSerializer
+from datetime import datetime, timedelta
+from django.utils import timezone
+from django.db.models import signals
+from libreosteoweb.api.receivers import (block_disconnect_all_signal,
+                                         receiver_examination,
+                                         receiver_newpatient)
+
+
+class TestExaminationInvoices(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        receivers_senders = [(receiver_examination, Examination),
+                             (receiver_newpatient, Patient)]
+        with block_disconnect_all_signal(signal=signals.post_save,
+                                         receivers_senders=receivers_senders):
+            cls.user = get_user_model().objects.create_superuser(
+                "test", "test@test.com", "testpw")
+            patient = Patient.objects.create(family_name="Picard",
+                                             first_name="Jean-Luc",
+                                             birth_date=datetime(1935, 7, 13))
+            now = timezone.now()
+            for i in range(0, 10):
+                examination = Examination.objects.create(
+                    date=now - timedelta(days=i),
+                    status=ExaminationStatus.WAITING_FOR_PAIEMENT,
+                    type=1,
+                    therapeut=cls.user,
+                    patient=patient)
+                cls.create_invoices(examination, i)
+
+    @classmethod
+    def create_invoices(cls, examination, i):
+        invoice = cls.create_invoice(examination, 'F%s' % i)
+        if i % 3 == 1:
+            # Canceled by a credit note
+            credit_note = Invoice.objects.create(
+                date=examination.date + timedelta(hours=1),
+                amount=-50,
+                number='A%s' % i,
+                type='creditnote')
+            cls.cancel(invoice, credit_note)
+        elif i % 3 == 2:
+            # Canceled twice by corrective invoices
+            corrective = cls.create_invoice(examination, 'C%s' % i, 1)
+            cls.cancel(invoice, corrective)
+            last = cls.create_invoice(examination, 'D%s' % i, 2)
+            cls.cancel(corrective, last)
+            invoice = last
+        paiment = Paiment.objects.create(amount=50,
+                                         currency='EUR',
+                                         paiment_mode='cash',
+                                         date=examination.date)
+        paiment.invoice.add(invoice)
+        examination.update_current_invoice()
+
+    @classmethod
+    def create_invoice(cls, examination, number, hours=0):
+        invoice = Invoice.objects.create(
+            date=examination.date + timedelta(hours=hours),
+            amount=50,
+            number=number,
+            status=InvoiceStatus.WAITING_FOR_PAIEMENT)
+        examination.invoices.add(invoice)
+        return invoice
+
+    @classmethod
+    def cancel(cls, invoice, cancelation):
+        invoice.status = InvoiceStatus.CANCELED
+        invoice.canceled_by = cancelation
+        invoice.save()
+
+    def get_invoices(self, examinations):
+        return [(e.get_invoice_number(),
+                 e.last_invoice.id if e.last_invoice else None,
+                 [(i.id, [p.id for p in i.paiments_list])
+                  for i in e.invoices_list]) for e in examinations]
+
+    def test_invoice_chain(self):
+        invoices = dict(
+            (number, invoices_list)
+            for (number, last_invoice,
+                 invoices_list) in self.get_invoices(Examination.objects.all()))
+        self.assertIn('F0', invoices)
+        # The credit note cancels the invoice
+        self.assertIn(None, invoices)
+        self.assertIn('D2', invoices)
+        self.assertEqual(
+            [Invoice.objects.get(id=i).number for (i, p) in invoices['D2']],
+            ['D2', 'C2', 'D2', 'C2', 'F2'])
+
+    def test_same_result_with_prefetch(self):
+        examinations = Examination.objects.order_by('date')
+        self.assertEqual(self.get_invoices(examinations),
+                         self.get_invoices(examinations.with_invoices()))
+        self.assertEqual(
+            ExaminationSerializer(examinations, many=True).data,
+            ExaminationSerializer(examinations.with_invoices(),
+                                  many=True).data)
+
+    def test_number_of_queries(self):
+        # The examinations with their current invoice, their invoices,
+        # the cancelations and the paiments of the three
+        with self.assertNumQueries(6):
+            self.get_invoices(Examination.objects.with_invoices())
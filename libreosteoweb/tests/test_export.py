@@ -0,0 +1,187 @@
+# This file is part of LibreOsteo.
+#
+# LibreOsteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LibreOsteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
+# -*- coding: utf-8 -*-
+from unittest.mock import patch
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from rest_framework_csv.renderers import CSVRenderer
+from django.contrib.auth import get_user_model
+from libreosteoweb.models import (TherapeutSettings, Patient, Examination,
+                                  Invoice, InvoiceStatus, Paiment,
+                                  OfficeSettings)
+from libreosteoweb.api.serializers import (InvoiceSerializer,
+                                           PatientSerializer,
+                                           ExaminationSerializer)
+from libreosteoweb.api.renderers import (InvoiceCSVRenderer,
+                                         PatientCSVRenderer,
+                                         ExaminationCSVRenderer)
+from datetime import datetime, timedelta
+from django.utils import timezone
+from django.db import connection
+from django.db.models import signals
+from django.test.utils import CaptureQueriesContext
+from libreosteoweb.api.receivers import (block_disconnect_all_signal,
+                                         receiver_examination,
+                                         receiver_newpatient)
+
+
+class TestCSVExport(APITestCase):
+
+    def setUp(self):
+        receivers_senders = [(receiver_examination, Examination),
+                             (receiver_newpatient, Patient)]
+        with block_disconnect_all_signal(signal=signals.post_save,
+                                         receivers_senders=receivers_senders):
+            self.user = get_user_model().objects.create_superuser(
+                "test", "test@test.com", "testpw")
+            TherapeutSettings.objects.create(user=self.user)
+            self.client.login(username='test', password='testpw')
+            session = self.client.session
+            session.update({"officesettings": 1})
+            session.save()
+            self.other = get_user_model().objects.create_user(
+                "other", "other@test.com", "otherpw")
+            self.office2 = OfficeSettings.objects.create(
+                office_identifier="98765", currency='EUR')
+            for i in range(0, 5):
+                patient = Patient.objects.create(
+                    family_name="Picard%s" % i,
+                    first_name="Jean-Luc",
+                    birth_date=datetime(1935, 7, 13))
+                Examination.objects.create(
+                    date=timezone.now() - timedelta(days=i),
+                    reason="Reason %s" % i,
+                    status=0,
+                    type=1,
+                    therapeut=self.user if i % 2 == 0 else self.other,
+                    office_id=1 if i < 3 else self.office2.id,
+                    patient=patient)
+                invoice = Invoice.objects.create(
+                    date=timezone.now() - timedelta(days=i),
+                    amount=50 + i,
+                    number=u'W%s' % i,
+                    paiment_mode='cash',
+                    status=InvoiceStatus.INVOICED_PAID)
+                if i % 2 == 0:
+                    paiment = Paiment.objects.create(amount=50 + i,
+                                                     currency='EUR',
+                                                     paiment_mode='cash',
+                                                     date=timezone.now())
+                    paiment.invoice.add(invoice)
+
+    def get_csv(self, url, params=None):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        return b''.join(response.streaming_content)
+
+    def get_invoices_csv(self):
+        # As rendered before the streaming, with the columns of all the rows
+        return CSVRenderer().render(
+            InvoiceSerializer(Invoice.objects.all(), many=True).data,
+            renderer_context={
+                'header': None,
+                'labels': InvoiceCSVRenderer.labels
+            })
+
+    def test_invoices(self):
+        invoice = Invoice.objects.get(number='W0')
+        paiment = Paiment.objects.create(amount=10,
+                                         currency='EUR',
+                                         paiment_mode='check',
+                                         date=timezone.now())
+        paiment.invoice.add(invoice)
+        invoice = Invoice.objects.get(number='W1')
+        invoice.status = InvoiceStatus.CANCELED
+        invoice.canceled_by = Invoice.objects.create(date=timezone.now(),
+                                                     amount=-51,
+                                                     number=u'W5',
+                                                     paiment_mode='cash')
+        invoice.save()
+        expected = self.get_invoices_csv()
+        header = expected.decode('utf-8').splitlines()[0]
+        self.assertIn('paiments_list.1.amount', header)
+        self.assertIn('canceled_by.number', header)
+        # The label of the canceled_by column, empty when not canceled
+        self.assertIn('Annulée par', header)
+        with patch.object(InvoiceSerializer,
+                          'to_representation',
+                          autospec=True,
+                          side_effect=InvoiceSerializer.to_representation
+                          ) as to_representation:
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.get_csv('/api/invoices.csv'), expected)
+        # The rows are serialized once
+        self.assertEqual(to_representation.call_count,
+                         Invoice.objects.count())
+        # The header is sized by a single query
+        self.assertEqual(
+            len([q for q in queries.captured_queries if 'MAX(' in q['sql']]),
+            1)
+
+    def test_invoices_without_paiment(self):
+        Paiment.objects.all().delete()
+        expected = self.get_invoices_csv()
+        self.assertNotIn(b'paiments_list', expected)
+        self.assertNotIn(b'canceled_by.number', expected)
+        self.assertEqual(self.get_csv('/api/invoices.csv'), expected)
+        Invoice.objects.all().delete()
+        self.assertEqual(self.get_csv('/api/invoices.csv'), b'')
+
+    def test_invoices_fields(self):
+        content = self.get_csv(
+            '/api/invoices.csv', {
+                'fields': 'number,amount',
+                'date__gte': (timezone.now() - timedelta(days=1, hours=1))
+            })
+        self.assertEqual(content.decode('utf-8').splitlines(),
+                         ['Numéro,montant', 'W0,50.0', 'W1,51.0'])
+
+    def test_patients(self):
+        expected = PatientCSVRenderer().render(
+            PatientSerializer(Patient.objects.all(), many=True).data)
+        self.assertEqual(self.get_csv('/api/patients.csv'), expected)
+
+    def test_examinations(self):
+        expected = ExaminationCSVRenderer().render(
+            ExaminationSerializer(Examination.objects.order_by('date'),
+                                  many=True).data)
+        with CaptureQueriesContext(connection) as all_examinations:
+            content = self.get_csv('/api/examinations.csv')
+        self.assertEqual(content, expected)
+        # The patient and the therapeut are selected with the examinations
+        with CaptureQueriesContext(connection) as last_examination:
+            self.get_csv('/api/examinations.csv',
+                         {'date__gte': timezone.now() - timedelta(hours=1)})
+        self.assertEqual(len(all_examinations.captured_queries),
+                         len(last_examination.captured_queries))
+
+    def test_examinations_filters(self):
+        for (params, reasons) in [({
+                'date__gte': timezone.now() - timedelta(days=1, hours=1)
+        }, ['Reason 1', 'Reason 0']), ({
+                'office': self.office2.id
+        }, ['Reason 4', 'Reason 3']), ({
+                'therapeut': self.other.id,
+                'office': 1
+        }, ['Reason 1'])]:
+            lines = self.get_csv('/api/examinations.csv',
+                                 params).decode('utf-8').splitlines()
+            self.assertEqual([l.split(',')[4] for l in lines[1:]], reasons)
+        response = self.client.get('/api/examinations.csv',
+                                   {'therapeut': 'nobody'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
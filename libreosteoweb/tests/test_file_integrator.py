@@ -13,8 +13,20 @@
 # You should have received a copy of the GNU General Public License
 # along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
 # -*- coding: utf-8 -*-
+import os
+import tempfile
+from datetime import date
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.db.models import signals
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from haystack.query import SearchQuerySet
 from libreosteoweb.api import file_integrator
+from libreosteoweb.api.receivers import (block_disconnect_all_signal,
+                                         receiver_newpatient)
+from libreosteoweb.models import Examination, FileImport, Patient
+from libreosteoweb.tests.test_indexing import IndexTestMixin
 try:
     from unittest.mock import mock_open
     from unittest.mock import patch
@@ -116,7 +128,241 @@ class TestFileIntegrator(TestCase):
             self.assertEquals(1, result['nb_row'])
             self.assertEquals(['Nom', 'Prenom', 'Nom de Famille'],
                               result['header'])
-            self.assertEquals([], result['content'])
+            self.assertEquals([], list(result['content']))
 
     def tearDown(self):
-        pass
+        self.patcher.stop()
+
+
+class TestFileContentCache(TestCase):
+
+    def get_content(self, name, size=100):
+        return MagicMock(file=name, get_size=MagicMock(return_value=size))
+
+    def test_lru(self):
+        cache = file_integrator.FileContentCache(max_size=250)
+        a = cache.get('a', lambda: self.get_content('a'))
+        self.assertIs(cache.get('a', lambda: self.get_content('a')), a)
+        cache.get('b', lambda: self.get_content('b'))
+        cache.get('a', lambda: self.get_content('a'))
+        # The least recently used content is removed
+        cache.get('c', lambda: self.get_content('c'))
+        self.assertEqual(list(cache.entries.keys()), ['a', 'c'])
+        self.assertEqual(cache.get_stats(), {
+            'entries': 2,
+            'size': 200,
+            'hits': 2,
+            'misses': 3
+        })
+        # Too large to be kept
+        cache.get('d', lambda: self.get_content('d', size=300))
+        self.assertEqual(list(cache.entries.keys()), ['a', 'c'])
+
+    def test_ttl(self):
+        cache = file_integrator.FileContentCache(ttl=60)
+        a = cache.get('a', lambda: self.get_content('a'))
+        now = file_integrator.time.monotonic()
+        with patch('libreosteoweb.api.file_integrator.time.monotonic',
+                   return_value=now + 61):
+            self.assertIsNot(cache.get('a', lambda: self.get_content('a')),
+                             a)
+            self.assertEqual(cache.misses, 2)
+
+    def test_evict(self):
+        cache = file_integrator.FileContentCache()
+        cache.get(file_integrator.FileContentKey('a', None),
+                  lambda: self.get_content('a'))
+        cache.get(file_integrator.FileContentKey('a', file_integrator.filter),
+                  lambda: self.get_content('a'))
+        cache.get(file_integrator.FileContentKey('b', None),
+                  lambda: self.get_content('b'))
+        cache.evict('a')
+        self.assertEqual([k.file for k in cache.entries], ['b'])
+        self.assertEqual(cache.size, 100)
+
+    def test_file_import_delete(self):
+        file_import = FileImport.objects.create(
+            file_patient='tmp/patients.csv',
+            file_examination='tmp/examinations.csv')
+        key = file_integrator.FileContentKey(file_import.file_patient,
+                                             file_integrator.filter)
+        file_integrator.file_content_cache.get(
+            key, lambda: self.get_content('a'))
+        file_import.delete()
+        self.assertNotIn(key, file_integrator.file_content_cache.entries)
+
+
+class FileMixin(object):
+
+    def write_file(self, content, encoding='utf-8'):
+        f = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+        f.write(content.encode(encoding))
+        f.close()
+        self.addCleanup(os.remove, f.name)
+        return MagicMock(path=f.name)
+
+
+class TestFileContentAdapter(FileMixin, TestCase):
+
+    def test_rows(self):
+        for encoding in ('utf-8', 'iso-8859-1'):
+            f = self.write_file(
+                u'Nom;Prénom;Ville\r\nCôté;"Hélène\r\nMarie";Paris\r\n'
+                u'Roux;Zoé;Lyon\r\n', encoding)
+            adapter = file_integrator.FileContentAdapter(
+                f, line_filter=file_integrator.filter)
+            result = adapter.get_content()
+            self.assertEquals(3, result['nb_row'])
+            self.assertEquals(['Nom', 'Prénom', 'Ville'], result['header'])
+            rows = [[u'Côté', u'Hélène\r\nMarie', u'Paris'],
+                    [u'Roux', u'Zoé', u'Lyon']]
+            self.assertEquals(rows, list(result['content']))
+            # The file is read again
+            self.assertEquals(rows, list(result['content']))
+
+    @patch('libreosteoweb.api.file_integrator._CSV_SNIFF_SIZE', 16)
+    def test_sniff_sample(self):
+        f = self.write_file(
+            u'Nom,Prénom\n' + u''.join(u'Roux%d,Zoé\n' % i
+                                       for i in range(0, 1000)), 'utf-8')
+        result = file_integrator.FileContentAdapter(f).get_content()
+        self.assertEquals(1001, result['nb_row'])
+        rows = iter(result['content'])
+        self.assertEquals([u'Roux0', u'Zoé'], next(rows))
+        rows.close()
+
+
+PATIENT_HEADER = [
+    'Numero', 'Nom de famille', 'Nom de jeune fille', 'Prenom',
+    'Date de naissance', 'Sexe', 'Rue', 'Complement', 'Code postal', 'Ville',
+    'Email', 'Telephone', 'Mobile', 'Profession', 'Loisirs', 'Fumeur',
+    'Lateralite', 'Informations importantes', 'Traitement en cours',
+    'Antecedents chirurgicaux', 'Antecedents medicaux',
+    'Antecedents familiaux', 'Antecedents traumatiques', 'CR medicaux'
+]
+EXAMINATION_HEADER = [
+    'Numero', 'Date', 'Motif', 'Description', 'ORL', 'Visceral', 'Pulmo',
+    'Uro-gyneco', 'Peripherie', 'Etat general', 'Examen medical',
+    'Diagnostic', 'Traitements', 'Conclusion'
+]
+
+
+@patch('libreosteoweb.api.file_integrator.AbstractIntegrator.batch_size', 2)
+class TestIntegrator(FileMixin, IndexTestMixin, TestCase):
+
+    def setUp(self):
+        super(TestIntegrator, self).setUp()
+        self.user = get_user_model().objects.create_user('test')
+        with block_disconnect_all_signal(
+                signal=signals.post_save,
+                receivers_senders=[(receiver_newpatient, Patient)]):
+            Patient.objects.create(family_name="Kirk",
+                                   first_name="James",
+                                   birth_date=date(1933, 3, 22))
+
+    def write_csv(self, header, rows):
+        return self.write_file(u''.join(u';'.join(r) + u'\r\n'
+                                        for r in [header] + rows))
+
+    def get_patient(self, number, family_name, first_name, birth_date):
+        return [number, family_name, '', first_name, birth_date, 'F'
+                ] + [''] * 9 + ['N', 'D'] + [''] * 7
+
+    def get_examination(self, number, day, reason):
+        return [number, day, reason] + [''] * 11
+
+    def test_integrate(self):
+        patients = self.write_csv(PATIENT_HEADER, [
+            self.get_patient('1', 'Picard', 'Jean-Luc', '13/07/1935'),
+            self.get_patient('2', 'Crusher', 'Beverly', '13/13/1935'),
+            self.get_patient('3', 'KIRK', 'James', '22/03/1933'),
+            self.get_patient('4', 'Troi', 'Deanna', '29/03/1950'),
+            self.get_patient('5', 'Picard', 'Jean-luc', '13/07/1935'),
+        ])
+        examinations = self.write_csv(EXAMINATION_HEADER, [
+            self.get_examination('1', '02/05/2024', 'Lombalgie'),
+            self.get_examination('4', '03/05/2024', 'Cervicalgie'),
+            self.get_examination('4', '32/05/2024', 'Entorse'),
+            self.get_examination('3', '04/05/2024', 'Dorsalgie'),
+            self.get_examination('2', '05/05/2024', 'Migraine'),
+        ])
+        handler = file_integrator.IntegratorHandler()
+        with self.captureOnCommitCallbacks(execute=True):
+            (nb_line, errors) = handler.integrate(patients)
+        self.assertEqual(nb_line, 2)
+        # The lines of the file are given, with the header as first line
+        self.assertEqual([line for (line, e) in errors], [3, 4, 6])
+        self.assertIn('13/13/1935', errors[0][1][0])
+        self.assertEqual(
+            sorted(Patient.objects.values_list('family_name', flat=True)),
+            ['Kirk', 'Picard', 'Troi'])
+        with self.captureOnCommitCallbacks(execute=True):
+            (nb_line, errors) = handler.integrate(examinations,
+                                                  file_additional=patients,
+                                                  user=self.user)
+        self.assertEqual(nb_line, 3)
+        self.assertEqual([line for (line, e) in errors], [4, 6])
+        self.assertEqual(
+            Examination.objects.get(reason='Cervicalgie').patient.family_name,
+            'Troi')
+        # The patient was already stored
+        self.assertEqual(
+            Examination.objects.get(reason='Dorsalgie').patient.family_name,
+            'Kirk')
+        # Indexed once integrated
+        self.assertEqual(
+            SearchQuerySet().models(Patient).filter(content='Picard').count(),
+            1)
+        self.assertEqual(
+            SearchQuerySet().models(Examination).filter(
+                content='Lombalgie').count(), 1)
+
+    def test_integrate_without_returning(self):
+        # As on SQLite before 3.35, the keys are not returned by the inserts
+        with patch.object(type(connection.features),
+                          'can_return_rows_from_bulk_insert', False):
+            self.test_integrate()
+
+    def test_patient_table(self):
+        patients = self.write_csv(PATIENT_HEADER, [
+            self.get_patient('1', 'Picard', 'Jean-Luc', '13/07/1935'),
+            self.get_patient('2', 'Kirk', 'James', '22/03/1933'),
+            self.get_patient('3', 'Troi', 'Deanna', '29/03/1950'),
+        ])
+        examinations = self.write_csv(EXAMINATION_HEADER, [
+            self.get_examination('1', '02/05/2024', 'Lombalgie'),
+            self.get_examination('2', '03/05/2024', 'Cervicalgie'),
+            self.get_examination('3', '04/05/2024', 'Dorsalgie'),
+        ])
+        with self.captureOnCommitCallbacks(execute=True):
+            file_integrator.IntegratorHandler().integrate(patients)
+        # The patient file was integrated by another handler
+        with self.captureOnCommitCallbacks(execute=True):
+            with CaptureQueriesContext(connection) as context:
+                (nb_line, errors) = file_integrator.IntegratorHandler(
+                ).integrate(examinations,
+                            file_additional=patients,
+                            user=self.user)
+        self.assertEqual((nb_line, errors), (3, []))
+        # The patients are not looked up one by one
+        self.assertFalse(
+            any('"libreosteoweb_patient"."family_name" =' in q['sql']
+                for q in context.captured_queries))
+        # Only the patients born on the days of a batch are read
+        lookups = [
+            q['sql'] for q in context.captured_queries
+            if q['sql'].startswith(
+                'SELECT "libreosteoweb_patient"."id", '
+                '"libreosteoweb_patient"."family_name", '
+                '"libreosteoweb_patient"."first_name", '
+                '"libreosteoweb_patient"."birth_date" FROM')
+        ]
+        self.assertEqual(len(lookups), 2)
+        self.assertTrue(
+            all('"libreosteoweb_patient"."birth_date" IN' in q
+                for q in lookups))
+        self.assertEqual(
+            sorted(
+                Examination.objects.values_list('patient__family_name',
+                                                flat=True)),
+            ['Kirk', 'Picard', 'Troi'])
@@ -0,0 +1,191 @@
+# This file is part of LibreOsteo.
+#
+# LibreOsteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LibreOsteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import shutil
+import tempfile
+import time
+from unittest.mock import Mock, patch
+from django.contrib.auth import get_user_model
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from libreosteoweb.api.importer import ImportJobRunner
+from libreosteoweb.models import Examination, FileImport, ImportJob, Patient
+from libreosteoweb.tests.test_file_integrator import (EXAMINATION_HEADER,
+                                                      PATIENT_HEADER)
+
+
+class ImportMixin(object):
+
+    def setUp(self):
+        super(ImportMixin, self).setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = get_user_model().objects.create_superuser(
+            "test", "test@test.com", "testpw")
+        self.client.login(username='test', password='testpw')
+        self.write_csv('patients.csv', PATIENT_HEADER, [
+            self.get_patient('1', 'Picard', 'Jean-Luc', '13/07/1935'),
+            self.get_patient('2', 'Kirk', 'James', '22/03/1933'),
+            self.get_patient('3', 'Troi', 'Deanna', '29/03/1950'),
+        ])
+        self.write_csv('examinations.csv', EXAMINATION_HEADER, [
+            self.get_examination('1', '02/05/2024', 'Lombalgie'),
+            self.get_examination('3', '32/05/2024', 'Entorse'),
+        ])
+        self.file_import = FileImport.objects.create(
+            file_patient='patients.csv', file_examination='examinations.csv')
+
+    def write_csv(self, name, header, rows):
+        with open(os.path.join(self.media_root, name), 'w',
+                  encoding='utf-8') as f:
+            f.write(u''.join(u';'.join(r) + u'\r\n' for r in [header] + rows))
+
+    def get_patient(self, number, family_name, first_name, birth_date):
+        return [number, family_name, '', first_name, birth_date, 'F'
+                ] + [''] * 9 + ['N', 'D'] + [''] * 7
+
+    def get_examination(self, number, day, reason):
+        return [number, day, reason] + [''] * 11
+
+    def integrate(self):
+        response = self.client.post(
+            reverse('fileimport-integrate', args=[self.file_import.pk]))
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        return response.data
+
+    def get_job(self, job_id):
+        response = self.client.get(reverse('importjob-detail', args=[job_id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+
+@patch('libreosteoweb.api.file_integrator.AbstractIntegrator.batch_size', 2)
+class TestImportJob(ImportMixin, TestCase):
+
+    def setUp(self):
+        super(TestImportJob, self).setUp()
+        # The jobs are run by the test
+        self.runner = ImportJobRunner()
+        self.runner.start_worker = Mock()
+        patcher = patch('libreosteoweb.api.importer.import_runner',
+                        self.runner)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_jobs(self):
+        while self.runner.pending:
+            self.runner.run_job(self.runner.pending.popleft())
+
+    def test_integrate(self):
+        job = self.integrate()
+        self.assertEqual(job['status'], ImportJob.PENDING)
+        self.assertEqual(list(self.runner.pending), [job['id']])
+        self.run_jobs()
+        job = self.get_job(job['id'])
+        self.assertEqual(job['status'], ImportJob.DONE)
+        self.assertEqual((job['total'], job['done'], job['nb_errors']),
+                         (5, 5, 1))
+        self.assertIsNone(job['eta'])
+        self.assertEqual(job['result']['patient'], {
+            'imported': 3,
+            'errors': []
+        })
+        self.assertEqual(job['result']['examination']['imported'], 1)
+        self.assertEqual(
+            [line for (line, e) in job['result']['examination']['errors']],
+            [3])
+        self.assertEqual(
+            Examination.objects.get(reason='Lombalgie').therapeut, self.user)
+        # Finished jobs are not canceled
+        response = self.client.post(
+            reverse('importjob-cancel', args=[job['id']]))
+        self.assertFalse(response.data['cancel_requested'])
+
+    def test_cancel_pending(self):
+        job = self.integrate()
+        response = self.client.post(
+            reverse('importjob-cancel', args=[job['id']]))
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['status'], ImportJob.CANCELED)
+        self.run_jobs()
+        self.assertEqual(self.get_job(job['id'])['status'],
+                         ImportJob.CANCELED)
+        self.assertFalse(Patient.objects.exists())
+
+    def test_cancel_running(self):
+        job = self.integrate()
+        # Stopped once the first batch is integrated
+        self.runner.stopping = True
+        self.run_jobs()
+        job = self.get_job(job['id'])
+        self.assertEqual(job['status'], ImportJob.CANCELED)
+        self.assertEqual((job['total'], job['done']), (5, 2))
+        self.assertEqual(Patient.objects.count(), 2)
+        # The batches already integrated are counted
+        self.assertEqual(job['result']['patient'], {
+            'imported': 2,
+            'errors': []
+        })
+
+    def test_other_user(self):
+        job = self.integrate()
+        get_user_model().objects.create_user("other", "other@test.com",
+                                             "otherpw")
+        self.client.login(username='other', password='otherpw')
+        response = self.client.get(reverse('importjob-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, [])
+        response = self.client.post(
+            reverse('importjob-cancel', args=[job['id']]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(ImportJob.objects.get(pk=job['id']).cancel_requested)
+
+    def test_recover(self):
+        running = ImportJob.objects.create(file_import=self.file_import,
+                                           status=ImportJob.RUNNING)
+        pending = ImportJob.objects.create(file_import=self.file_import)
+        self.runner.recover()
+        running.refresh_from_db()
+        self.assertEqual(running.status, ImportJob.FAILED)
+        self.assertEqual(list(self.runner.pending), [pending.pk])
+        self.file_import.delete()
+        self.run_jobs()
+        pending.refresh_from_db()
+        self.assertEqual(pending.status, ImportJob.FAILED)
+
+
+class TestImportJobRunner(ImportMixin, TransactionTestCase):
+    # The jobs are read from the connection of the worker
+    serialized_rollback = True
+
+    def test_worker(self):
+        runner = ImportJobRunner()
+        with patch('libreosteoweb.api.importer.import_runner', runner):
+            job = self.integrate()
+            self.assertTrue(runner.is_running())
+            for i in range(0, 100):
+                job = self.get_job(job['id'])
+                if job['status'] not in (ImportJob.PENDING,
+                                         ImportJob.RUNNING):
+                    break
+                time.sleep(0.1)
+            runner.stop_worker()
+        self.assertEqual(job['status'], ImportJob.DONE)
+        self.assertFalse(runner.is_running())
+        self.assertEqual(Patient.objects.count(), 3)
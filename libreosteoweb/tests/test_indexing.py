@@ -0,0 +1,199 @@
+# This file is part of LibreOsteo.
+#
+# LibreOsteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LibreOsteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
+# -*- coding: utf-8 -*-
+from django.test import TestCase, TransactionTestCase
+from django.contrib.auth import get_user_model
+from django.urls import reverse
+from haystack import connections
+from haystack.query import SearchQuerySet
+from libreosteoweb.models import Patient
+from libreosteoweb.api.indexing import index_queue, flush_index_queue
+from libreosteoweb.api.rebuild import RebuildJob, get_chunks
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from unittest import mock
+from django.utils import timezone
+from django.db import transaction
+from django.db.models import signals
+from libreosteoweb.api.receivers import (block_disconnect_all_signal,
+                                         receiver_newpatient)
+import shutil
+import tempfile
+
+
+class IndexTestMixin(object):
+
+    def setUp(self):
+        # Index into a temporary folder
+        self.connection_info = connections.connections_info['default']
+        self.index_path = self.connection_info['PATH']
+        self.connection_info['PATH'] = tempfile.mkdtemp()
+        connections.reload('default')
+        self.delay = index_queue.delay
+
+    def tearDown(self):
+        index_queue.stop_worker()
+        index_queue.delay = self.delay
+        shutil.rmtree(self.connection_info['PATH'])
+        self.connection_info['PATH'] = self.index_path
+        connections.reload('default')
+
+    def create_patient(self, first_name="Jean-Luc"):
+        with block_disconnect_all_signal(
+                signal=signals.post_save,
+                receivers_senders=[(receiver_newpatient, Patient)]):
+            with self.committed():
+                return Patient.objects.create(family_name="Picard",
+                                              first_name=first_name,
+                                              birth_date=datetime(
+                                                  1935, 7, 13))
+
+    def search(self):
+        return SearchQuerySet().models(Patient).filter(
+            content='Picard').count()
+
+    def clear_index(self):
+        connections['default'].get_backend().clear()
+
+
+class TestQueuedIndexing(IndexTestMixin, TestCase):
+
+    def committed(self):
+        return self.captureOnCommitCallbacks(execute=True)
+
+    def test_index_at_once_without_indexer(self):
+        self.create_patient()
+        self.assertEqual(self.search(), 1)
+
+    def test_indexer(self):
+        index_queue.delay = 60
+        index_queue.start_worker()
+        patient = self.create_patient()
+        self.assertEqual(self.search(), 0)
+        flush_index_queue()
+        self.assertEqual(self.search(), 1)
+        with self.committed():
+            patient.delete()
+        self.assertEqual(self.search(), 1)
+        flush_index_queue()
+        self.assertEqual(self.search(), 0)
+
+    def test_hold(self):
+        index_queue.hold()
+        self.create_patient()
+        self.assertEqual(self.search(), 0)
+        index_queue.release()
+        self.assertEqual(self.search(), 1)
+
+
+class TestIndexerThread(IndexTestMixin, TransactionTestCase):
+    # The indexer reads the committed changes from its own connection
+    serialized_rollback = True
+
+    def committed(self):
+        return transaction.atomic()
+
+    def test_indexer_thread(self):
+        index_queue.delay = 0
+        index_queue.start_worker()
+        self.create_patient()
+        # The indexer applies the pending changes when it is stopped
+        index_queue.stop_worker()
+        self.assertEqual(self.search(), 1)
+
+
+class TestRebuildIndex(IndexTestMixin, TransactionTestCase):
+    serialized_rollback = True
+
+    def committed(self):
+        return transaction.atomic()
+
+    def run_job(self, **kwargs):
+        job = RebuildJob(**kwargs)
+        job.get_executor = lambda: ThreadPoolExecutor(job.workers)
+        job.start()
+        job.thread.join()
+        self.assertEqual(job.status, 'done')
+        return job
+
+    def test_chunks(self):
+        self.assertEqual(get_chunks([1, 2, 5, 8, 9], 2), [(1, 2), (5, 8),
+                                                         (9, 9)])
+        self.assertEqual(get_chunks([], 2), [])
+
+    @mock.patch('libreosteoweb.api.rebuild.REBUILD_BATCH_SIZE', 2)
+    def test_rebuild(self):
+        for first_name in ["Jean-Luc", "Yvette", "Maurice"]:
+            self.create_patient(first_name)
+        deleted = self.create_patient("Robert")
+        # Left in the index, as the changes are held
+        index_queue.hold()
+        with self.committed():
+            deleted.delete()
+        self.assertEqual(self.search(), 4)
+        job = self.run_job(workers=2)
+        self.assertEqual((job.total, job.done), (3, 3))
+        self.assertEqual(self.search(), 3)
+        index_queue.release()
+        # The held changes are applied to the new index
+        index_queue.hold()
+        self.create_patient("Robert")
+        job = self.run_job()
+        self.assertEqual(job.total, 4)
+        index_queue.release()
+        self.assertEqual(self.search(), 4)
+
+    def test_incremental(self):
+        old = self.create_patient("Jean-Luc")
+        Patient.objects.filter(pk=old.pk).update(update_date=timezone.now() -
+                                                 timedelta(days=2))
+        self.create_patient("Yvette")
+        self.clear_index()
+        job = self.run_job(age=24)
+        self.assertEqual(job.as_dict()['mode'], 'incremental')
+        self.assertEqual((job.total, job.done), (1, 1))
+        self.assertEqual([
+            r.first_name for r in SearchQuerySet().models(Patient).filter(
+                content='Picard')
+        ], ["Yvette"])
+
+    def test_views(self):
+        get_user_model().objects.create_superuser("test", "test@test.com",
+                                                  "testpw")
+        self.client.login(username='test', password='testpw')
+        self.create_patient()
+        self.clear_index()
+        response = self.client.get(reverse('rebuild_index'))
+        self.assertEqual(response.status_code, 202)
+        job = response.json()
+        self.assertEqual(job['mode'], 'full')
+        with mock.patch('libreosteoweb.api.rebuild.RebuildJob.start'):
+            # The running job is returned
+            response = self.client.get(reverse('rebuild_index'))
+        self.assertEqual(response.json()['id'], job['id'])
+        from libreosteoweb.api.rebuild import get_rebuild_job
+        get_rebuild_job(job['id']).thread.join()
+        response = self.client.get(
+            reverse('rebuild_index_progress', args=[job['id']]))
+        self.assertEqual(response.json()['status'], 'done')
+        self.assertEqual(response.json()['done'], 1)
+        self.assertEqual(self.search(), 1)
+        self.assertEqual(
+            self.client.get(reverse('rebuild_index_progress',
+                                    args=['0' * 32])).status_code, 404)
+        self.assertEqual(
+            self.client.get(reverse('rebuild_index'), {
+                'age': 'soon'
+            }).status_code, 400)
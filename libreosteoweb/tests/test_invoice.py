@@ -19,13 +19,16 @@ from rest_framework.test import APITestCase
 from django.contrib.auth import get_user_model
 from libreosteoweb.models import (TherapeutSettings, OfficeSettings, Invoice,
                                   Patient, Examination, InvoiceStatus,
-                                  ExaminationStatus)
+                                  ExaminationStatus, Paiment, PaimentMean)
 from datetime import datetime
 from django.utils import timezone
+from django.db import connection
 from django.db.models import signals
+from django.test.utils import CaptureQueriesContext
 from libreosteoweb.api.receivers import (block_disconnect_all_signal,
                                          receiver_examination,
                                          receiver_newpatient)
+from libreosteoweb.api.signals import post_reload_db
 
 
 class TestChangeIdInvoice(APITestCase):
@@ -177,6 +180,9 @@ class TestCancelInvoice(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         examination = Examination.objects.filter(pk=self.e1.pk)[0]
         self.assertEqual(examination.invoices.latest('date').number, u'10000')
+        self.assertEqual(examination.current_invoice.number, u'10000')
+        self.assertEqual(examination.current_invoice_status,
+                         InvoiceStatus.INVOICED_PAID)
         # When
         response = self.client.post(
             reverse('invoice-cancel',
@@ -200,6 +206,9 @@ class TestCancelInvoice(APITestCase):
         self.assertEqual(len(response.data['invoices_list']), 2)
         self.assertEqual(response.data['invoices_list'][0]['id'],
                          credit_note['id'])
+        examination = Examination.objects.get(pk=self.e1.pk)
+        self.assertIsNone(examination.current_invoice)
+        self.assertIsNone(examination.current_invoice_status)
 
 
 class TestRegularizeNotPaidInvoice(APITestCase):
@@ -241,6 +250,9 @@ class TestRegularizeNotPaidInvoice(APITestCase):
                                     },
                                     format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(reverse('examination-unpaid'))
+        self.assertEqual([e['id'] for e in response.data], [self.e1.pk])
+        self.assertEqual(response.data[0]['last_invoice']['number'], u'10000')
         examination = Examination.objects.filter(pk=self.e1.pk)[0]
         self.assertEqual(examination.invoices.latest('date').number, u'10000')
         self.assertEqual(
@@ -270,6 +282,56 @@ class TestRegularizeNotPaidInvoice(APITestCase):
         self.assertEqual(paiements.first().amount, 55)
         self.assertEqual(paiements.first().paiment_mode, 'check')
         self.assertEqual(paiements.first().currency, 'EUR')
+        examination = Examination.objects.get(pk=self.e1.pk)
+        self.assertEqual(examination.current_invoice, invoice)
+        self.assertEqual(examination.current_invoice_status,
+                         InvoiceStatus.INVOICED_PAID)
+        response = self.client.get(reverse('examination-unpaid'))
+        self.assertEqual(response.data, [])
+
+    def testUnpaidAfterRestore(self):
+        response = self.client.post(reverse('examination-close',
+                                            kwargs={'pk': self.e1.pk}),
+                                    data={
+                                        'status': 'invoiced',
+                                        'amount': 55,
+                                        'paiment_mode': 'notpaid',
+                                        'check': {}
+                                    },
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # As restored from a backup without the current invoices
+        Examination.objects.update(current_invoice=None,
+                                   current_invoice_status=None)
+        examination = Examination.objects.with_invoices().get(pk=self.e1.pk)
+        self.assertEqual(examination.get_invoice_number(), u'10000')
+        self.assertEqual(examination.invoices_list, [])
+        post_reload_db.send(self.__class__)
+        response = self.client.get(reverse('examination-unpaid'))
+        self.assertEqual([e['id'] for e in response.data], [self.e1.pk])
+        self.assertEqual(response.data[0]['invoice_number'], u'10000')
+
+    def testOutdatedCurrentInvoice(self):
+        response = self.client.post(reverse('examination-close',
+                                            kwargs={'pk': self.e1.pk}),
+                                    data={
+                                        'status': 'invoiced',
+                                        'amount': 55,
+                                        'paiment_mode': 'notpaid',
+                                        'check': {}
+                                    },
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        other = Invoice.objects.create(date=timezone.now(),
+                                       amount=50,
+                                       number=u'W1',
+                                       paiment_mode='cash',
+                                       status=InvoiceStatus.INVOICED_PAID)
+        Examination.objects.update(current_invoice=other)
+        response = self.client.get(
+            reverse('examination-detail', kwargs={'pk': self.e1.pk}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['invoices_list'], [])
 
     def testRegularizeInvoiceNotPaid_NotPaid(self):
         # Given
@@ -459,3 +521,60 @@ class TestInvoiceWithOfficeSettings(APITestCase):
         setting2 = OfficeSettings.objects.get(id=2)
         self.assertEquals(setting1.invoice_start_sequence, u'')
         self.assertEquals(setting2.invoice_start_sequence, u'1000001')
+
+
+class TestInvoiceList(APITestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_superuser(
+            "test", "test@test.com", "testpw")
+        TherapeutSettings.objects.create(user=self.user)
+        self.client.login(username='test', password='testpw')
+        self.office = OfficeSettings.objects.get(id=1)
+        self.office.office_name = "Office"
+        self.office.save()
+        self.cash = PaimentMean.objects.filter(code='cash').first().text
+
+    def create_invoices(self, nb):
+        for i in range(0, nb):
+            invoice = Invoice.objects.create(
+                date=timezone.now(),
+                amount=50,
+                number=u'W%s' % Invoice.objects.count(),
+                paiment_mode='cash',
+                status=InvoiceStatus.INVOICED_PAID,
+                officesettings_id=self.office.id)
+            paiment = Paiment.objects.create(amount=50,
+                                             currency='EUR',
+                                             paiment_mode='cash',
+                                             date=timezone.now())
+            paiment.invoice.add(invoice)
+
+    def get_number_of_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('invoice-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return (len(context.captured_queries), response.data)
+
+    def test_number_of_queries(self):
+        self.create_invoices(2)
+        (nb_queries, invoices) = self.get_number_of_queries()
+        self.assertEqual(len(invoices), 2)
+        self.assertEqual(invoices[0]['office_name'], "Office")
+        self.assertEqual(invoices[0]['paiment_mode_text'], self.cash)
+        self.assertEqual(
+            invoices[0]['paiments_list'][0]['paiment_mode_text'], self.cash)
+        self.create_invoices(20)
+        (nb_queries_more_invoices, invoices) = self.get_number_of_queries()
+        self.assertEqual(len(invoices), 22)
+        self.assertEqual(nb_queries, nb_queries_more_invoices)
+
+    def test_unknown_references(self):
+        Invoice.objects.create(date=timezone.now(),
+                               amount=50,
+                               number=u'W1',
+                               paiment_mode='unknown',
+                               officesettings_id=99)
+        invoice = self.get_number_of_queries()[1][0]
+        self.assertEqual(invoice['office_name'], 'n/a')
+        self.assertEqual(invoice['paiment_mode_text'], 'n/a')
@@ -0,0 +1,131 @@
+# This file is part of LibreOsteo.
+#
+# LibreOsteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LibreOsteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
+from django.test import Client, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.urls import reverse
+from rest_framework import status
+from libreosteoweb.middleware import middleware_cache, session_keys
+from libreosteoweb.models import LoggedInUser, OfficeEvent, OfficeSettings
+
+
+class TestMiddlewareCache(TransactionTestCase):
+    # The cache is only used out of a transaction
+    serialized_rollback = True
+
+    def setUp(self):
+        middleware_cache.clear()
+        self.user = get_user_model().objects.create_superuser(
+            "test", "test@test.com", "testpw")
+        self.client.login(username='test', password='testpw')
+
+    def tearDown(self):
+        middleware_cache.clear()
+
+    def get_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('patient-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # The session of the user is only stored on the first request
+        return [
+            q['sql'] for q in context.captured_queries
+            if 'loggedinuser' not in q['sql']
+        ]
+
+    def test_cached_lookups(self):
+        first = self.get_queries()
+        second = self.get_queries()
+        # The users and the offices are not counted anymore
+        self.assertEqual(len(second), len(first) - 2)
+        self.assertFalse(
+            any('COUNT' in q and 'officesettings' in q for q in second))
+
+    def test_invalidated_on_change(self):
+        self.get_queries()
+        office = OfficeSettings.objects.create(office_identifier="98765",
+                                               currency='EUR')
+        response = self.client.get(reverse('patient-list'))
+        self.assertRedirects(response,
+                             reverse('officesettings-set'),
+                             fetch_redirect_response=False)
+        office.delete()
+        self.get_queries()
+        OfficeEvent.objects.all().delete()
+        get_user_model().objects.all().delete()
+        response = self.client.get('/')
+        self.assertRedirects(response,
+                             reverse('install'),
+                             fetch_redirect_response=False)
+
+
+class TestOneSessionPerUser(TransactionTestCase):
+    # The session keys are only kept out of a transaction
+    serialized_rollback = True
+
+    def setUp(self):
+        session_keys.clear()
+        self.user = get_user_model().objects.create_superuser(
+            "test", "test@test.com", "testpw")
+        self.client.login(username='test', password='testpw')
+
+    def tearDown(self):
+        session_keys.clear()
+
+    def get_queries(self, client):
+        with CaptureQueriesContext(connection) as context:
+            response = client.get(reverse('patient-list'))
+        return response, [
+            q['sql'] for q in context.captured_queries
+            if 'loggedinuser' in q['sql']
+        ]
+
+    def test_stored_on_change(self):
+        # Stored on login
+        self.assertEqual(
+            LoggedInUser.objects.get(user=self.user).session_key,
+            self.client.session.session_key)
+        response, queries = self.get_queries(self.client)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(any(q.startswith('UPDATE') for q in queries))
+        response, queries = self.get_queries(self.client)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(queries, [])
+        # Stored by an older version
+        LoggedInUser.objects.filter(user=self.user).update(session_key=None)
+        session_keys.clear()
+        response, queries = self.get_queries(self.client)
+        self.assertTrue(any(q.startswith('UPDATE') for q in queries))
+        response, queries = self.get_queries(self.client)
+        self.assertEqual(queries, [])
+
+    def test_other_session(self):
+        self.get_queries(self.client)
+        other = Client()
+        other.login(username='test', password='testpw')
+        response, queries = self.get_queries(other)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # The first session is closed
+        response, queries = self.get_queries(self.client)
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        response, queries = self.get_queries(other)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(queries, [])
+        other.logout()
+        self.assertFalse(LoggedInUser.objects.filter(user=self.user).exists())
+        self.client.login(username='test', password='testpw')
+        response, queries = self.get_queries(self.client)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(queries, [])
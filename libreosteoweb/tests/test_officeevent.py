@@ -0,0 +1,105 @@
+# This file is part of LibreOsteo.
+#
+# LibreOsteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LibreOsteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
+# -*- coding: utf-8 -*-
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from django.contrib.auth import get_user_model
+from libreosteoweb.models import OfficeEvent, Patient, Examination
+from datetime import datetime, timedelta
+from django.utils import timezone
+from django.db import connection
+from django.db.models import signals
+from django.test.utils import CaptureQueriesContext
+from libreosteoweb.api.receivers import (block_disconnect_all_signal,
+                                         receiver_examination,
+                                         receiver_newpatient)
+
+
+class TestOfficeEventFeed(APITestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_superuser(
+            "test", "test@test.com", "testpw")
+        self.client.login(username='test', password='testpw')
+        with block_disconnect_all_signal(
+                signal=signals.post_save,
+                receivers_senders=[(receiver_newpatient, Patient)]):
+            self.patient = Patient.objects.create(
+                family_name="Picard",
+                first_name="Jean-Luc",
+                birth_date=datetime(1935, 7, 13))
+        now = timezone.now()
+        for i in range(0, 25):
+            # Some events share the same date
+            OfficeEvent.objects.create(date=now - timedelta(minutes=i // 2),
+                                       clazz=Patient.__name__,
+                                       type=1 if i % 5 else 2,
+                                       comment="Event %s" % i,
+                                       reference=self.patient.id,
+                                       user=self.user)
+
+    def get_feed(self, url):
+        ids = []
+        while url is not None:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(len(response.data['results']) <= 10)
+            ids.extend(e['id'] for e in response.data['results'])
+            url = response.data['next']
+        return ids
+
+    def test_feed(self):
+        events = OfficeEvent.objects.order_by('-date', '-id')
+        self.assertEqual(self.get_feed(reverse('officeevent-list')),
+                         list(events.exclude(type=2).values_list('id',
+                                                                 flat=True)))
+        self.assertEqual(
+            self.get_feed(reverse('officeevent-list') + '?all=1&limit=7'),
+            list(events.values_list('id', flat=True)))
+
+    def test_patient_names(self):
+        with block_disconnect_all_signal(
+                signal=signals.post_save,
+                receivers_senders=[(receiver_newpatient, Patient),
+                                   (receiver_examination, Examination)]):
+            deleted = Patient.objects.create(family_name="Kirk",
+                                             first_name="James",
+                                             birth_date=datetime(1933, 3, 22))
+            examination = Examination.objects.create(date=timezone.now(),
+                                                     status=0,
+                                                     type=1,
+                                                     patient=self.patient)
+        for (clazz, reference) in [("Examination", examination.id),
+                                   ("Examination", 0),
+                                   ("Patient", deleted.id)]:
+            OfficeEvent.objects.create(date=timezone.now(),
+                                       clazz=clazz,
+                                       type=1,
+                                       comment="New",
+                                       reference=reference,
+                                       user=self.user)
+        deleted.delete()
+        events = self.client.get(reverse('officeevent-list')).data['results']
+        self.assertEqual([e['patient_name'] for e in events[0:4]],
+                         ["", "", "Picard Jean-Luc", "Picard Jean-Luc"])
+
+    def test_number_of_queries(self):
+        with CaptureQueriesContext(connection) as small_page:
+            self.client.get(reverse('officeevent-list'), {'limit': 2})
+        with CaptureQueriesContext(connection) as large_page:
+            self.client.get(reverse('officeevent-list'), {'limit': 20})
+        self.assertEqual(len(small_page.captured_queries),
+                         len(large_page.captured_queries))
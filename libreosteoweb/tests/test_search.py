@@ -0,0 +1,217 @@
+# This file is part of LibreOsteo.
+#
+# LibreOsteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LibreOsteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
+# -*- coding: utf-8 -*-
+from django.test import TestCase
+from django.urls import reverse
+from django.contrib.auth import get_user_model
+from django.db.models import signals
+from django.utils import timezone
+from rest_framework import status
+from libreosteoweb.models import (Document, Examination, Patient,
+                                  PatientDocument)
+from libreosteoweb.api.receivers import (block_disconnect_all_signal,
+                                         receiver_examination,
+                                         receiver_newpatient)
+from libreosteoweb.tests.test_indexing import IndexTestMixin
+from datetime import datetime
+
+
+class SearchTestMixin(IndexTestMixin):
+
+    def setUp(self):
+        super(SearchTestMixin, self).setUp()
+        self.user = get_user_model().objects.create_superuser(
+            "test", "test@test.com", "testpw")
+        self.client.login(username='test', password='testpw')
+        receivers_senders = [(receiver_examination, Examination),
+                             (receiver_newpatient, Patient)]
+        with block_disconnect_all_signal(signal=signals.post_save,
+                                         receivers_senders=receivers_senders):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.picard = Patient.objects.create(family_name="Picard",
+                                                     first_name="Jean-Luc",
+                                                     birth_date=datetime(
+                                                         1935, 7, 13))
+                kirk = Patient.objects.create(family_name="Kirk",
+                                              first_name="James",
+                                              birth_date=datetime(
+                                                  1933, 3, 22))
+                self.create_examination(self.picard, datetime(2024, 5, 2),
+                                        1, self.user, "Lombalgie aigue")
+                self.create_examination(self.picard, datetime(2024, 6, 12),
+                                        2, self.user, "Lombalgie chronique")
+                self.create_examination(kirk, datetime(2024, 6, 20), 4, None,
+                                        "Cervicalgie, douleur lombaire")
+                self.create_examination(kirk, datetime(2024, 6, 21), 1,
+                                        self.user, "Entorse")
+                document = Document.objects.create(
+                    document_file='documents/radio.pdf',
+                    title="Radio lombaire",
+                    internal_date=timezone.now())
+                PatientDocument.objects.create(patient=self.picard,
+                                               document=document,
+                                               attachment_type=1)
+
+    def create_examination(self, patient, date, type, therapeut, diagnosis):
+        return Examination.objects.create(patient=patient,
+                                          date=timezone.make_aware(date),
+                                          status=0,
+                                          type=type,
+                                          therapeut=therapeut,
+                                          diagnosis=diagnosis)
+
+
+class TestExaminationSearch(SearchTestMixin, TestCase):
+
+    def search(self, **params):
+        response = self.client.get(reverse('examination-search'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_search(self):
+        result = self.search(q='lomb')
+        self.assertEqual(result['count'], 3)
+        self.assertEqual(
+            sorted(r['diagnosis'] for r in result['results']),
+            ["Cervicalgie, douleur lombaire", "Lombalgie aigue",
+             "Lombalgie chronique"])
+        picard = [
+            r['patient'] for r in result['results']
+            if r['diagnosis'] == "Lombalgie aigue"
+        ][0]
+        self.assertEqual(picard, {
+            'id': self.picard.pk,
+            'family_name': "Picard",
+            'first_name': "Jean-Luc"
+        })
+        self.assertEqual(result['facets']['month'], [{
+            'value': 202406,
+            'count': 2
+        }, {
+            'value': 202405,
+            'count': 1
+        }])
+        self.assertEqual(result['facets']['therapeut'], [{
+            'value': self.user.pk,
+            'count': 2
+        }, {
+            'value': None,
+            'count': 1
+        }])
+        self.assertEqual(len(result['facets']['type']), 3)
+        self.assertEqual(self.search(q='entorse')['count'], 1)
+        self.assertEqual(self.search(q='')['count'], 0)
+
+    def test_filters(self):
+        self.assertEqual(self.search(q='lomb', month=202406)['count'], 2)
+        self.assertEqual(
+            self.search(q='lomb', therapeut=self.user.pk)['count'], 2)
+        result = self.search(q='lomb', type=4)
+        self.assertEqual(result['facets']['type'], [{
+            'value': 4,
+            'count': 1
+        }])
+        self.assertEqual(
+            self.search(q='lomb', date__gte='2024-06-01',
+                        date__lte='2024-06-15')['count'], 1)
+        result = self.search(q='lomb', page_size=2, page=2)
+        self.assertEqual((result['count'], len(result['results'])), (3, 1))
+        for params in [{
+                'therapeut': 'me'
+        }, {
+                'date__gte': '2024-13-01'
+        }, {
+                'page': 0
+        }]:
+            response = self.client.get(reverse('examination-search'),
+                                       dict(q='lomb', **params))
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+
+    def test_update(self):
+        examination = Examination.objects.get(diagnosis="Entorse")
+        examination.diagnosis = "Lombalgie"
+        with self.captureOnCommitCallbacks(execute=True):
+            examination.save()
+        self.assertEqual(self.search(q='lomb')['count'], 4)
+        with self.captureOnCommitCallbacks(execute=True):
+            examination.delete()
+        self.assertEqual(self.search(q='lomb')['count'], 3)
+
+
+class TestGlobalSearch(SearchTestMixin, TestCase):
+
+    def search(self, **params):
+        response = self.client.get(reverse('search_api'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def get_titles(self, result):
+        return [(r['model'], r['title']) for r in result['results']]
+
+    def test_search(self):
+        result = self.search(q='pic')
+        self.assertEqual(result['count'], 1)
+        picard = result['results'][0]
+        self.assertEqual((picard['model'], picard['id'], picard['title']),
+                         ('patient', self.picard.pk, "Picard Jean-Luc"))
+        self.assertEqual(picard['patient']['id'], self.picard.pk)
+        self.assertIn('<span class="highlighted">Pic', picard['highlight'])
+        result = self.search(q='lomb')
+        self.assertEqual(result['count'], 4)
+        self.assertEqual(result['facets']['model'], [{
+            'value': 'document',
+            'count': 1
+        }, {
+            'value': 'examination',
+            'count': 3
+        }, {
+            'value': 'patient',
+            'count': 0
+        }])
+        # The document is linked to its patient
+        document = [r for r in result['results'] if r['model'] == 'document']
+        self.assertEqual(document[0]['patient']['family_name'], "Picard")
+        self.assertEqual(self.search(q='')['count'], 0)
+        # The results are rendered by the front-end
+        self.assertEqual(
+            self.client.get(reverse('search_view')).status_code,
+            status.HTTP_200_OK)
+
+    def test_refine(self):
+        result = self.search(q='lomb', models='document,patient')
+        self.assertEqual(self.get_titles(result),
+                         [('document', "Radio lombaire")])
+        # The counts of the other models are kept
+        self.assertEqual(result['facets']['model'][1]['count'], 3)
+        result = self.search(q='lomb', models='examination', page_size=2)
+        self.assertEqual((result['count'], len(result['results'])), (3, 2))
+        result = self.search(q='lomb',
+                             models='examination',
+                             page_size=2,
+                             page=2)
+        self.assertEqual(len(result['results']), 1)
+        result = self.search(q='lomb', models='examination', sort='-date')
+        self.assertEqual([r['title'] for r in result['results']], [''] * 3)
+        self.assertEqual([
+            r['id'] for r in result['results']
+        ], list(
+            Examination.objects.filter(diagnosis__icontains='lomb').order_by(
+                '-date').values_list('id', flat=True)))
+        for params in [{'models': 'invoice'}, {'sort': 'date'}]:
+            response = self.client.get(reverse('search_api'),
+                                       dict(q='lomb', **params))
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,146 @@
+# This file is part of LibreOsteo.
+#
+# LibreOsteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LibreOsteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
+# -*- coding: utf-8 -*-
+from django.test import TransactionTestCase
+from django.db import connection, transaction
+from django.db.models import signals
+from haystack import connections
+from haystack.inputs import AutoQuery
+from haystack.query import SearchQuerySet
+from libreosteoweb.models import Document, Patient
+from libreosteoweb.api.rebuild import RebuildJob, start_rebuild
+from libreosteoweb.api.indexing import index_queue
+from libreosteoweb.api.signals import post_reload_db
+from libreosteoweb.api.receivers import (block_disconnect_all_signal,
+                                         receiver_newpatient)
+from libreosteoweb.tests import test_search
+from datetime import datetime
+
+
+class TestSQLiteFTSBackend(TransactionTestCase):
+    # The rebuild reads the committed data from its own connection
+    serialized_rollback = True
+
+    def setUp(self):
+        self.connection_info = connections.connections_info['default']
+        connections.connections_info['default'] = {
+            'ENGINE': 'libreosteoweb.api.sqlite_backend.SQLiteFTSEngine',
+            'TABLE': 'test_search',
+        }
+        connections.reload('default')
+
+    def tearDown(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TABLE IF EXISTS test_search')
+        connections.connections_info['default'] = self.connection_info
+        connections.reload('default')
+
+    def create_patient(self, family_name, first_name, **kwargs):
+        with block_disconnect_all_signal(
+                signal=signals.post_save,
+                receivers_senders=[(receiver_newpatient, Patient)]):
+            with transaction.atomic():
+                return Patient.objects.create(family_name=family_name,
+                                              first_name=first_name,
+                                              birth_date=datetime(
+                                                  1935, 7, 13),
+                                              **kwargs)
+
+    def search(self, query):
+        return sorted(r.first_name for r in SearchQuerySet().models(
+            Patient).filter(content=query))
+
+    def test_search(self):
+        self.create_patient("Picard", "Jean-Luc", medical_history="Migraine")
+        self.create_patient("Picardie", "Hélène")
+        self.create_patient("Kirk", "James")
+        self.assertEqual(self.search("pic"), ["Hélène", "Jean-Luc"])
+        self.assertEqual(self.search("PICARDIE"), ["Hélène"])
+        self.assertEqual(self.search("helene"), ["Hélène"])
+        self.assertEqual(self.search("pic migr"), ["Jean-Luc"])
+        self.assertEqual(self.search("'\""), [])
+        self.assertEqual(
+            [
+                r.first_name for r in SearchQuerySet().filter(
+                    content=AutoQuery('pic -hel'))
+            ], ["Jean-Luc"])
+        self.assertEqual(
+            SearchQuerySet().filter(content=AutoQuery('"jean luc"')).count(),
+            1)
+        self.assertEqual(SearchQuerySet().models(Document).count(), 0)
+        self.assertEqual(SearchQuerySet().all().count(), 3)
+        results = SearchQuerySet().filter(content='pic').order_by('first_name')
+        self.assertEqual([r.first_name for r in results[1:]], ["Jean-Luc"])
+        self.assertIn("Migraine", results[1].text)
+        self.assertGreater(results[1].score, 0)
+
+    def test_update(self):
+        patient = self.create_patient("Picard", "Jean-Luc")
+        patient.family_name = "Kirk"
+        with transaction.atomic():
+            patient.save()
+        self.assertEqual(self.search("pic"), [])
+        self.assertEqual(self.search("kirk"), ["Jean-Luc"])
+        with transaction.atomic():
+            patient.delete()
+        self.assertEqual(self.search("kirk"), [])
+
+    def test_rebuild(self):
+        self.create_patient("Picard", "Jean-Luc")
+        deleted = self.create_patient("Picard", "Yvette")
+        index_queue.hold()
+        try:
+            with transaction.atomic():
+                deleted.delete()
+            connections['default'].get_backend().clear()
+            job = RebuildJob()
+            job.run()
+            self.assertEqual(job.status, 'done')
+            self.assertEqual(self.search("pic"), ["Jean-Luc"])
+        finally:
+            index_queue.release()
+        # The restored data is indexed again
+        connections['default'].get_backend().clear()
+        post_reload_db.send(self.__class__)
+        # Returns the started job, if still running
+        start_rebuild().thread.join()
+        self.assertEqual(self.search("pic"), ["Jean-Luc"])
+
+
+class SQLiteFTSSearchMixin(object):
+
+    def setUp(self):
+        self.whoosh_connection_info = connections.connections_info['default']
+        connections.connections_info['default'] = {
+            'ENGINE': 'libreosteoweb.api.sqlite_backend.SQLiteFTSEngine',
+            # Replaced by IndexTestMixin
+            'PATH': self.whoosh_connection_info['PATH'],
+        }
+        super(SQLiteFTSSearchMixin, self).setUp()
+
+    def tearDown(self):
+        super(SQLiteFTSSearchMixin, self).tearDown()
+        connections.connections_info['default'] = self.whoosh_connection_info
+        connections.reload('default')
+
+
+class TestSQLiteFTSExaminationSearch(SQLiteFTSSearchMixin,
+                                     test_search.TestExaminationSearch):
+    pass
+
+
+class TestSQLiteFTSGlobalSearch(SQLiteFTSSearchMixin,
+                                test_search.TestGlobalSearch):
+    pass
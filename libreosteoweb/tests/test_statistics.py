@@ -0,0 +1,336 @@
+# This file is part of LibreOsteo.
+#
+# LibreOsteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LibreOsteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
+# -*- coding: utf-8 -*-
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.cache import cache
+from libreosteoweb.models import (TherapeutSettings, Patient, Examination,
+                                  Invoice, DailyOfficeStats, ExaminationStatus,
+                                  InvoiceStatus, OfficeSettings)
+from libreosteoweb.api.statistics import (Statistics, AggregatedStatistics,
+                                          RollupStatistics)
+from libreosteoweb.api.signals import post_reload_db
+from datetime import datetime, timedelta
+from django.utils import timezone
+from django.db.models import signals
+from libreosteoweb.api.receivers import (block_disconnect_all_signal,
+                                         receiver_examination,
+                                         receiver_newpatient)
+from unittest.mock import patch
+from io import StringIO
+
+
+def disconnect_events():
+    receivers_senders = [(receiver_examination, Examination),
+                         (receiver_newpatient, Patient)]
+    return block_disconnect_all_signal(signal=signals.post_save,
+                                       receivers_senders=receivers_senders)
+
+
+def create_history(user):
+    with disconnect_events():
+        now = timezone.now()
+        for (idx, days) in enumerate(range(0, 4200, 29)):
+            patient = Patient.objects.create(
+                family_name="Picard%s" % idx,
+                first_name="Jean-Luc",
+                birth_date=datetime(1935, 7, 13),
+                creation_date=(now - timedelta(days=days)).date())
+            for (offset, examination_type) in [(0, 1), (3, 3), (5, 4)]:
+                Examination.objects.create(date=now -
+                                           timedelta(days=days + offset),
+                                           status=0,
+                                           type=examination_type,
+                                           therapeut=user,
+                                           patient=patient)
+            for (offset, invoice_status) in [
+                (1, InvoiceStatus.WAITING_FOR_PAIEMENT),
+                (2, InvoiceStatus.INVOICED_PAID)
+            ]:
+                Invoice.objects.create(date=now - timedelta(days=days + offset),
+                                       amount=50,
+                                       number=u'%s-%s' % (idx, offset),
+                                       status=invoice_status,
+                                       therapeut_id=user.id)
+
+
+class TestAggregatedStatistics(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_superuser(
+            "test", "test@test.com", "testpw")
+        create_history(cls.user)
+
+    def test_same_result_as_statistics(self):
+        with patch('django.utils.timezone.now', return_value=timezone.now()):
+            self.assertEqual(Statistics().compute(),
+                             AggregatedStatistics().compute())
+
+    def test_history_is_complete(self):
+        result = AggregatedStatistics().compute()
+        for period in ['week', 'month', 'year']:
+            history = result['history'][period]
+            self.assertEqual(len(history['nb_examination'][0]), 11)
+            self.assertEqual(len(history['nb_examination'][1]), 11)
+            self.assertTrue(sum(history['nb_examination'][1]) > 0)
+            self.assertEqual(result[period]['nb_examination'],
+                             history['nb_examination'][1][-1])
+
+    def test_number_of_queries(self):
+        # One grouped query for the patients, one for the examinations,
+        # one for the unpaid invoices and one for the receivables
+        with self.assertNumQueries(4):
+            AggregatedStatistics().compute()
+
+    def test_unpaid_invoices(self):
+        result = AggregatedStatistics().compute()
+        for period in ['week', 'month', 'year']:
+            history = result['history'][period]
+            self.assertTrue(sum(history['nb_non_paid'][1]) > 0)
+            self.assertEqual(
+                [50 * nb for nb in history['nb_non_paid'][1]],
+                history['amount_non_paid'][1])
+
+    def test_receivables(self):
+        # One unpaid invoice every 29 days, since the day before
+        current_date = Invoice.objects.latest('date').date + timedelta(days=1)
+        receivables = AggregatedStatistics().get_receivables(current_date)
+        nb_non_paid = Invoice.objects.filter(
+            status=InvoiceStatus.WAITING_FOR_PAIEMENT).count()
+        self.assertEqual(receivables['nb_non_paid'], nb_non_paid)
+        self.assertEqual(receivables['amount_non_paid'], 50 * nb_non_paid)
+        self.assertEqual([a['label'] for a in receivables['aging']],
+                         ['0-30', '31-60', '61-90', '90+'])
+        self.assertEqual([a['nb_non_paid'] for a in receivables['aging']],
+                         [2, 1, 1, nb_non_paid - 4])
+        self.assertEqual(
+            sum(a['amount_non_paid'] for a in receivables['aging']),
+            receivables['amount_non_paid'])
+
+
+class TestRollupStatistics(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_superuser(
+            "test", "test@test.com", "testpw")
+        create_history(cls.user)
+
+    def get_rows(self):
+        return list(
+            DailyOfficeStats.objects.order_by('day', 'office',
+                                              'therapeut').values(
+                                                  'day', 'office', 'therapeut',
+                                                  'nb_new_patient',
+                                                  'nb_examination',
+                                                  'nb_urgent_return'))
+
+    def test_same_result_as_aggregated_statistics(self):
+        with patch('django.utils.timezone.now', return_value=timezone.now()):
+            self.assertEqual(AggregatedStatistics().compute(),
+                             RollupStatistics().compute())
+
+    def test_number_of_queries(self):
+        with self.assertNumQueries(3):
+            RollupStatistics().compute()
+
+    def test_rebuild_is_same_as_incremental(self):
+        incremental = self.get_rows()
+        DailyOfficeStats.objects.all().delete()
+        call_command('rebuild_daily_stats', stdout=StringIO())
+        self.assertEqual(incremental, self.get_rows())
+        DailyOfficeStats.objects.all().delete()
+        post_reload_db.send(self.__class__)
+        self.assertEqual(incremental, self.get_rows())
+
+    def test_update_examination(self):
+        examination = Examination.objects.order_by('-date').first()
+        day = timezone.localtime(examination.date).date()
+        before = DailyOfficeStats.objects.get(day=day, therapeut=self.user)
+        examination.status = ExaminationStatus.WAITING_FOR_PAIEMENT
+        examination.date = examination.date - timedelta(days=400)
+        examination.save()
+        after = DailyOfficeStats.objects.filter(day=day,
+                                                therapeut=self.user).first()
+        self.assertEqual(
+            after.nb_examination if after else 0, before.nb_examination - 1)
+        moved = DailyOfficeStats.objects.get(
+            day=timezone.localtime(examination.date).date(),
+            therapeut=self.user)
+        self.assertEqual(
+            moved.nb_examination,
+            Examination.objects.filter(therapeut=self.user,
+                                       date__date=moved.day).count())
+        examination.delete()
+        self.assertFalse(
+            DailyOfficeStats.objects.filter(
+                day=timezone.localtime(examination.date).date(),
+                therapeut=self.user).exists())
+
+
+class TestStatisticsView(APITestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_superuser(
+            "test", "test@test.com", "testpw")
+        TherapeutSettings.objects.create(user=self.user)
+        create_history(self.user)
+        self.client.login(username='test', password='testpw')
+
+    def test_get_statistics(self):
+        with patch('django.utils.timezone.now', return_value=timezone.now()):
+            response = self.client.get(reverse('statistics_view'))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data, Statistics().compute())
+
+
+class TestStatisticsScope(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_superuser(
+            "test", "test@test.com", "testpw")
+        self.other = get_user_model().objects.create_user(
+            "other", "other@test.com", "otherpw")
+        TherapeutSettings.objects.create(user=self.user)
+        self.office1 = OfficeSettings.objects.get(id=1)
+        self.office2 = OfficeSettings.objects.create(office_identifier="98765",
+                                                     currency='EUR')
+        with disconnect_events():
+            self.patient = Patient.objects.create(
+                family_name="Picard",
+                first_name="Jean-Luc",
+                birth_date=datetime(1935, 7, 13),
+                creation_date=timezone.localdate())
+        for (office, therapeut, nb) in [(self.office1, self.user, 3),
+                                        (self.office2, self.user, 2),
+                                        (self.office2, self.other, 1)]:
+            for i in range(0, nb):
+                self.create_examination(office, therapeut)
+        self.client.login(username='test', password='testpw')
+        session = self.client.session
+        session.update({"officesettings": 1})
+        session.save()
+
+    def create_examination(self, office, therapeut):
+        with disconnect_events():
+            return Examination.objects.create(date=timezone.now(),
+                                              status=0,
+                                              type=1,
+                                              therapeut=therapeut,
+                                              office=office,
+                                              patient=self.patient)
+
+    def get_statistics(self, **params):
+        response = self.client.get(reverse('statistics_view'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_scope(self):
+        for (office, therapeut, nb) in [(None, None, 6), (1, None, 3),
+                                        (2, None, 3), (None, self.user.id, 5),
+                                        (2, self.other.id, 1)]:
+            statistics = RollupStatistics(office=office, therapeut=therapeut)
+            with patch('django.utils.timezone.now',
+                       return_value=timezone.now()):
+                result = statistics.compute()
+                self.assertEqual(
+                    Statistics(office=office, therapeut=therapeut).compute(),
+                    result)
+            self.assertEqual(result['week']['nb_examination'], nb)
+            self.assertEqual(result['year']['nb_new_patient'], 1)
+
+    def test_receivables_scope(self):
+        for (office, therapeut) in [(1, self.user.id), (2, self.user.id),
+                                    (2, self.other.id)]:
+            Invoice.objects.create(date=timezone.now(),
+                                   amount=30,
+                                   number=u'%s-%s' % (office, therapeut),
+                                   status=InvoiceStatus.WAITING_FOR_PAIEMENT,
+                                   officesettings_id=office,
+                                   therapeut_id=therapeut)
+        for (office, therapeut, nb) in [(None, None, 3), (2, None, 2),
+                                        (None, self.user.id, 2),
+                                        (2, self.other.id, 1)]:
+            result = RollupStatistics(office=office,
+                                      therapeut=therapeut).compute()
+            self.assertEqual(result['week']['nb_non_paid'], nb)
+            self.assertEqual(result['week']['amount_non_paid'], 30 * nb)
+            self.assertEqual(result['receivables']['nb_non_paid'], nb)
+            self.assertEqual(result['receivables']['aging'][0]['nb_non_paid'],
+                             nb)
+
+    def test_view_scope(self):
+        result = self.get_statistics(office='current', therapeut='me')
+        self.assertEqual(result['week']['nb_examination'], 3)
+        result = self.get_statistics(office=2, therapeut=self.other.id)
+        self.assertEqual(result['week']['nb_examination'], 1)
+        result = self.get_statistics(period='month')
+        self.assertEqual(result['month']['nb_examination'], 6)
+        self.assertIsNone(result['week'])
+        self.assertIsNone(result['history']['year'])
+
+    def test_view_invalid_scope(self):
+        response = self.client.get(reverse('statistics_view'),
+                                   {'office': 'nowhere'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(reverse('statistics_view'),
+                                   {'period': 'century'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_cache(self):
+        with patch.object(RollupStatistics,
+                          'compute',
+                          autospec=True,
+                          side_effect=RollupStatistics.compute) as compute:
+            self.get_statistics(office=1)
+            self.get_statistics(office=1)
+            self.get_statistics(office=2)
+            self.assertEqual(compute.call_count, 2)
+            # An examination into another office keeps the cache
+            self.create_examination(self.office2, self.other)
+            self.assertEqual(
+                self.get_statistics(office=1)['week']['nb_examination'], 3)
+            self.assertEqual(compute.call_count, 2)
+            # An examination into the office invalidates it
+            self.create_examination(self.office1, self.other)
+            self.assertEqual(
+                self.get_statistics(office=1)['week']['nb_examination'], 4)
+            self.assertEqual(compute.call_count, 3)
+            # A new patient invalidates all the scopes
+            with disconnect_events():
+                Patient.objects.create(family_name="Bond",
+                                       first_name="James",
+                                       birth_date=datetime(1924, 1, 1),
+                                       creation_date=timezone.localdate())
+            self.assertEqual(
+                self.get_statistics(office=2)['week']['nb_new_patient'], 2)
+            self.assertEqual(compute.call_count, 4)
+            # An unpaid invoice invalidates its scope
+            Invoice.objects.create(date=timezone.now(),
+                                   amount=30,
+                                   number=u'W1',
+                                   status=InvoiceStatus.WAITING_FOR_PAIEMENT,
+                                   officesettings_id=2,
+                                   therapeut_id=self.user.id)
+            self.assertEqual(
+                self.get_statistics(office=2)['receivables']['nb_non_paid'],
+                1)
+            self.assertEqual(compute.call_count, 5)
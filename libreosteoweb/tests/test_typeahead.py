@@ -0,0 +1,117 @@
+# This file is part of LibreOsteo.
+#
+# LibreOsteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LibreOsteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
+# -*- coding: utf-8 -*-
+from django.test import SimpleTestCase
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from django.contrib.auth import get_user_model
+from libreosteoweb.models import Patient
+from libreosteoweb.api.typeahead import PatientNameIndex, patient_name_index
+from datetime import date, datetime
+from django.db.models import signals
+from libreosteoweb.api.receivers import (block_disconnect_all_signal,
+                                         receiver_newpatient)
+
+PATIENTS = [
+    (1, "Lefèbvre", "", "Hélène", date(1980, 5, 2)),
+    (2, "Picard", "Dupont", "Jean-Luc", date(1935, 7, 13)),
+    (3, "Piquet", "", "Zoé", date(1990, 1, 20)),
+    (4, "Lefort", "", "Jean", None),
+]
+
+
+class TestPatientNameIndex(SimpleTestCase):
+
+    def setUp(self):
+        self.index = PatientNameIndex()
+        self.index.load(PATIENTS)
+
+    def search(self, query, limit=10):
+        return [r['id'] for r in self.index.search(query, limit)]
+
+    def test_search(self):
+        self.assertEqual(self.search("lef"), [1, 4])
+        self.assertEqual(self.search("LÉFÈ"), [1])
+        self.assertEqual(self.search("hel"), [1])
+        self.assertEqual(self.search("pi"), [2, 3])
+        self.assertEqual(self.search("dupont"), [2])
+        self.assertEqual(self.search("luc"), [2])
+        self.assertEqual(self.search("jean lef"), [4])
+        self.assertEqual(self.search("pi 1935"), [2])
+        self.assertEqual(self.search("13/07/1935"), [2])
+        self.assertEqual(self.search("lef", limit=1), [1])
+        self.assertEqual(self.search("kirk"), [])
+        self.assertEqual(self.search(" - "), [])
+        self.assertEqual(self.index.search("picard")[0]['birth_date'],
+                         '1935-07-13')
+
+    def test_update(self):
+        self.index.update((3, "Kirk", "", "James", date(1933, 3, 22)))
+        self.index.update((5, "Lefranc", "", "Yvette", None))
+        self.assertEqual(self.search("pi"), [2])
+        self.assertEqual(self.search("kir"), [3])
+        self.assertEqual(self.search("lef"), [1, 4, 5])
+        self.index.remove(1)
+        self.index.remove(6)
+        self.assertEqual(self.search("lef"), [4, 5])
+        self.assertEqual(self.search("hel"), [])
+        self.assertEqual(len(self.index.keys), len(self.index.pks))
+
+
+class TestTypeahead(APITestCase):
+
+    def setUp(self):
+        patient_name_index.reset()
+        get_user_model().objects.create_superuser("test", "test@test.com",
+                                                  "testpw")
+        self.client.login(username='test', password='testpw')
+        self.picard = self.create_patient("Picard", "Jean-Luc")
+
+    def tearDown(self):
+        patient_name_index.reset()
+
+    def create_patient(self, family_name, first_name):
+        with block_disconnect_all_signal(
+                signal=signals.post_save,
+                receivers_senders=[(receiver_newpatient, Patient)]):
+            with self.captureOnCommitCallbacks(execute=True):
+                return Patient.objects.create(family_name=family_name,
+                                              first_name=first_name,
+                                              birth_date=datetime(
+                                                  1935, 7, 13))
+
+    def search(self, query):
+        response = self.client.get(reverse('patient-typeahead'), {'q': query})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [p['family_name'] for p in response.data]
+
+    def test_typeahead(self):
+        self.assertEqual(self.search("pic"), ["Picard"])
+        # The index is kept up to date once loaded
+        self.create_patient("Picardie", "Yvette")
+        self.assertEqual(self.search("pic"), ["Picard", "Picardie"])
+        self.picard.family_name = "Kirk"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.picard.save()
+        self.assertEqual(self.search("pic"), ["Picardie"])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.picard.delete()
+        self.assertEqual(self.search("kirk"), [])
+        response = self.client.get(reverse('patient-typeahead'), {
+            'q': 'pic',
+            'limit': 'all'
+        })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,81 @@
+# This file is part of LibreOsteo.
+#
+# LibreOsteo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# LibreOsteo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with LibreOsteo.  If not, see <http://www.gnu.org/licenses/>.
+import threading
+from unittest import mock
+from django.conf import settings
+from django.test import TestCase, override_settings
+from libreosteoweb.api.version.version import VersionChecker
+
+ASK = 'libreosteoweb.api.version.version.ask_for_new_version'
+
+
+@override_settings(VERSION_CHECK=True, VERSION_CHECK_INTERVAL=3600)
+class TestVersionChecker(TestCase):
+
+    def test_background_check(self):
+        checker = VersionChecker()
+        answered = threading.Event()
+
+        def ask():
+            answered.wait(5)
+            return (True, '99.0')
+
+        with mock.patch(ASK, side_effect=ask) as ask_mock:
+            # Does not wait for the answer
+            self.assertEqual(checker.get(), (False, None))
+            self.assertEqual(checker.get(), (False, None))
+            thread = checker.thread
+            answered.set()
+            thread.join()
+            self.assertEqual(checker.get(), (True, '99.0'))
+            self.assertIsNone(checker.thread)
+            self.assertEqual(ask_mock.call_count, 1)
+            # Checked again once outdated
+            answered.clear()
+            with override_settings(VERSION_CHECK_INTERVAL=0):
+                self.assertEqual(checker.get(), (True, '99.0'))
+            thread = checker.thread
+            answered.set()
+            thread.join()
+            self.assertEqual(ask_mock.call_count, 2)
+
+    def test_disabled(self):
+        checker = VersionChecker()
+        with override_settings(VERSION_CHECK=False):
+            with mock.patch(ASK) as ask_mock:
+                self.assertEqual(checker.get(), (False, None))
+                self.assertIsNone(checker.thread)
+                ask_mock.assert_not_called()
+
+    def test_default_settings(self):
+        checker = VersionChecker()
+        with override_settings():
+            del settings.VERSION_CHECK
+            del settings.VERSION_CHECK_INTERVAL
+            answered = threading.Event()
+
+            def ask():
+                answered.wait(5)
+                return (True, '99.0')
+
+            with mock.patch(ASK, side_effect=ask) as ask_mock:
+                self.assertEqual(checker.get(), (False, None))
+                thread = checker.thread
+                answered.set()
+                thread.join()
+                # Not checked again before the default interval
+                self.assertEqual(checker.get(), (True, '99.0'))
+                self.assertIsNone(checker.thread)
+                self.assertEqual(ask_mock.call_count, 1)
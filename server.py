@@ -15,6 +15,7 @@
 # Python stdlib imports
 import sys
 import logging
+import multiprocessing
 import os, os.path
 
 # Third-party imports
@@ -23,6 +24,9 @@ from cherrypy.process import wspbus, plugins
 from cherrypy import _cplogging, _cperror
 from django.conf import settings
 from Libreosteo.standalone import application
+from libreosteoweb.api.indexing import index_queue
+from libreosteoweb.api.importer import import_runner
+from libreosteoweb.api.typeahead import patient_name_index
 from django.http import HttpResponseServerError
 import configparser
 import pdb
@@ -95,6 +99,8 @@ class Server(object):
         # with the CherryPy engine, meaning the app will
         # play nicely with the process bus that is the engine.
         DjangoAppPlugin(cherrypy.engine, self.base_dir).subscribe()
+        IndexerPlugin(cherrypy.engine).subscribe()
+        ImporterPlugin(cherrypy.engine).subscribe()
 
     def run(self, callback=None):
         engine = cherrypy.engine
@@ -156,6 +162,57 @@ class DjangoAppPlugin(plugins.SimplePlugin):
         cherrypy.tree.mount(static_handler, '/static')
 
 
+class IndexerPlugin(plugins.SimplePlugin):
+    def __init__(self, bus):
+        """
+        CherryPy engine plugin to run the search indexer thread,
+        which applies the queued index updates in batches, and to load
+        the typeahead index of the patients.
+        """
+        plugins.SimplePlugin.__init__(self, bus)
+
+    def start(self):
+        self.bus.log("Starting the search indexer")
+        index_queue.start_worker()
+        self.bus.log("Loading the typeahead index")
+        try:
+            patient_name_index.load()
+        except Exception:
+            # Loaded on the first search instead
+            logger.exception("Cannot load the typeahead index")
+
+    def stop(self):
+        self.bus.log("Stopping the search indexer")
+        index_queue.stop_worker()
+
+
+class ImporterPlugin(plugins.SimplePlugin):
+    def __init__(self, bus):
+        """
+        CherryPy engine plugin to run the import jobs thread. The jobs
+        left pending by the previous run are started again.
+        """
+        plugins.SimplePlugin.__init__(self, bus)
+
+    def start(self):
+        self.bus.log("Starting the importer")
+        try:
+            import_runner.recover()
+        except Exception:
+            logger.exception("Cannot recover the import jobs")
+        import_runner.start_worker()
+
+    # Once the indexer is started
+    start.priority = 60
+
+    def stop(self):
+        self.bus.log("Stopping the importer")
+        import_runner.stop_worker()
+
+    # Before the indexer, to index its last batch
+    stop.priority = 40
+
+
 class HTTPLogger(_cplogging.LogManager):
     def __init__(self, app):
         _cplogging.LogManager.__init__(self, id(self),
@@ -228,6 +285,8 @@ class HTTPLogger(_cplogging.LogManager):
 
 
 if __name__ == '__main__':
+    # The index rebuild spawns its workers from the frozen executable
+    multiprocessing.freeze_support()
     if "__file__":
         DATA_FOLDER = os.path.dirname("__file__")
     else: